@@ -0,0 +1,336 @@
+"""
+Drop compensation for the darts.
+
+A BallisticsTable maps the range to a target onto the extra pitch the gun needs so the dart drops onto it,
+and onto the dart's time of flight. The table is built once, from a drag model or from calibration shots,
+and cached to disk; looking a range up is two array reads and an interpolation.
+
+Refit from test shots with:
+
+    python Ballistics.py shots.csv
+
+where each row of the CSV is a range (mm) and the pitch correction (degrees) that hit at that range.
+"""
+
+from timeit import default_timer
+import csv
+import math
+import numpy as np
+import os
+import sys
+import zipfile
+
+GRAVITY = 9.81
+AIR_DENSITY = 1.225
+
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ballistics.npz")
+
+class DartModel:
+    """
+    Point-mass dart with quadratic drag.
+    """
+
+    def __init__(self, muzzleVelocity = 20, mass = 1.3, diameter = 13, dragCoefficient = 0.75):
+        """
+        Parameters:
+            muzzleVelocity (float): Speed leaving the barrel (metres per second).
+            mass (float): Dart mass (grams).
+            diameter (float): Dart diameter (mm).
+            dragCoefficient (float): Drag coefficient of the dart.
+        """
+        self.muzzleVelocity = muzzleVelocity
+        self.mass = mass
+        self.diameter = diameter
+        self.dragCoefficient = dragCoefficient
+
+    def dragFactor(self):
+        # Deceleration per speed squared (per metre)
+        area = math.pi * (self.diameter / 2000) ** 2
+        return 0.5 * AIR_DENSITY * self.dragCoefficient * area / (self.mass / 1000)
+
+    def params(self):
+        return [self.muzzleVelocity, self.mass, self.diameter, self.dragCoefficient]
+
+    def trajectories(self, launchAngles, step = 0.001, maxTime = 3):
+        """
+        Flies a dart at each launch angle at once and finds where each comes back down to the height it was fired from.
+
+        Parameters:
+            launchAngles (array): Launch angles above level (degrees).
+        Returns:
+            (range in mm, time of flight in seconds) arrays, NaN for darts still in the air after maxTime
+        """
+        angles = np.radians(np.asarray(launchAngles, dtype=np.float64))
+        vx = self.muzzleVelocity * np.cos(angles)
+        vy = self.muzzleVelocity * np.sin(angles)
+        x = np.zeros_like(angles)
+        y = np.zeros_like(angles)
+        ranges = np.full_like(angles, np.nan)
+        times = np.full_like(angles, np.nan)
+        drag = self.dragFactor()
+        flying = np.ones(len(angles), dtype=bool)
+
+        t = 0
+        while t < maxTime and flying.any():
+            speed = np.hypot(vx, vy)
+            vx = vx - drag * speed * vx * step
+            vy = vy - (drag * speed * vy + GRAVITY) * step
+            newX = x + vx * step
+            newY = y + vy * step
+            t += step
+
+            # Landed this step, interpolate to where it crossed the launch height
+            landed = flying & (newY <= 0) & (vy < 0)
+            if landed.any():
+                fraction = y[landed] / (y[landed] - newY[landed])
+                ranges[landed] = (x[landed] + fraction * (newX[landed] - x[landed])) * 1000
+                times[landed] = t - step + fraction * step
+                flying &= ~landed
+            x = newX
+            y = newY
+        return ranges, times
+
+
+class BallisticsTable:
+    """
+    Pitch correction and time of flight, every `step` mm of range.
+    """
+
+    # Range covered (mm), spacing of the entries (mm) and the fan of launch angles flown to build them (degrees)
+    TABLE_SETTINGS = {"minDistance": 0, "maxDistance": 10000, "step": 10, "maxAngle": 45, "angleStep": 0.02}
+
+    def __init__(self, minDistance, step, corrections, flightTimes, params = ()):
+        """
+        Parameters:
+            minDistance (float): Range of the first entry (mm).
+            step (float): Range between entries (mm).
+            corrections (array): Pitch to add at each range (degrees).
+            flightTimes (array): Time of flight at each range (seconds).
+            params (list): What the table was built from, to check the cache against.
+        """
+        self.minDistance = float(minDistance)
+        self.step = float(step)
+        self.corrections = np.asarray(corrections, dtype=np.float64)
+        self.flightTimes = np.asarray(flightTimes, dtype=np.float64)
+        self.params = list(params)
+        self.maxDistance = self.minDistance + self.step * (len(self.corrections) - 1)
+
+        # Plain lists are quicker to index one value at a time than arrays
+        self._corrections = self.corrections.tolist()
+        self._flightTimes = self.flightTimes.tolist()
+        self._last = len(self._corrections) - 1
+
+    @classmethod
+    def fromModel(cls, model = None, **settings):
+        """
+        Builds the table by flying the drag model at a fan of launch angles and inverting range against angle.
+        Ranges past the longest the dart can reach get the correction for that longest range.
+
+        Parameters:
+            model (DartModel): Defaults to DartModel().
+            settings: Any of TABLE_SETTINGS, to override the defaults.
+        """
+        if model is None:
+            model = DartModel()
+        settings = cls.tableSettings(**settings)
+        minDistance, maxDistance, step = settings["minDistance"], settings["maxDistance"], settings["step"]
+        maxAngle, angleStep = settings["maxAngle"], settings["angleStep"]
+        angles = np.arange(0, maxAngle + angleStep, angleStep)
+        ranges, times = model.trajectories(angles)
+
+        # Only the low, flat trajectories, up to the angle of longest range
+        valid = ~np.isnan(ranges)
+        angles, ranges, times = angles[valid], ranges[valid], times[valid]
+        longest = int(np.argmax(ranges))
+        angles, ranges, times = angles[:longest + 1], ranges[:longest + 1], times[:longest + 1]
+
+        distances = np.arange(minDistance, maxDistance + step, step, dtype=np.float64)
+        corrections = np.interp(distances, ranges, angles)
+        flightTimes = np.interp(distances, ranges, times, left=0)
+        # Below the shortest range in the fan the dart is close to a straight line
+        close = distances < ranges[0]
+        flightTimes[close] = distances[close] / 1000 / model.muzzleVelocity
+        return cls(minDistance, step, corrections, flightTimes, cls.tableParams(model, **settings))
+
+    @classmethod
+    def tableSettings(cls, **settings):
+        """
+        Returns:
+            TABLE_SETTINGS with the given settings laid over them
+        """
+        for name in settings:
+            if name not in cls.TABLE_SETTINGS:
+                raise ValueError("Unknown ballistics table setting %s, expected one of %s" % (name, list(cls.TABLE_SETTINGS)))
+        return dict(cls.TABLE_SETTINGS, **settings)
+
+    @classmethod
+    def tableParams(cls, model, **settings):
+        """
+        Returns:
+            Everything a table built from the model with these settings depends on
+        """
+        settings = cls.tableSettings(**settings)
+        return model.params() + [settings[name] for name in cls.TABLE_SETTINGS]
+
+    @classmethod
+    def fromShots(cls, shots, model = None, **tableSettings):
+        """
+        Fits the drag model's muzzle velocity and drag coefficient to calibration shots, then builds the table from it.
+
+        Parameters:
+            shots (list): (range in mm, pitch correction in degrees that hit) pairs.
+            model (DartModel): Starting model, its mass and diameter are kept.
+        Returns:
+            (BallisticsTable, fitted DartModel, rms error of the fit in degrees)
+        """
+        if model is None:
+            model = DartModel()
+        shots = np.asarray(shots, dtype=np.float64)
+        if len(shots) == 0:
+            raise ValueError("No calibration shots to fit")
+        distances, measured = shots[:, 0], shots[:, 1]
+        # Only fly the angles near the measured ones, the fit is hundreds of model runs
+        angles = np.arange(0, min(45, measured.max() * 1.5 + 2) + 0.05, 0.05)
+
+        def error(velocity, dragCoefficient):
+            trial = DartModel(velocity, model.mass, model.diameter, dragCoefficient)
+            ranges, _ = trial.trajectories(angles)
+            valid = ~np.isnan(ranges)
+            ranges, fan = ranges[valid], angles[valid]
+            longest = int(np.argmax(ranges))
+            if ranges[longest] < distances.max():
+                return math.inf # Can't reach the furthest shot
+            predicted = np.interp(distances, ranges[:longest + 1], fan[:longest + 1])
+            return float(np.sqrt(np.mean((predicted - measured) ** 2)))
+
+        def bestVelocity(dragCoefficient):
+            # Golden section search, the error is close to unimodal in the muzzle velocity
+            low, high = 5.0, 60.0
+            ratio = (math.sqrt(5) - 1) / 2
+            a = high - ratio * (high - low)
+            b = low + ratio * (high - low)
+            errorA, errorB = error(a, dragCoefficient), error(b, dragCoefficient)
+            for _ in range(16):
+                if errorA <= errorB:
+                    high, b, errorB = b, a, errorA
+                    a = high - ratio * (high - low)
+                    errorA = error(a, dragCoefficient)
+                else:
+                    low, a, errorA = a, b, errorB
+                    b = low + ratio * (high - low)
+                    errorB = error(b, dragCoefficient)
+            return (a, errorA) if errorA <= errorB else (b, errorB)
+
+        best = None
+        for dragCoefficient in (0.2, 0.35, 0.5, 0.75, 1.0, 1.5, 2.0):
+            velocity, rms = bestVelocity(dragCoefficient)
+            if best is None or rms < best[2]:
+                best = (velocity, dragCoefficient, rms)
+
+        fitted = DartModel(best[0], model.mass, model.diameter, best[1])
+        return cls.fromModel(fitted, **tableSettings), fitted, best[2]
+
+    @classmethod
+    def fromCsv(cls, path, model = None, **tableSettings):
+        """
+        Reads calibration shots (range in mm, pitch correction in degrees per row) and fits them, see fromShots().
+        """
+        shots = []
+        with open(path, newline="") as file:
+            for row in csv.reader(file):
+                try:
+                    shots.append((float(row[0]), float(row[1])))
+                except (ValueError, IndexError):
+                    continue # Header or blank line
+        return cls.fromShots(shots, model, **tableSettings)
+
+    @classmethod
+    def cached(cls, model = None, path = DEFAULT_CACHE, **tableSettings):
+        """
+        Parameters:
+            model (DartModel): Model the table has to have been built from. Without one, whatever table is cached is
+                used as long as it has the same table settings, so a table fitted with `python Ballistics.py shots.csv`
+                is kept.
+        Returns:
+            The table for the model, loaded from the cache file when it was built with the same settings, otherwise built and saved
+        """
+        try:
+            table = cls.load(path)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            table = None
+        if model is None:
+            settings = cls.tableSettings(**tableSettings)
+            settings = [settings[name] for name in cls.TABLE_SETTINGS]
+            if table is not None and len(table.params) > len(settings) and np.allclose(table.params[-len(settings):], settings):
+                return table
+            model = DartModel()
+        params = cls.tableParams(model, **tableSettings)
+        if table is not None and len(table.params) == len(params) and np.allclose(table.params, params):
+            return table
+
+        table = cls.fromModel(model, **tableSettings)
+        try:
+            table.save(path)
+        except OSError as error:
+            print("Couldn't cache the ballistics table")
+            print(error)
+        return table
+
+    def save(self, path = DEFAULT_CACHE):
+        # Written aside and swapped in, other processes may be loading the cache at the same time
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary, "wb") as file:
+            np.savez(file, header=np.array([self.minDistance, self.step]), corrections=self.corrections,
+                flightTimes=self.flightTimes, params=np.array(self.params, dtype=np.float64))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path = DEFAULT_CACHE):
+        with np.load(path) as data:
+            minDistance, step = data["header"].tolist()
+            return cls(minDistance, step, data["corrections"], data["flightTimes"], data["params"].tolist())
+
+    def lookup(self, values, distance):
+        position = (distance - self.minDistance) / self.step
+        if position <= 0:
+            return values[0]
+        index = int(position)
+        if index >= self._last:
+            return values[self._last]
+        fraction = position - index
+        return values[index] + fraction * (values[index + 1] - values[index])
+
+    def correction(self, distance):
+        """
+        Parameters:
+            distance (float): Range to the target (mm).
+        Returns:
+            Pitch to add above the line of sight (degrees)
+        """
+        return self.lookup(self._corrections, distance)
+
+    def flightTime(self, distance):
+        """
+        Returns:
+            Time for a dart to travel the range (seconds)
+        """
+        return self.lookup(self._flightTimes, distance)
+
+
+def main():
+    if len(sys.argv) < 2:
+        start = default_timer()
+        table = BallisticsTable.fromModel()
+        print("Built the default table in %.3fs" % (default_timer() - start))
+    else:
+        table, model, rms = BallisticsTable.fromCsv(sys.argv[1])
+        print("Fitted muzzle velocity %.1f m/s, drag coefficient %.2f, rms error %.2f degrees" % (model.muzzleVelocity, model.dragCoefficient, rms))
+    table.save()
+    print("Saved to %s" % DEFAULT_CACHE)
+
+    for distance in (500, 1000, 2000, 3000, 5000, 8000):
+        print("%6dmm: +%.2f degrees, %.3fs flight" % (distance, table.correction(distance), table.flightTime(distance)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Microbenchmark of Person Sensor frame decoding.
+
+Compares the original per-face struct.unpack_from loop against PersonSensorDecoder,
+on its own, with the dictionary compatibility view and with frame validation. Runs without any hardware attached.
+"""
+
+from PersonSensor import PersonSensor, PersonSensorDecoder, SensorLens, Face
+from timeit import default_timer as timer
+import random
+import struct
+
+def recordFrames(count = 1000, seed = 0):
+    """
+    Returns a list of result frames with 0 to 4 faces, laid out as the sensor sends them.
+    """
+    rng = random.Random(seed)
+    decoder = PersonSensorDecoder()
+    frames = []
+    for _ in range(count):
+        numFaces = rng.randint(0, PersonSensorDecoder.FACE_MAX)
+        values = [0, 0, PersonSensorDecoder.RESULT.size - PersonSensorDecoder.HEADER.size, numFaces]
+        for i in range(PersonSensorDecoder.FACE_MAX):
+            left, top = rng.randrange(200), rng.randrange(200)
+            face = [rng.randrange(60, 100), left, top, left + rng.randrange(1, 55), top + rng.randrange(1, 55), rng.randrange(100), rng.randrange(-1, 8), rng.randrange(2)]
+            values.extend(face if i < numFaces else [0] * len(Face._fields))
+        values.append(0)
+        frame = bytearray(PersonSensorDecoder.RESULT.pack(*values))
+        checksum = decoder.crc(frame[:PersonSensorDecoder.CHECKSUM_OFFSET])
+        PersonSensorDecoder.CHECKSUM.pack_into(frame, PersonSensorDecoder.CHECKSUM_OFFSET, checksum)
+        frames.append(bytes(frame))
+    return frames
+
+
+def legacyDecode(read_bytes):
+    # The decoding PersonSensor.update() used before PersonSensorDecoder
+    offset = 0
+    (pad1, pad2, payload_bytes) = struct.unpack_from("BBH", read_bytes, offset)
+    offset = offset + struct.calcsize("BBH")
+
+    (num_faces) = struct.unpack_from("B", read_bytes, offset)
+    num_faces = int(num_faces[0])
+    offset = offset + 1
+
+    faces = []
+    for i in range(num_faces):
+        (box_confidence, box_left, box_top, box_right, box_bottom, id_confidence, id, is_facing) = struct.unpack_from("BBBBBBbB", read_bytes, offset)
+        offset = offset + struct.calcsize("BBBBBBbB")
+        x = box_left + (box_right - box_left)
+        y = box_top + (box_bottom - box_top)
+        x2 = x - (((255 - 60) / 2) + 60)
+        y2 = y - (((255 - 60) / 2) + 60)
+        faces.append({
+            "box_confidence": box_confidence,
+            "box_left": box_left,
+            "box_top": box_top,
+            "box_right": box_right,
+            "box_bottom": box_bottom,
+            "box_centre": [x, y],
+            "from_centre": [x2, y2],
+            "id_confidence": id_confidence,
+            "id": id,
+            "is_facing": is_facing,
+        })
+    if (num_faces > 0):
+        return faces
+    return -1
+
+
+class OfflineSensor(PersonSensor):
+    """
+    A PersonSensor that doesn't open the I2C bus, used for the dictionary compatibility view.
+    """
+    def __init__(self):
+        self.decoder = PersonSensorDecoder()
+        self.dictFaces = True
+        self.setLens(SensorLens())
+
+
+def timeDecode(frames, decode, repeats = 20):
+    start = timer()
+    for _ in range(repeats):
+        for frame in frames:
+            decode(frame)
+    return (timer() - start) / (repeats * len(frames))
+
+
+def main():
+    frames = recordFrames()
+    decoder = PersonSensorDecoder()
+    sensor = OfflineSensor()
+
+    def decodeIntoBuffer(frame):
+        # As PersonSensor.read() does, the frame lands in the preallocated buffer
+        decoder.view[:] = frame
+        return decoder.decode()
+
+    def withoutCentres(faces):
+        # The centre fields changed when the box centre was fixed, everything else must match the original
+        if faces == -1:
+            return faces
+        return [{key: value for key, value in face.items() if key not in ("box_centre", "from_centre")} for face in faces]
+
+    for frame in frames:
+        assert withoutCentres(sensor.present(decoder.decode(frame) or -1)) == withoutCentres(legacyDecode(frame))
+
+    legacy = timeDecode(frames, legacyDecode)
+    records = timeDecode(frames, decodeIntoBuffer)
+    dicts = timeDecode(frames, lambda frame: sensor.present(decodeIntoBuffer(frame) or -1))
+
+    def checkAndDecode(frame):
+        decoder.view[:] = frame
+        if decoder.check() == decoder.ACCEPTED:
+            return decoder.decode()
+    checked = timeDecode(frames, checkAndDecode)
+
+    print("%-28s %10s" % ("decoder", "us/frame"))
+    print("%-28s %10.2f" % ("legacy unpack_from loop", legacy * 1e6))
+    print("%-28s %10.2f" % ("PersonSensorDecoder", records * 1e6))
+    print("%-28s %10.2f" % ("  + dictionary view", dicts * 1e6))
+    print("%-28s %10.2f" % ("  + checksum and repeat check", checked * 1e6))
+    print("frames: %s" % decoder.getStats())
+
+
+if __name__ == '__main__':
+    main()
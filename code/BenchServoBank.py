@@ -0,0 +1,96 @@
+"""
+Benchmark of per-object Servo.update() calls against a single ServoBank.update().
+
+Checks both produce the same trajectories, then reports the per-tick cost at 6, 16, 32, 48 and 64 channels.
+Banks smaller than ServoBank.SCALAR_CHANNELS are stepped one servo at a time, larger ones with NumPy.
+Runs without any hardware attached.
+"""
+
+from CustomServo import Servo
+from ServoBank import ServoBank
+from timeit import default_timer as timer
+import random
+
+class StandInServo:
+    """
+    Takes the place of servokit.servo[index], just stores what is written to it.
+    """
+    def __init__(self):
+        self.actuation_range = 180
+        self.angle = None
+
+    def set_pulse_width_range(self, minPulse, maxPulse):
+        pass
+
+
+def makeServos(count, seed = 0):
+    rng = random.Random(seed)
+    servos = []
+    for i in range(count):
+        servos.append(Servo(StandInServo(), dom=180, minAngle=10, maxAngle=170, restAngle=90,
+            maxSpeed=rng.choice([150, 250, 400]), acceleration=rng.choice([1000, 2000, 4000]),
+            invert=(i % 3 == 0), name="servo-%s" % i))
+    return servos
+
+
+def makeTargets(count, moves, seed = 1):
+    """
+    Returns a list of (tick, channel, angle) retargets spread over the run.
+    """
+    rng = random.Random(seed)
+    return [(rng.randrange(moves * 40), rng.randrange(count), rng.uniform(10, 170)) for _ in range(moves * count)]
+
+
+def run(servos, targets, ticks, step, bank = None):
+    """
+    Drives the servos through the retargets with a fixed tick length.
+
+    Returns:
+        (trajectory, seconds per tick)
+    """
+    retargets = {}
+    for tick, channel, angle in targets:
+        retargets.setdefault(tick, []).append((channel, angle))
+
+    trajectory = []
+    elapsed = 0
+    for tick in range(ticks):
+        currentTime = 1 + tick * step
+        for channel, angle in retargets.get(tick, ()):
+            servos[channel].setAngle(angle, currentTime)
+
+        start = timer()
+        if bank is None:
+            for servo in servos:
+                servo.update(currentTime)
+        else:
+            bank.update(currentTime)
+        elapsed += timer() - start
+
+        trajectory.append([servo.servo.angle for servo in servos])
+    return trajectory, elapsed / ticks
+
+
+def compare(count, ticks = 2000, step = 0.01):
+    targets = makeTargets(count, ticks // 40)
+
+    servos = makeServos(count)
+    reference, perObject = run(servos, targets, ticks, step)
+
+    servos = makeServos(count)
+    bank = ServoBank(servos)
+    trajectory, banked = run(servos, targets, ticks, step, bank)
+
+    mismatches = sum(1 for a, b in zip(reference, trajectory) if a != b)
+    return perObject, banked, mismatches
+
+
+def main():
+    print("%8s %16s %16s %8s %10s" % ("channels", "per-object (us)", "ServoBank (us)", "speedup", "mismatches"))
+    for count in (6, 16, 32, 48, 64):
+        perObject, banked, mismatches = compare(count)
+        print("%8s %16.1f %16.1f %7.2fx %10s" % (count, perObject * 1e6, banked * 1e6, perObject / banked, mismatches))
+
+
+if __name__ == '__main__':
+    main()
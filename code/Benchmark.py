@@ -0,0 +1,303 @@
+"""
+End-to-end latency benchmarks, run against the hardware simulator.
+
+Measures the path from a Person Sensor frame becoming readable, through PersonSensor.read(),
+findLargestFace/getAngleEstimation and ServoHandler.fromCentre, to the servo update that writes a new angle.
+Also measures control-loop jitter and CPU time per tick, and time-to-settle for standard retargets.
+
+    python Benchmark.py --output results.json
+    python Benchmark.py --compare results.json --tolerance 0.1
+
+Results are written as JSON when --output is given. In compare mode any simulated-time metric that got worse than
+the baseline by more than the tolerance is listed and the exit status is 1. Those come out the same on every run of
+the same code, the wall-clock ones (CPU per stage, jitter) move by more than any sensible tolerance between runs,
+so they're shown against the baseline but never fail the comparison.
+"""
+
+from Hardware import RealClock
+from Simulator import Simulator, ScriptedTarget
+from TargetTracker import TargetTracker
+from timeit import default_timer as perfTimer
+import Hardware
+import argparse
+import json
+import math
+import sys
+import time
+
+# Metrics measured in simulated time only, the ones compare() gates on
+DETERMINISTIC = ("latency.frame_to_pwm_simulated.", "settle.", "bus.")
+
+def percentiles(samples):
+    """
+    Returns:
+        Summary of a list of samples, in the units of the samples
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": rank(0.50),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "max": ordered[-1],
+    }
+
+
+def weavingPath(t):
+    return [90 + 25 * math.sin(2 * math.pi * 0.15 * t), 100 + 6 * math.sin(2 * math.pi * 0.1 * t)]
+
+
+def makeTurret(targets, clock = None, start = False):
+    """
+    Builds a ServoHandler and PersonSensor on a fresh simulator.
+    """
+    sim = Simulator(targets, clock=clock)
+    Hardware.useSimulator(sim)
+    from ServoHandler import ServoHandler
+    from PersonSensor import PersonSensor
+    handler = ServoHandler(start=start)
+    handler.enable()
+    sensor = PersonSensor(continuous=False)
+    sim.followCamera(handler)
+    return sim, handler, sensor
+
+
+def stageLatency(duration = 120, tickRate = 100):
+    """
+    Per-stage CPU latency and frame-to-PWM latency, in simulated time with the CPU time of each stage added,
+    and in simulated time alone. The new angle goes out with the write batch flushed at the end of the following tick.
+    """
+    sim, handler, sensor = makeTurret([ScriptedTarget(weavingPath)])
+    stages = {"decode": [], "select": [], "command": [], "frame_to_pwm": [], "frame_to_pwm_simulated": [], "tick_cpu": []}
+    step = 1 / tickRate
+    nextPoll = 0
+    pending = None # (frame available time, cpu time so far, pulse count before the command)
+
+    def pwmWritten(t, cpu):
+        stages["frame_to_pwm"].append((t - pending[0]) + cpu)
+        stages["frame_to_pwm_simulated"].append(t - pending[0])
+
+    for i in range(int(duration * tickRate)):
+        t = i * step
+        sim.clock.time = t
+
+        if t >= nextPoll:
+            nextPoll += sensor.PERSON_SENSOR_DELAY
+            start = perfTimer()
+            faces = sensor.read()
+            decoded = perfTimer()
+            if sensor.lastStatus == sensor.decoder.ACCEPTED and faces != -1:
+                angles = sensor.getAngleEstimation(sensor.findLargestFace(faces))
+                selected = perfTimer()
+                pulses = sim.pulseCount
+                handler.fromCentre(angles)
+                commanded = perfTimer()
+                stages["decode"].append(decoded - start)
+                stages["select"].append(selected - decoded)
+                stages["command"].append(commanded - selected)
+                bus = sim.personSensor
+                pending = (bus.captureTime(bus.frameIndex) + bus.latency, commanded - start, pulses)
+
+        start = perfTimer()
+        handler.tick(t)
+        tickTime = perfTimer() - start
+        stages["tick_cpu"].append(tickTime)
+        if pending is not None and sim.pulseCount > pending[2]:
+            pwmWritten(t, pending[1] + tickTime)
+            pending = None
+
+    return {name: percentiles(samples) for name, samples in stages.items()}
+
+
+def loopJitter(duration = 5, tickRate = 100):
+    """
+    Runs the real update thread in real time and measures the interval between ticks while moving.
+    """
+    sim, handler, sensor = makeTurret([], clock=RealClock())
+    tickTimes = []
+    tick = handler.tick
+    def timedTick(currentTime = None):
+        tickTimes.append(perfTimer())
+        tick(currentTime)
+    handler.tick = timedTick
+    handler.setUpdateRate(tickRate)
+    handler.start()
+    cpuStart = time.process_time()
+    ticksStart = handler.scheduler.ticks
+    end = time.monotonic() + duration
+    swing = 0
+    while time.monotonic() < end:
+        # Keep the camera sweeping so the loop never idles
+        swing += 1
+        handler.setCamera([40 if swing % 2 else 140, 60 if swing % 2 else 120])
+        time.sleep(0.4)
+    cpu = time.process_time() - cpuStart
+    ticks = handler.scheduler.ticks - ticksStart
+    handler.stop()
+    time.sleep(0.05)
+
+    period = 1 / tickRate
+    intervals = [b - a for a, b in zip(tickTimes, tickTimes[1:]) if b - a < 5 * period]
+    return {
+        "jitter": percentiles([abs(interval - period) for interval in intervals]),
+        "cpu_per_tick": cpu / ticks if ticks else None,
+        "ticks": ticks,
+        "overruns": handler.scheduler.overruns,
+    }
+
+
+def settleTimes(tickRate = 100):
+    """
+    Simulated time for standard retargets to settle.
+    """
+    results = {}
+    step = 1 / tickRate
+
+    # Gun moves, planned from rest
+    for name, angles in (("gun_small", [145, 95]), ("gun_diagonal", [195, 115]), ("gun_large", [15, 65])):
+        sim, handler, sensor = makeTurret([])
+        handler.moveTurret([135, 90])
+        sim.run(2, step, handler.tick)
+        start = sim.clock.now()
+        handler.moveTurret(angles)
+        while not (handler.gunYaw.atPos and handler.gunYPitch.atPos) and sim.clock.now() - start < 5:
+            sim.clock.advance(step)
+            handler.tick(sim.clock.now())
+        results[name] = sim.clock.now() - start
+
+    # Camera acquiring a target that appears off centre, through the sensor loop
+    for name, offset in (("acquire_near", 10), ("acquire_far", 35)):
+        target = ScriptedTarget(lambda t, offset=offset: [90 + offset, 75])
+        sim, handler, sensor = makeTurret([target])
+        start = sim.clock.now()
+        settledSince = None
+        nextPoll = 0
+        while sim.clock.now() - start < 10:
+            t = sim.clock.now()
+            if t >= nextPoll:
+                nextPoll += sensor.PERSON_SENSOR_DELAY
+                faces = sensor.read()
+                if sensor.lastStatus == sensor.decoder.ACCEPTED and faces != -1:
+                    handler.fromCentre(sensor.getAngleEstimation(sensor.findLargestFace(faces)))
+            handler.tick(t)
+            error = math.hypot(*[a - b for a, b in zip(handler.cameraAngles(t), target.position(t))])
+            if error < 3:
+                settledSince = t if settledSince is None else settledSince
+                if t - settledSince > 1:
+                    break
+            else:
+                settledSince = None
+            sim.clock.advance(step)
+        results[name] = (settledSince - start) if settledSince is not None else None
+    return results
+
+
+def busWrites(duration = 30, tickRate = 100):
+    """
+    I2C traffic for the servo writes while tracking, against one transaction per servo update.
+    """
+    sim, handler, sensor = makeTurret([ScriptedTarget(weavingPath)])
+    tracker = TargetTracker()
+    handler.track(tracker)
+    def tick(t):
+        faces = sensor.read()
+        if sensor.lastStatus == sensor.decoder.ACCEPTED and faces != -1:
+            angles = sensor.getAngleEstimation(sensor.findLargestFace(faces))
+            camera = handler.cameraAngles(t)
+            tracker.addMeasurement([camera[0] + angles[0], camera[1] + angles[1]], t)
+        handler.tick(t)
+    sim.run(duration, 1 / tickRate, tick)
+    stats = handler.getWriteStats()
+    return {
+        "transactions_per_tick": stats["transactions"] / stats["flushes"],
+        "bytes_per_tick": stats["bytes"] / stats["flushes"],
+        "unbatched_transactions_per_tick": stats["baseline_transactions"] / stats["flushes"],
+        "unbatched_bytes_per_tick": stats["baseline_bytes"] / stats["flushes"],
+    }
+
+
+def runAll(quick = False):
+    return {
+        "latency": stageLatency(30 if quick else 120),
+        "loop": loopJitter(2 if quick else 5),
+        "settle": settleTimes(),
+        "bus": busWrites(),
+    }
+
+
+def flatten(results, prefix = ""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance, gated = DETERMINISTIC):
+    """
+    Parameters:
+        gated (tuple of str): Prefixes of the metrics checked, defaults to the simulated-time ones.
+    Returns:
+        List of (metric, baseline, current) for metrics that got worse by more than the tolerance.
+        Every metric is a time or a count of bad events, so bigger is worse. None means it never settled.
+    """
+    current = flatten(results)
+    regressions = []
+    for metric, old in flatten(baseline).items():
+        if metric.endswith(".count") or metric.endswith(".ticks") or metric not in current:
+            continue
+        if not metric.startswith(gated):
+            continue
+        new = current[metric]
+        if old is None:
+            continue
+        if new is None:
+            regressions.append((metric, old, math.inf))
+        elif new > old * (1 + tolerance) and new - old > 1e-6:
+            regressions.append((metric, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Turret latency benchmarks (simulated hardware)")
+    parser.add_argument("--output", help="Where to write the results, they're only printed without it")
+    parser.add_argument("--compare", help="Baseline results to check against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed fractional regression")
+    parser.add_argument("--quick", action="store_true", help="Shorter runs")
+    args = parser.parse_args()
+
+    results = runAll(args.quick)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = flatten(json.load(file))
+
+    for metric, value in sorted(flatten(results).items()):
+        line = "%-40s %12s" % (metric, "-" if value is None else "%.6f" % value)
+        if baseline is not None and baseline.get(metric) is not None and value is not None:
+            line += "  (baseline %.6f%s)" % (baseline[metric], "" if metric.startswith(DETERMINISTIC) else ", not gated")
+        print(line)
+
+    if args.compare:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against %s:" % args.compare)
+            for metric, old, new in regressions:
+                print("%-40s %12.6f -> %12.6f" % (metric, old, new))
+            sys.exit(1)
+        print("\nNo regressions against %s" % args.compare)
+
+
+if __name__ == '__main__':
+    main()
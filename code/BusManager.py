@@ -0,0 +1,208 @@
+from collections import deque
+from contextlib import contextmanager
+from timeit import default_timer
+import heapq
+import itertools
+import threading
+
+# Lower numbers get the bus first
+PRIORITY_SERVO = 0
+PRIORITY_SENSOR = 1
+PRIORITY_BACKGROUND = 2
+
+class BusOperation:
+    """
+    A run() call waiting for the bus, that later identical calls can share.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BusManager:
+    """
+    Owns the I2C bus shared by the servo HAT, the VL53L0X and the Person Sensor.
+
+    Every transaction claims the bus first, and while it's busy the waiting claims are granted in priority order,
+    so a servo write queued behind a sensor read goes next instead of waiting its turn. A transaction that has
+    started is never interrupted, a long sensor read is made of many short claims so servos get in between them.
+    Operations run with a key are coalesced: a call made while an identical one is still waiting for the bus
+    doesn't queue again, it waits for the queued one and shares its result.
+
+    Times are wall clock, even under the simulator's virtual clock, since they measure real contention.
+    """
+
+    def __init__(self, waitSamples = 1000):
+        """
+        Parameters:
+            waitSamples (int): Most recent queue waits kept per device, for the percentiles in getStats().
+        """
+        self.condition = threading.Condition()
+        self.waiting = [] # Heap of (priority, sequence)
+        self.sequence = itertools.count()
+        self.owner = None
+        self.depth = 0
+        self.ownerName = None
+        self.claimedAt = 0
+        self.queued = {} # key -> BusOperation that hasn't got the bus yet
+        self.waitSamples = waitSamples
+        self.resetStats()
+
+    def resetStats(self):
+        with self.condition:
+            self.startTime = default_timer()
+            self.busyTime = 0
+            self.devices = {}
+
+    def deviceStats(self, name):
+        stats = self.devices.get(name)
+        if stats is None:
+            stats = {"transactions": 0, "coalesced": 0, "busy": 0, "wait": 0, "max_wait": 0, "waits": deque(maxlen=self.waitSamples)}
+            self.devices[name] = stats
+        return stats
+
+    def acquire(self, priority = PRIORITY_SENSOR, name = "unnamed"):
+        """
+        Blocks until this thread has the bus. Claims can be nested by the thread that holds the bus.
+        """
+        me = threading.get_ident()
+        with self.condition:
+            if self.owner == me:
+                self.depth += 1
+                return
+            queuedAt = default_timer()
+            entry = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, entry)
+            while self.owner is not None or self.waiting[0] != entry:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+
+            self.owner = me
+            self.depth = 1
+            self.ownerName = name
+            self.claimedAt = default_timer()
+
+            wait = self.claimedAt - queuedAt
+            stats = self.deviceStats(name)
+            stats["transactions"] += 1
+            stats["wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            stats["waits"].append(wait)
+
+    def release(self):
+        with self.condition:
+            self.depth -= 1
+            if self.depth > 0:
+                return
+            busy = default_timer() - self.claimedAt
+            self.busyTime += busy
+            self.deviceStats(self.ownerName)["busy"] += busy
+            self.owner = None
+            self.condition.notify_all()
+
+    @contextmanager
+    def claim(self, priority = PRIORITY_SENSOR, name = "unnamed"):
+        self.acquire(priority, name)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def run(self, function, priority = PRIORITY_SENSOR, name = "unnamed", key = None):
+        """
+        Runs function() with the bus claimed.
+
+        Parameters:
+            function (function): The transaction, takes no arguments.
+            priority (int): PRIORITY_SERVO, PRIORITY_SENSOR or PRIORITY_BACKGROUND.
+            name (str): Device name for the statistics.
+            key: Calls with the same key are coalesced while one is waiting for the bus, None never coalesces.
+        Returns:
+            Whatever function() returns
+        """
+        if key is None or self.owner == threading.get_ident():
+            with self.claim(priority, name):
+                return function()
+
+        with self.condition:
+            operation = self.queued.get(key)
+            joined = operation is not None
+            if joined:
+                self.deviceStats(name)["coalesced"] += 1
+            else:
+                operation = BusOperation()
+                self.queued[key] = operation
+
+        if joined:
+            operation.done.wait()
+            if operation.error is not None:
+                raise operation.error
+            return operation.result
+
+        try:
+            with self.claim(priority, name):
+                with self.condition:
+                    # Started, anything asked for from now on needs a new transaction
+                    del self.queued[key]
+                operation.result = function()
+        except BaseException as error:
+            operation.error = error
+            raise
+        finally:
+            operation.done.set()
+        return operation.result
+
+    def wrap(self, i2c, priority = PRIORITY_SENSOR, name = "unnamed"):
+        """
+        Returns:
+            A busio.I2C stand-in for Adafruit drivers, whose locking claims this bus
+        """
+        return ManagedI2C(i2c, self, priority, name)
+
+    def getStats(self):
+        with self.condition:
+            elapsed = max(1e-9, default_timer() - self.startTime)
+            devices = {}
+            for name, stats in self.devices.items():
+                waits = sorted(stats["waits"])
+                transactions = max(1, stats["transactions"])
+                devices[name] = {
+                    "transactions": stats["transactions"],
+                    "coalesced": stats["coalesced"],
+                    "utilisation": stats["busy"] / elapsed,
+                    "mean_wait": stats["wait"] / transactions,
+                    "p95_wait": waits[int(0.95 * (len(waits) - 1))] if waits else 0,
+                    "max_wait": stats["max_wait"],
+                }
+            return {
+                "utilisation": self.busyTime / elapsed,
+                "queued": len(self.waiting),
+                "devices": devices,
+            }
+
+
+class ManagedI2C:
+    """
+    Wraps a busio.I2C so an Adafruit driver's own locking (I2CDevice calls try_lock() and unlock()
+    around every transaction) goes through a BusManager.
+    """
+    def __init__(self, i2c, bus, priority, name):
+        self.i2c = i2c
+        self.bus = bus
+        self.priority = priority
+        self.name = name
+
+    def try_lock(self):
+        self.bus.acquire(self.priority, self.name)
+        if self.i2c.try_lock():
+            return True
+        self.bus.release()
+        return False
+
+    def unlock(self):
+        self.i2c.unlock()
+        self.bus.release()
+
+    def __getattr__(self, name):
+        return getattr(self.i2c, name)
@@ -0,0 +1,165 @@
+"""
+The turret's calibration profile: every servo's channel, pulse range, limits, rest angle, horn adjustment and
+motion limits, the fire control angles and timings, the gains of the fromCentre() tracking law, and whether the
+Person Sensor's frame checksums are verified.
+
+defaultConfig.json holds the values for the standard build. A profile written by ServoPositionCalibration.py
+(calibration.json next to this file, or the file TURRET_CALIBRATION names) is laid over it, so it only has to
+hold what differs. Profiles carry a version, older layouts are migrated when they're loaded.
+"""
+
+import copy
+import json
+import os
+
+VERSION = 1
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULTS_PATH = os.path.join(DIRECTORY, "defaultConfig.json")
+DEFAULT_PATH = os.path.join(DIRECTORY, "calibration.json")
+
+SERVO_NAMES = ("gunYaw", "gunPitch", "prime", "trigger", "trackYaw", "trackPitch")
+SERVO_FIELDS = ("channel", "dom", "minPulse", "maxPulse", "minAngle", "maxAngle", "restAngle",
+    "maxSpeed", "acceleration", "jerk", "adjustment", "invert", "deadband")
+FIRE_CONTROL_FIELDS = ("primeActiveAngle", "triggerPullAngle", "spinupTime", "triggerDepressionDelay")
+TRACKING_FIELDS = ("gain", "rateGain")
+PERSON_SENSOR_FIELDS = ("verifyChecksum",)
+
+
+def profilePath(path = None):
+    if path is not None:
+        return path
+    return os.environ.get("TURRET_CALIBRATION", DEFAULT_PATH)
+
+
+def readJson(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def migrate(data, path = "profile"):
+    """
+    Brings a profile's dictionary up to the current VERSION.
+
+    Version 0 is the original defaultConfig.json layout, the same servo sections without a version.
+    """
+    version = data.get("version", 0)
+    if version > VERSION:
+        raise ValueError("%s is calibration version %s, this code reads up to version %s" % (path, version, VERSION))
+    data = dict(data)
+    if version == 0:
+        data.setdefault("servos", {})
+        data.setdefault("fireControl", {})
+        data.setdefault("tracking", {})
+        data["version"] = 1
+    return data
+
+
+class CalibrationProfile:
+    """
+    One profile, as loaded from disk or being built by the calibration tool.
+    """
+
+    def __init__(self, data = None, path = None):
+        """
+        Parameters:
+            data (dict): The profile's contents, defaults to defaultConfig.json.
+            path (str): File save() writes to, defaults to profilePath().
+        """
+        if data is None:
+            data = readJson(DEFAULTS_PATH)
+        data = migrate(data, path or "profile")
+        self.servos = {}
+        self.fireControl = {}
+        self.tracking = {}
+        self.personSensor = {}
+        self.path = profilePath(path)
+        self.merge(data)
+
+    def merge(self, data):
+        """
+        Lays another profile's values over this one's.
+        """
+        data = migrate(data)
+        for name, settings in data.get("servos", {}).items():
+            self.setServo(name, **settings)
+        self.setFireControl(**data.get("fireControl", {}))
+        self.setTracking(**data.get("tracking", {}))
+        self.setPersonSensor(**data.get("personSensor", {}))
+
+    def setServo(self, name, **settings):
+        if name not in SERVO_NAMES:
+            raise ValueError("Unknown servo %s in calibration, expected one of %s" % (name, list(SERVO_NAMES)))
+        for field in settings:
+            if field not in SERVO_FIELDS:
+                raise ValueError("Unknown calibration setting %s for servo %s" % (field, name))
+        self.servos.setdefault(name, {}).update(settings)
+
+    def setFireControl(self, **settings):
+        for field in settings:
+            if field not in FIRE_CONTROL_FIELDS:
+                raise ValueError("Unknown fire control calibration setting %s" % field)
+        self.fireControl.update(settings)
+
+    def setTracking(self, **settings):
+        for field in settings:
+            if field not in TRACKING_FIELDS:
+                raise ValueError("Unknown tracking calibration setting %s" % field)
+        self.tracking.update(settings)
+
+    def setPersonSensor(self, **settings):
+        for field in settings:
+            if field not in PERSON_SENSOR_FIELDS:
+                raise ValueError("Unknown Person Sensor calibration setting %s" % field)
+        self.personSensor.update(settings)
+
+    def verifyChecksum(self):
+        """
+        Returns:
+            Whether Person Sensor frames with a bad checksum should be dropped, off unless the profile turns it on
+        """
+        return bool(self.personSensor.get("verifyChecksum", False))
+
+    def channel(self, name):
+        return self.servos[name]["channel"]
+
+    def servoSettings(self, name):
+        """
+        Returns:
+            Keyword arguments for CustomServo.Servo
+        """
+        settings = {field: value for field, value in self.servos[name].items() if field != "channel"}
+        if "invert" in settings:
+            settings["invert"] = bool(settings["invert"]) # Stored as 0 or 1 in the original layout
+        return settings
+
+    def toDict(self):
+        return {
+            "version": VERSION,
+            "servos": copy.deepcopy(self.servos),
+            "fireControl": dict(self.fireControl),
+            "tracking": dict(self.tracking),
+            "personSensor": dict(self.personSensor),
+        }
+
+    def save(self, path = None):
+        """
+        Writes the whole profile. The file is replaced in one step, so a crash never leaves half a profile behind.
+        """
+        path = self.path if path is None else path
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.toDict(), file, indent="\t", separators=(",", " : "))
+        os.replace(temporary, path)
+        return path
+
+
+def load(path = None):
+    """
+    Returns:
+        defaultConfig.json with the profile at path (defaults to profilePath()) laid over it, when there is one
+    """
+    profile = CalibrationProfile(path=path)
+    if os.path.exists(profile.path):
+        profile.merge(readJson(profile.path))
+    return profile
@@ -1,10 +1,55 @@
-from timeit import default_timer as timer
+from Hardware import timer
+from MotionProfile import MotionProfile, trapezoid
+
+class BankedField:
+    """
+    A Servo attribute that is stored in a ServoBank array once the servo has been added to a bank.
+    Until then it is stored on the servo like any other attribute.
+    """
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+    
+    def __get__(self, servo, owner = None):
+        if servo is None:
+            return self
+        bank = servo.__dict__.get("bank")
+        if bank is None:
+            return servo.__dict__[self.name]
+        return getattr(bank, self.name)[servo.bankIndex].item()
+    
+    def __set__(self, servo, value):
+        bank = servo.__dict__.get("bank")
+        if bank is None:
+            servo.__dict__[self.name] = value
+        else:
+            getattr(bank, self.name)[servo.bankIndex] = value
+
 
 class Servo:
     """
     A custom servo clas built to expand the Adafruit ServoKit library
     """
     
+    # Motion state and limits, these move into ServoBank arrays when the servo is added to a bank
+    BANKED_FIELDS = ("dom", "minAngle", "maxAngle", "maxSpeed", "invert", "acceleration",
+        "currentSpeed", "currentAngle", "targetAngle", "atPos", "arrivalTime")
+    dom = BankedField()
+    minAngle = BankedField()
+    maxAngle = BankedField()
+    maxSpeed = BankedField()
+    invert = BankedField()
+    acceleration = BankedField()
+    currentSpeed = BankedField()
+    currentAngle = BankedField()
+    targetAngle = BankedField()
+    atPos = BankedField()
+    arrivalTime = BankedField()
+    
+    # Settings kept in the calibration profile, see Calibration.py
+    CALIBRATION_FIELDS = ("dom", "minPulse", "maxPulse", "minAngle", "maxAngle", "restAngle", "maxSpeed",
+        "acceleration", "jerk", "adjustment", "invert", "deadband")
+    
     def __init__(self, servo,
         dom = 180, 
         minPulse = 500, maxPulse = 2500,
@@ -12,8 +57,10 @@ class Servo:
         restAngle = 90,
         maxSpeed = 250,
         acceleration = 2000,
+        jerk = 20000,
         adjustment = 0,
         invert = False,
+        deadband = 1,
         name = "generic-servo"):
         """
         Servo setup.
@@ -26,11 +73,15 @@ class Servo:
             restAngle (int): Resting angle of the servo.
             maxSpeed (int): Maximum speed limit of the servo (degrees per second).
             acceleration (int): Acceleration/decceleration rate (degrees per second per second).
+            jerk (int): Rate of change of acceleration for S-curve moves (degrees per second cubed).
             adjustment (int): Servo horn ange adjustment.
             invert (bool): Inverts the servo if it moves the wrong way.
+            deadband (float): Targets closer than this to a resting servo are ignored (degrees).
         """
         
         # Establish all parameters of the servo
+        self.bank = None
+        self.bankIndex = -1
         self.servo = servo
         self.dom = dom
         self.minPulse = minPulse
@@ -48,18 +99,20 @@ class Servo:
         
         # Variables of the servo
         self.acceleration = acceleration
-        self.currentJump = 0
+        self.jerk = jerk
+        self.deadband = deadband
         self.currentSpeed = 0
-        self.prevSpeed = 0
         self.currentAngle = self.restAngle
         self.targetAngle = self.currentAngle
         self.servo.angle = self.restAngle
-        self.direction = 0
         self.adjustment = adjustment
         self.atPos = False
         self.targetFrozen = False
+        self.wakeEvent = None # Optional threading.Event, set whenever a new target is given
         
-        self.timeAtLastUpdate = timer()
+        # The current move, planned once in setAngle() and evaluated in update()
+        self.profile = MotionProfile.hold(self.currentAngle, timer())
+        self.arrivalTime = self.profile.endTime
     
     
     def getDirection(self, current, target):
@@ -68,10 +121,43 @@ class Servo:
         return (target - current) / abs(target - current)
     
     
-    def setAngle(self, target):
+    def setAngle(self, target, currentUptime = None):
         """
+        Plans a move to the target angle.
+        
+        Parameters:
+            target (float): Angle to move to (before adjustment and inversion).
+            currentUptime (float): Time the move starts, defaults to the current timer() value.
         Returns:
-            self.update() : If the Update thread crashes, this will continue to move the servo without acceleration
+            self.update() : If the Update thread crashes, this will continue to move the servo
+        """
+        if (currentUptime is None):
+            currentUptime = timer()
+        
+        target = self.resolveTarget(target)
+        
+        if (target == self.targetAngle):
+            # Already heading there, nothing to replan
+            return self.update(currentUptime)
+        
+        # Bring the servo up to date so the new move starts from where it actually is
+        self.update(currentUptime)
+        
+        if (self.currentSpeed == 0 and abs(target - self.currentAngle) < self.deadband):
+            profile = MotionProfile.hold(self.currentAngle, currentUptime)
+        else:
+            profile = trapezoid(self.currentAngle, target, self.maxSpeed, self.acceleration, currentUptime, self.currentSpeed)
+        
+        self.targetAngle = target
+        #print("CustomServo-setAngle: Setting %s's targetAngle to %s" % (self.name,target))
+        self.setProfile(profile)
+        return self.update(currentUptime)
+    
+    
+    def resolveTarget(self, target):
+        """
+        Returns:
+            The servo angle for a target, after adjustment, limits and inversion
         """
         target = target + self.adjustment
         target = min(target, self.maxAngle)
@@ -79,85 +165,107 @@ class Servo:
         
         if (self.invert):
             target = self.dom - target
-        
-        self.direction = self.getDirection(self.currentAngle, target)
-        self.targetAngle = target
-        #print("CustomServo-setAngle: Setting %s's targetAngle to %s" % (self.name,target))
+        return target
+    
+    
+    def setProfile(self, profile):
+        """
+        Replaces the current move with a planned MotionProfile (in servo angles, after adjustment and inversion).
+        """
+        self.profile = profile
+        self.arrivalTime = profile.endTime
         self.atPos = False
-        return self.update()
+        if (self.bank is not None):
+            self.bank.loadProfile(self.bankIndex, profile)
+        if (self.wakeEvent is not None):
+            self.wakeEvent.set()
+    
     
     def rest(self):
         self.setAngle(self.restAngle)
     
     
     def adjust(self, val):
-        self.setAngle(self.targetAngle + val)
+        self.setAngle(self.fromServoAngle(self.targetAngle) + val)
     
     
-    def update(self):
-        self.atPos = False
+    def update(self, currentUptime = None):
+        """
+        Moves the servo to where its planned move says it should be.
         
-        currentUptime = timer()
-    
-        timeElapsed = currentUptime - self.timeAtLastUpdate
-        self.timeAtLastUpdate = currentUptime
+        Parameters:
+            currentUptime (float): Time of the step, defaults to the current timer() value.
+        Returns:
+            True : The servo is at its target angle
+            False : The servo is still moving
+        """
+        if (currentUptime is None):
+            currentUptime = timer()
         
-        targetAngle = self.targetAngle
+        if (self.atPos):
+            return True
+        
+        angle, self.currentSpeed = self.profile.sample(currentUptime)
+        angle = min(angle, self.maxAngle)
+        angle = max(angle, self.minAngle)
+        self.currentAngle = angle
         
-        if (self.currentAngle == targetAngle or abs(self.currentAngle - targetAngle) < 1):
+        if (currentUptime >= self.arrivalTime):
             self.currentSpeed = 0
-            
             self.atPos = True
-            return True
-        
-        else:
         
-            distanceToTarget = abs(targetAngle - self.currentAngle)
-            
-            decelerationDistance = ( self.prevSpeed ** 2 ) / ( 2 * self.acceleration )
-            
-            decel = False
-            
-            if (distanceToTarget > decelerationDistance):
-            
-                self.currentSpeed += self.acceleration * timeElapsed * self.direction  #Increase speed
-                
-            else:
-                
-                self.currentSpeed -= self.acceleration * timeElapsed * self.direction
-                
-                decel = True
-            
-            if (abs(self.currentSpeed) > self.maxSpeed):
-                self.currentSpeed = self.maxSpeed * (self.currentSpeed / abs(self.currentSpeed))
-            
-            self.currentJump = self.currentSpeed * timeElapsed
-            
-            if (abs(self.currentJump) >= abs(self.currentAngle - targetAngle) ): # Check if the next planned move will take us past the target angle
-            
-                self.currentAngle = targetAngle
-                
-                self.currentSpeed = 0
-            
-            else:
-                
-                self.currentAngle += self.currentJump
-                
-                self.currentAngle = min(self.currentAngle, self.maxAngle)
-                self.currentAngle = max(self.currentAngle, self.minAngle)
-                
-
         #print("CustomServo-update: Moving %s to %s" % (self.name, self.currentAngle))
-        self.servo.angle = self.currentAngle # Move servo to currentAngle
-        self.prevSpeed = self.currentSpeed
-           
-            
+        self.servo.angle = angle # Move servo to currentAngle
+        
         return self.atPos
+    
+    
+    def angleQuantum(self, frequency = 50):
+        """
+        Returns:
+            The smallest change of angle the PCA9685 can output, one of its 4096 steps per PWM period (degrees)
+        """
+        return self.dom * 1000000 / (frequency * 4096) / (self.maxPulse - self.minPulse)
+    
+    
+    def timeToArrival(self, currentUptime = None):
+        """
+        Returns:
+            Seconds until the servo reaches its target angle, 0 if it's already there
+        """
+        if (currentUptime is None):
+            currentUptime = timer()
+        return max(0, self.arrivalTime - currentUptime)
         
         
     def setAdjustment(self, angle):
+        target = self.fromServoAngle(self.targetAngle)
         self.adjustment = angle
-        self.setAngle(self.targetAngle)
+        self.setAngle(target)
+        
+    def fromServoAngle(self, angle):
+        """
+        Returns:
+            The angle setAngle() takes for a servo angle, undoing inversion and adjustment
+        """
+        if (self.invert):
+            angle = self.dom - angle
+        return angle - self.adjustment
+        
+    def angleAt(self, currentUptime):
+        """
+        Returns:
+            The angle (before adjustment and inversion, as given to setAngle) the servo was at, or will be at,
+            at the given time during its current move
+        """
+        return self.fromServoAngle(self.profile.sample(max(currentUptime, self.profile.startTime))[0])
+        
+    def getCalibration(self):
+        """
+        Returns:
+            The servo's current settings, as Calibration.CalibrationProfile.setServo() takes them
+        """
+        return {field: getattr(self, field) for field in self.CALIBRATION_FIELDS}
         
     def getCurrentAngle(self):
         if (self.invert):
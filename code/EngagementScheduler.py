@@ -0,0 +1,93 @@
+from Hardware import timer
+from MotionProfile import trapezoidTime
+import itertools
+
+class EngagementScheduler:
+    """
+    Orders targets so the turret spends as little time as possible slewing between them.
+
+    Slew times come from the servos' own speed and acceleration limits, the slowest axis deciding each move,
+    and targets are taken at their predicted position when the turret would reach them.
+    """
+
+    def __init__(self, maxSpeeds, accelerations, dwell = 0.5, exhaustiveLimit = 6):
+        """
+        Parameters:
+            maxSpeeds (list): [yaw, pitch] speed limits (degrees per second).
+            accelerations (list): [yaw, pitch] acceleration limits (degrees per second per second).
+            dwell (float): Time spent on each target (seconds).
+            exhaustiveLimit (int): Up to this many targets every order is tried, above it the nearest target is taken next.
+        """
+        self.maxSpeeds = maxSpeeds
+        self.accelerations = accelerations
+        self.dwell = dwell
+        self.exhaustiveLimit = exhaustiveLimit
+
+
+    @classmethod
+    def fromServos(cls, yawServo, pitchServo, **settings):
+        return cls([yawServo.maxSpeed, pitchServo.maxSpeed], [yawServo.acceleration, pitchServo.acceleration], **settings)
+
+
+    def slewTime(self, start, end):
+        """
+        Returns:
+            Time to move between two [yaw, pitch] positions
+        """
+        return max(trapezoidTime(b - a, maxSpeed, acceleration)
+            for a, b, maxSpeed, acceleration in zip(start, end, self.maxSpeeds, self.accelerations))
+
+
+    def planTime(self, startAngles, tracks, currentUptime):
+        """
+        Returns:
+            Time to visit the tracks in the given order
+        """
+        elapsed = 0
+        position = startAngles
+        for track in tracks:
+            # Aim where the target will be, aiming for it changes how long the slew takes only slightly
+            target = track.tracker.predict(currentUptime + elapsed)
+            elapsed += self.slewTime(position, target)
+            target = track.tracker.predict(currentUptime + elapsed)
+            elapsed += self.dwell
+            position = target
+        return elapsed
+
+
+    def order(self, startAngles, tracks, currentUptime = None):
+        """
+        Parameters:
+            startAngles (list): Current [yaw, pitch] of the turret.
+            tracks (list of TargetTracker.Track): Targets to engage.
+            currentUptime (float): Time the plan starts, defaults to now.
+        Returns:
+            (tracks in engagement order, total time)
+        """
+        if currentUptime is None:
+            currentUptime = timer()
+        tracks = [track for track in tracks if track.tracker.active()]
+        if not tracks:
+            return [], 0
+
+        if len(tracks) <= self.exhaustiveLimit:
+            best = None
+            bestTime = None
+            for plan in itertools.permutations(tracks):
+                planTime = self.planTime(startAngles, plan, currentUptime)
+                if bestTime is None or planTime < bestTime:
+                    best, bestTime = list(plan), planTime
+            return best, bestTime
+
+        # Too many to try every order, take the quickest to reach each time
+        plan = []
+        remaining = list(tracks)
+        position = startAngles
+        elapsed = 0
+        while remaining:
+            nearest = min(remaining, key=lambda track: self.slewTime(position, track.tracker.predict(currentUptime + elapsed)))
+            elapsed += self.slewTime(position, nearest.tracker.predict(currentUptime + elapsed)) + self.dwell
+            position = nearest.tracker.predict(currentUptime + elapsed)
+            remaining.remove(nearest)
+            plan.append(nearest)
+        return plan, self.planTime(startAngles, plan, currentUptime)
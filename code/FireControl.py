@@ -0,0 +1,203 @@
+from Hardware import timer
+import heapq
+import itertools
+import threading
+
+class FireControl:
+    """
+    State machine for the blaster: flywheels (the prime servo) and trigger.
+
+    SAFE -> SPINNING_UP -> READY -> TRIGGER_PULLED -> RECOVERING -> READY ...
+
+    Every timed transition is put on a heap of deadlines when it's scheduled, and advance() only runs the ones
+    that are due, so nothing is checked between events and the control loop can sleep until nextEvent().
+    Shots are asked for in bursts, a burst queued before the flywheels are up to speed fires once they are.
+    All the methods can be called from any thread.
+    """
+
+    SAFE = "safe"
+    SPINNING_UP = "spinning_up"
+    READY = "ready"
+    TRIGGER_PULLED = "trigger_pulled"
+    RECOVERING = "recovering"
+
+    def __init__(self, primeServo, triggerServo, primeActiveAngle = 50, triggerPullAngle = 55, spinupTime = 2, triggerDepressionDelay = 0.5):
+        """
+        Parameters:
+            primeServo (Servo): Holds the rev switch, which spins the flywheels, at primeActiveAngle.
+            triggerServo (Servo): Pulls the trigger at triggerPullAngle.
+            spinupTime (float): Time for the flywheels to reach full speed (seconds).
+            triggerDepressionDelay (float): Time the trigger is held, and then left released before the next pull (seconds).
+        """
+        self.primeServo = primeServo
+        self.triggerServo = triggerServo
+        self.primeActiveAngle = primeActiveAngle
+        self.triggerPullAngle = triggerPullAngle
+        self.spinupTime = spinupTime
+        self.triggerDepressionDelay = triggerDepressionDelay
+        self.wakeEvent = None # Optional threading.Event, set whenever a new deadline is scheduled
+
+        self.lock = threading.RLock()
+        self.deadlines = [] # Heap of (time, sequence, transition)
+        self.sequence = itertools.count()
+        self.state = self.SAFE
+        self.pendingShots = 0
+        self.cadence = self.minCadence()
+        self.lastPull = None
+
+        # Statistics
+        self.shots = 0
+        self.firstShot = None
+        self.bursts = 0
+        self.burstShots = 0
+        self.burstStart = None
+        self.intervals = 0 # Total time between shots within bursts
+        self.intervalCount = 0
+        self.lastBurstRate = None
+
+    def minCadence(self):
+        # The trigger has to be held, then left released, between shots
+        return 2 * self.triggerDepressionDelay
+
+    def schedule(self, delay, transition, currentTime):
+        heapq.heappush(self.deadlines, (currentTime + delay, next(self.sequence), transition))
+        if self.wakeEvent is not None:
+            self.wakeEvent.set()
+
+    def advance(self, currentTime = None):
+        """
+        Runs the transitions that are due, the control loop calls this every tick.
+        """
+        if currentTime is None:
+            currentTime = timer()
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= currentTime:
+                _, _, transition = heapq.heappop(self.deadlines)
+                transition(currentTime)
+
+    def nextEvent(self, currentTime = None):
+        """
+        Returns:
+            Seconds until the next transition is due, None if nothing is scheduled
+        """
+        if currentTime is None:
+            currentTime = timer()
+        with self.lock:
+            if not self.deadlines:
+                return None
+            return max(0, self.deadlines[0][0] - currentTime)
+
+    def primed(self):
+        return self.state != self.SAFE
+
+    def ready(self):
+        return self.state == self.READY
+
+    def prime(self, currentTime = None):
+        """
+        Starts the flywheels, does nothing if they're already running.
+        """
+        if currentTime is None:
+            currentTime = timer()
+        with self.lock:
+            if self.state != self.SAFE:
+                return
+            self.primeServo.setAngle(self.primeActiveAngle)
+            self.state = self.SPINNING_UP
+            self.schedule(self.spinupTime, self.spunUp, currentTime)
+
+    def unprime(self):
+        """
+        Stops the flywheels and releases the trigger, dropping any shots still queued.
+        """
+        with self.lock:
+            self.deadlines = []
+            self.pendingShots = 0
+            self.state = self.SAFE
+            self.triggerServo.rest()
+            self.primeServo.rest()
+            self.endBurst()
+
+    def fire(self, shots = 1, cadence = None, currentTime = None):
+        """
+        Asks for a burst, priming first if needed.
+
+        Parameters:
+            shots (int): Number of darts.
+            cadence (float): Time between trigger pulls (seconds), defaults to the quickest the trigger allows.
+        Returns:
+            False if a burst was already under way, it isn't added to
+        """
+        if currentTime is None:
+            currentTime = timer()
+        with self.lock:
+            if self.pendingShots > 0 or self.state == self.TRIGGER_PULLED:
+                return False
+            self.prime(currentTime)
+            self.pendingShots = shots
+            self.cadence = self.minCadence() if cadence is None else max(cadence, self.minCadence())
+            self.endBurst()
+            self.bursts += 1
+            self.burstShots = 0
+            self.burstStart = None
+            if self.state == self.READY:
+                self.pull(currentTime)
+            return True
+
+    # Transitions, run with the lock held
+
+    def spunUp(self, currentTime):
+        self.state = self.READY
+        if self.pendingShots > 0:
+            self.pull(currentTime)
+
+    def pull(self, currentTime):
+        self.triggerServo.setAngle(self.triggerPullAngle)
+        self.state = self.TRIGGER_PULLED
+        self.pendingShots -= 1
+        self.shots += 1
+        if self.firstShot is None:
+            self.firstShot = currentTime
+        self.burstShots += 1
+        if self.burstStart is None:
+            self.burstStart = currentTime
+        elif self.lastPull is not None:
+            self.intervals += currentTime - self.lastPull
+            self.intervalCount += 1
+        self.lastPull = currentTime
+        self.schedule(self.triggerDepressionDelay, self.release, currentTime)
+
+    def release(self, currentTime):
+        self.triggerServo.rest()
+        self.state = self.RECOVERING
+        nextPull = max(currentTime + self.triggerDepressionDelay, self.lastPull + self.cadence)
+        self.schedule(nextPull - currentTime, self.recovered, currentTime)
+
+    def recovered(self, currentTime):
+        self.state = self.READY
+        if self.pendingShots > 0:
+            self.pull(currentTime)
+        else:
+            self.endBurst()
+
+    def endBurst(self):
+        if self.burstStart is not None and self.burstShots > 1:
+            self.lastBurstRate = (self.burstShots - 1) / (self.lastPull - self.burstStart)
+        self.burstStart = None
+
+    def getStats(self):
+        """
+        Returns:
+            Shot count, bursts asked for, and achieved fire rates (shots per second): overall, within the last burst
+            and within every burst
+        """
+        with self.lock:
+            return {
+                "state": self.state,
+                "shots": self.shots,
+                "bursts": self.bursts,
+                "pending_shots": self.pendingShots,
+                "fire_rate": (self.shots - 1) / (self.lastPull - self.firstShot) if self.shots > 1 and self.lastPull > self.firstShot else None,
+                "last_burst_rate": self.lastBurstRate,
+                "burst_fire_rate": self.intervalCount / self.intervals if self.intervals > 0 else None,
+            }
@@ -0,0 +1,383 @@
+"""
+Flight recorder for field sessions.
+
+Raw Person Sensor frames, VL53L0X readings and the servo targets and positions of every control tick are
+appended to a log of fixed-size binary records. Records are packed into a preallocated buffer, and full buffers
+are written out by a background thread, so recording costs the loop a struct pack and nothing else.
+
+FlightLog memory-maps a log for analysis, and replays it through the tracking code as fast as it can:
+
+    python FlightRecorder.py session.bin
+
+Record one with TurretRuntime.py --record session.bin, or attach a FlightRecorder to the handlers yourself.
+"""
+
+from Hardware import timer
+from PersonSensor import PersonSensorDecoder, SensorLens
+from TargetTracker import MultiTargetTracker
+import math
+import mmap
+import numpy as np
+import struct
+import sys
+import threading
+import queue
+
+MAGIC = b"TRTLOG02" # 02: tick angles are the ones setAngle takes, 01 held raw servo angles
+FILE_HEADER = struct.Struct("<8sHHd12x") # Magic, record size, payload size, time recording started
+RECORD_HEADER = struct.Struct("<BBHId") # Type, item count (bytes for a frame, servos for a tick), reserved, sequence number, timestamp
+PAYLOAD_SIZE = 48
+RECORD_SIZE = RECORD_HEADER.size + PAYLOAD_SIZE
+
+# Record types
+FRAME = 1 # Raw Person Sensor result frame
+RANGE = 2 # Raw VL53L0X range (mm), -1 when the read failed
+TICK = 3 # Target then current angle of each servo as setAngle takes them (inversion and adjustment undone), float32
+
+MAX_SERVOS = PAYLOAD_SIZE // 8
+
+RECORD_DTYPE = np.dtype([
+    ("type", "u1"),
+    ("count", "u1"),
+    ("reserved", "<u2"),
+    ("seq", "<u4"),
+    ("timestamp", "<f8"),
+    ("payload", "u1", (PAYLOAD_SIZE,)),
+])
+
+
+class FlightRecorder:
+    """
+    Appends records to a log file without blocking the threads that record them.
+
+    When every buffer is waiting to be written (the disk has stalled for a whole buffer's worth of records)
+    new records are dropped and counted, rather than holding up the control loop.
+    """
+
+    FRAME_FORMAT = struct.Struct("<BBHId%ds" % PAYLOAD_SIZE)
+    RANGE_FORMAT = struct.Struct("<BBHIdi")
+    TICK_FORMATS = [struct.Struct("<BBHId%df" % (2 * count)) for count in range(MAX_SERVOS + 1)]
+
+    def __init__(self, path, bufferRecords = 4096, buffers = 3):
+        """
+        Parameters:
+            path (str): Log file, overwritten.
+            bufferRecords (int): Records held in each buffer before it's handed to the writer thread.
+            buffers (int): Number of preallocated buffers.
+        """
+        self.path = path
+        self.capacity = bufferRecords
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, RECORD_SIZE, PAYLOAD_SIZE, timer()))
+
+        self.lock = threading.Lock()
+        self.free = queue.Queue()
+        for _ in range(buffers - 1):
+            self.free.put(bytearray(bufferRecords * RECORD_SIZE))
+        self.buffer = bytearray(bufferRecords * RECORD_SIZE)
+        self.count = 0 # Records in the current buffer
+        self.sequence = 0
+        self.full = queue.Queue()
+        self.writer = threading.Thread(target=self.writeLoop, args=(), daemon=True)
+        self.writer.start()
+        self.closed = False
+
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+
+    def attach(self, servoHandler = None, personSensor = None, ranger = None):
+        """
+        Starts recording what the given handlers do.
+
+        Parameters:
+            servoHandler (ServoHandler): Records every control tick.
+            personSensor (PersonSensor): Records every frame read from the sensor.
+            ranger (RangeSampler): Records every range reading.
+        """
+        for component in (servoHandler, personSensor, ranger):
+            if component is not None:
+                component.recorder = self
+
+    def detach(self, *components):
+        for component in components:
+            if component is not None and getattr(component, "recorder", None) is self:
+                component.recorder = None
+
+    def reserve(self):
+        """
+        Returns:
+            (buffer, offset, sequence number) to pack the next record at, None if it has to be dropped. Call with the lock held.
+        """
+        if self.closed:
+            return None
+        if self.count == self.capacity:
+            try:
+                replacement = self.free.get_nowait()
+            except queue.Empty:
+                self.dropped += 1
+                return None
+            self.full.put((self.buffer, self.count))
+            self.buffer = replacement
+            self.count = 0
+        offset = self.count * RECORD_SIZE
+        self.count += 1
+        self.sequence += 1
+        self.recorded += 1
+        return self.buffer, offset, self.sequence & 0xFFFFFFFF
+
+    def frame(self, data, timestamp = None):
+        """
+        Records a raw Person Sensor frame.
+        """
+        if timestamp is None:
+            timestamp = timer()
+        with self.lock:
+            slot = self.reserve()
+            if slot is not None:
+                self.FRAME_FORMAT.pack_into(slot[0], slot[1], FRAME, len(data), 0, slot[2], timestamp, bytes(data))
+
+    def range(self, distance, timestamp = None):
+        """
+        Records a raw range reading (mm), None for a failed read.
+        """
+        if timestamp is None:
+            timestamp = timer()
+        with self.lock:
+            slot = self.reserve()
+            if slot is not None:
+                self.RANGE_FORMAT.pack_into(slot[0], slot[1], RANGE, 0, 0, slot[2], timestamp, -1 if distance is None else int(distance))
+
+    def tick(self, bank, timestamp = None):
+        """
+        Records the target and current angle of every servo in a ServoBank, in the angles setAngle() and
+        setCamera() take, so a replay can add face offsets to them like the runtime does.
+        """
+        if timestamp is None:
+            timestamp = timer()
+        count = min(len(bank.servos), MAX_SERVOS)
+        # The bank holds servo angles, undo each servo's inversion and adjustment (see Servo.fromServoAngle)
+        invert = bank.invert[:count]
+        dom = bank.dom[:count]
+        adjustment = np.array([servo.adjustment for servo in bank.servos[:count]])
+        targets = np.where(invert, dom - bank.targetAngle[:count], bank.targetAngle[:count]) - adjustment
+        currents = np.where(invert, dom - bank.currentAngle[:count], bank.currentAngle[:count]) - adjustment
+        values = targets.tolist() + currents.tolist()
+        with self.lock:
+            slot = self.reserve()
+            if slot is not None:
+                self.TICK_FORMATS[count].pack_into(slot[0], slot[1], TICK, count, 0, slot[2], timestamp, *values)
+
+    def writeLoop(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                self.full.task_done()
+                return
+            buffer, count = item
+            self.file.write(memoryview(buffer)[:count * RECORD_SIZE])
+            self.written += count
+            self.free.put(buffer)
+            self.full.task_done()
+
+    def flush(self):
+        """
+        Hands the records buffered so far to the writer, and waits for everything to be written.
+        Not for the control loop, it can wait for a free buffer.
+        """
+        with self.lock:
+            if self.count > 0:
+                self.full.put((self.buffer, self.count))
+                self.buffer = self.free.get()
+                self.count = 0
+        self.full.join()
+        self.file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        with self.lock:
+            self.closed = True
+        self.full.put(None)
+        self.writer.join()
+        self.file.close()
+
+    def getStats(self):
+        return {
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+class FlightLog:
+    """
+    A recorded log, memory-mapped so even a long session opens instantly and is read without copying.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, recordSize, payloadSize, self.startTime = FILE_HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or recordSize != RECORD_SIZE:
+            raise ValueError("%s isn't a flight recorder log" % path)
+        count = (len(self.map) - FILE_HEADER.size) // RECORD_SIZE
+        self.records = np.frombuffer(self.map, dtype=RECORD_DTYPE, count=count, offset=FILE_HEADER.size)
+
+    def __len__(self):
+        return len(self.records)
+
+    def close(self):
+        del self.records
+        self.map.close()
+        self.file.close()
+
+    def select(self, recordType):
+        return self.records[self.records["type"] == recordType]
+
+    def frames(self):
+        """
+        Returns:
+            (timestamps, frames) with one raw frame per row of the uint8 array
+        """
+        records = self.select(FRAME)
+        return records["timestamp"], records["payload"][:, :PersonSensorDecoder.RESULT.size]
+
+    def ranges(self):
+        """
+        Returns:
+            (timestamps, ranges in mm) arrays, -1 for failed reads
+        """
+        records = self.select(RANGE)
+        return records["timestamp"], np.ascontiguousarray(records["payload"][:, :4]).view("<i4")[:, 0]
+
+    def ticks(self):
+        """
+        Returns:
+            (timestamps, target angles, current angles), one row per tick and one column per servo
+        """
+        records = self.select(TICK)
+        if len(records) == 0:
+            return records["timestamp"], np.zeros((0, 0)), np.zeros((0, 0))
+        count = int(records["count"].max())
+        values = np.ascontiguousarray(records["payload"][:, :8 * count]).view("<f4")
+        return records["timestamp"], values[:, :count], values[:, count:2 * count]
+
+    def replay(self, onFrame = None, onRange = None, onTick = None, speed = None):
+        """
+        Calls back with every record in time order.
+
+        Parameters:
+            onFrame (function): Called with (timestamp, raw frame bytes).
+            onRange (function): Called with (timestamp, range in mm or None).
+            onTick (function): Called with (timestamp, target angles, current angles).
+            speed (float): Replay speed relative to real time, None goes as fast as possible.
+        """
+        order = np.argsort(self.records["timestamp"], kind="stable")
+        frameSize = PersonSensorDecoder.RESULT.size
+        started = timer()
+        first = None
+        for index in order:
+            record = self.records[index]
+            timestamp = float(record["timestamp"])
+            if speed is not None:
+                if first is None:
+                    first = timestamp
+                delay = (timestamp - first) / speed - (timer() - started)
+                if delay > 0:
+                    threading.Event().wait(delay)
+            recordType = record["type"]
+            if recordType == FRAME and onFrame is not None:
+                onFrame(timestamp, record["payload"][:frameSize].tobytes())
+            elif recordType == RANGE and onRange is not None:
+                distance = int(record["payload"][:4].view("<i4")[0])
+                onRange(timestamp, None if distance < 0 else distance)
+            elif recordType == TICK and onTick is not None:
+                count = int(record["count"])
+                values = record["payload"][:8 * count].view("<f4")
+                onTick(timestamp, values[:count], values[count:])
+
+
+def replayTracking(log, cameraServos = (4, 5), latency = 0.1, confidence = 90, lens = None):
+    """
+    Runs a log's frames through the decoder and a MultiTargetTracker, with the camera angles recorded at each
+    frame's capture time, and measures how well the tracks predicted each new measurement.
+
+    Parameters:
+        cameraServos (tuple): Bank indices of the camera yaw and pitch servos, 4 and 5 in ServoHandler.
+    Returns:
+        Dictionary of counts and the rms prediction error (degrees)
+    """
+    decoder = PersonSensorDecoder()
+    lens = SensorLens() if lens is None else lens
+    tracks = MultiTargetTracker(latency=latency)
+    tickTimes, _, positions = log.ticks()
+    errors = []
+    counts = {"frames": 0, "accepted": 0, "faces": 0}
+
+    def cameraAt(t):
+        if len(tickTimes) == 0:
+            return [90, 90]
+        return [float(np.interp(t, tickTimes, positions[:, axis])) for axis in cameraServos]
+
+    def onFrame(timestamp, data):
+        counts["frames"] += 1
+        decoder.buffer[:] = data
+        if decoder.check() != decoder.ACCEPTED:
+            return
+        counts["accepted"] += 1
+        faces = [face for face in decoder.decode() if face.box_confidence >= confidence]
+        counts["faces"] += len(faces)
+        camera = cameraAt(timestamp - latency)
+        def toAngles(face):
+            offset = lens.angles((face.box_left + face.box_right) / 2, (face.box_top + face.box_bottom) / 2)
+            return [camera[0] + offset[0], camera[1] + offset[1]]
+        for face in faces:
+            angles = toAngles(face)
+            # Error of the nearest track's prediction, if one was following this face
+            distances = [math.hypot(predicted[0] - angles[0], predicted[1] - angles[1])
+                for predicted in (track.tracker.predict(timestamp - latency) for track in tracks.tracks) if predicted is not None]
+            if distances and min(distances) <= tracks.maxAngle:
+                errors.append(min(distances))
+        tracks.update(faces, toAngles, timestamp)
+
+    started = timer()
+    log.replay(onFrame=onFrame)
+    elapsed = timer() - started
+
+    counts["tracks"] = tracks.nextTrackId - 1
+    counts["prediction_rms"] = math.sqrt(sum(error * error for error in errors) / len(errors)) if errors else None
+    counts["replay_seconds"] = elapsed
+    if len(log):
+        counts["session_seconds"] = float(log.records["timestamp"].max() - log.records["timestamp"].min())
+    return counts
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python FlightRecorder.py session.bin")
+        return
+    log = FlightLog(sys.argv[1])
+    frameTimes, _ = log.frames()
+    rangeTimes, ranges = log.ranges()
+    tickTimes, _, _ = log.ticks()
+    print("%d records: %d frames, %d ranges, %d ticks" % (len(log), len(frameTimes), len(ranges), len(tickTimes)))
+    valid = ranges[ranges >= 0]
+    if len(valid):
+        print("Range %dmm to %dmm, %d failed reads" % (valid.min(), valid.max(), len(ranges) - len(valid)))
+    if len(tickTimes) > 1:
+        gaps = np.diff(tickTimes)
+        print("Tick interval mean %.2fms, max %.2fms" % (gaps.mean() * 1000, gaps.max() * 1000))
+
+    result = replayTracking(log)
+    print("Tracking replay: %s" % result)
+    if result.get("session_seconds"):
+        print("Replayed %.1fs of session in %.3fs (%.0fx real time)" % (result["session_seconds"], result["replay_seconds"],
+            result["session_seconds"] / max(1e-9, result["replay_seconds"])))
+    log.close()
+
+
+if __name__ == '__main__':
+    main()
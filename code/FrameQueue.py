@@ -0,0 +1,135 @@
+from Hardware import timer
+from collections import namedtuple
+import threading
+
+# One published sensor reading
+SensorFrame = namedtuple("SensorFrame", ["seq", "timestamp", "data"])
+
+
+class FrameQueue:
+    """
+    Bounded ring buffer of timestamped, sequence-numbered frames.
+
+    A producer thread put()s frames in, consumers block on next() for the frame after the last one they saw,
+    so no frame is read twice and a consumer only misses frames if it falls a whole buffer behind.
+    """
+
+    def __init__(self, size = 16):
+        """
+        Parameters:
+            size (int): Number of frames kept.
+        """
+        self.size = size
+        self.frames = [None] * size
+        self.seq = 0 # Sequence number of the newest frame, the first frame is 1
+        self.condition = threading.Condition()
+        self.listeners = []
+
+        self.published = 0
+        self.dropped = 0 # Frames no consumer read, overwritten in the buffer or skipped over by latest()
+        self.lastTaken = 0
+
+
+    def put(self, data, timestamp = None):
+        """
+        Publishes a frame and wakes anything waiting for one.
+
+        Returns:
+            The SensorFrame that was stored
+        """
+        if timestamp is None:
+            timestamp = timer()
+
+        with self.condition:
+            self.seq += 1
+            index = self.seq % self.size
+            evicted = self.frames[index]
+            if evicted is not None and evicted.seq > self.lastTaken:
+                self.dropped += 1
+            frame = SensorFrame(self.seq, timestamp, data)
+            self.frames[index] = frame
+            self.published += 1
+            self.condition.notify_all()
+
+        for listener in self.listeners:
+            listener(frame)
+        return frame
+
+
+    def addListener(self, callback):
+        """
+        Calls callback(frame) from the producer thread whenever a frame is published.
+        """
+        self.listeners.append(callback)
+
+
+    def latest(self, afterSeq = None):
+        """
+        Returns the newest frame without waiting, any unread frames before it count as dropped.
+
+        Parameters:
+            afterSeq (int): Sequence number of the last frame the caller has seen, older frames aren't returned.
+        Returns:
+            The newest frame, None if there isn't one (newer than afterSeq)
+        """
+        with self.condition:
+            frame = self.frames[self.seq % self.size]
+            if frame is None or (afterSeq is not None and frame.seq <= afterSeq):
+                return None
+            # Frames between the last one taken and this one are never going to be read, the ones already
+            # overwritten were counted by put()
+            self.dropped += max(0, frame.seq - max(self.lastTaken, self.seq - self.size) - 1)
+            self.lastTaken = max(self.lastTaken, frame.seq)
+            return frame
+
+
+    def next(self, afterSeq = None, timeout = None):
+        """
+        Waits for the frame after afterSeq.
+
+        Parameters:
+            afterSeq (int): Sequence number of the last frame the caller has seen, defaults to the last frame taken by anyone.
+            timeout (float): Longest time to wait (seconds), None waits forever.
+        Returns:
+            The oldest frame newer than afterSeq still in the buffer, None if the timeout expired
+        """
+        with self.condition:
+            if afterSeq is None:
+                afterSeq = self.lastTaken
+            if not self.condition.wait_for(lambda: self.seq > afterSeq, timeout):
+                return None
+
+            # If the caller fell a whole buffer behind, start at the oldest frame still held
+            seq = max(afterSeq + 1, self.seq - self.size + 1)
+            frame = self.frames[seq % self.size]
+            self.lastTaken = max(self.lastTaken, frame.seq)
+            return frame
+
+
+    def bracket(self, timestamp):
+        """
+        Finds the frames either side of a time, without taking them.
+
+        Returns:
+            (newest frame at or before the time, oldest frame after it), either is None past the ends of the buffer
+        """
+        with self.condition:
+            low = max(1, self.seq - self.size + 1)
+            high = self.seq + 1
+            # Binary search over the sequence numbers still held, frames are put in time order
+            while low < high:
+                middle = (low + high) // 2
+                if self.frames[middle % self.size].timestamp <= timestamp:
+                    low = middle + 1
+                else:
+                    high = middle
+            before = self.frames[(low - 1) % self.size] if low - 1 >= max(1, self.seq - self.size + 1) else None
+            after = self.frames[low % self.size] if low <= self.seq else None
+            return before, after
+
+
+    def getStats(self):
+        return {
+            "published": self.published,
+            "dropped": self.dropped,
+        }
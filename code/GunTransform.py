@@ -0,0 +1,100 @@
+from functools import lru_cache
+import numpy as np
+
+class GunTransform:
+    """
+    Converts where the camera gimbal is looking, plus the LIDAR range along that line, into the gun angles
+    that point the barrel at the same spot.
+
+    The camera and LIDAR sit on their own gimbal, offset from the gun's pivot, so at short range the gun has to
+    look noticeably across and down (or up) to hit what the camera is centred on. The turret frame is x to the
+    right, y forward and z up, with the gun pivot at the origin. Angles are servo command angles, as setCamera()
+    and moveTurret() take them, with `zero` being the command angle that points level and straight ahead.
+    """
+
+    def __init__(self, cameraOffset = (0, 100, 200),
+            cameraZero = (90, 90), cameraSign = (1, 1),
+            gunZero = (135, 90), gunSign = (1, 1),
+            defaultDistance = 3000,
+            angleQuantum = 0.05, distanceQuantum = 5, cacheSize = 4096):
+        """
+        Parameters:
+            cameraOffset (tuple): Position of the camera gimbal's pivot from the gun's pivot, [right, forward, up] (mm).
+            cameraZero (tuple): Camera [yaw, pitch] command angles that look straight ahead and level.
+            cameraSign (tuple): +1 if increasing the camera [yaw, pitch] turns right / up, -1 if left / down.
+            gunZero (tuple): Gun [yaw, pitch] command angles that point straight ahead and level.
+            gunSign (tuple): As cameraSign, for the gun.
+            defaultDistance (float): Range used when the LIDAR has no reading (mm).
+            angleQuantum (float): Angles are rounded to this before the memoised lookup (degrees).
+            distanceQuantum (float): Ranges are rounded to this before the memoised lookup (mm).
+            cacheSize (int): Most conversions remembered.
+        """
+        self.cameraOffset = np.asarray(cameraOffset, dtype=np.float64)
+        self.cameraZero = cameraZero
+        self.cameraSign = cameraSign
+        self.gunZero = gunZero
+        self.gunSign = gunSign
+        self.defaultDistance = defaultDistance
+        self.angleQuantum = angleQuantum
+        self.distanceQuantum = distanceQuantum
+        self._cached = lru_cache(maxsize=cacheSize)(self._quantised)
+
+
+    def transform(self, yaws, pitches, distances):
+        """
+        Converts a batch of camera directions at once.
+
+        Parameters:
+            yaws (array): Camera yaw command angles.
+            pitches (array): Camera pitch command angles.
+            distances (array): Range along each direction (mm), NaN uses defaultDistance.
+        Returns:
+            (gun yaws, gun pitches, ranges from the gun pivot in mm) arrays
+        """
+        yaws = np.asarray(yaws, dtype=np.float64)
+        pitches = np.asarray(pitches, dtype=np.float64)
+        distances = np.asarray(distances, dtype=np.float64)
+        distances = np.where(np.isnan(distances), self.defaultDistance, distances)
+
+        azimuth = np.radians((yaws - self.cameraZero[0]) * self.cameraSign[0])
+        elevation = np.radians((pitches - self.cameraZero[1]) * self.cameraSign[1])
+
+        # Target position from the gun pivot
+        flat = distances * np.cos(elevation)
+        x = self.cameraOffset[0] + flat * np.sin(azimuth)
+        y = self.cameraOffset[1] + flat * np.cos(azimuth)
+        z = self.cameraOffset[2] + distances * np.sin(elevation)
+
+        gunYaws = self.gunZero[0] + self.gunSign[0] * np.degrees(np.arctan2(x, y))
+        gunPitches = self.gunZero[1] + self.gunSign[1] * np.degrees(np.arctan2(z, np.hypot(x, y)))
+        return gunYaws, gunPitches, np.sqrt(x * x + y * y + z * z)
+
+
+    def _quantised(self, yawStep, pitchStep, distanceStep):
+        gunYaw, gunPitch, gunRange = self.transform(yawStep * self.angleQuantum, pitchStep * self.angleQuantum, distanceStep * self.distanceQuantum)
+        return (float(gunYaw), float(gunPitch), float(gunRange))
+
+
+    def gunAngles(self, cameraAngles, distance = None):
+        """
+        Converts one camera direction, remembering recent conversions so repeats at control-loop rate are a lookup.
+
+        Parameters:
+            cameraAngles (list): Camera [yaw, pitch] command angles.
+            distance (float): LIDAR range (mm), None uses defaultDistance.
+        Returns:
+            (gun yaw, gun pitch, range from the gun pivot in mm)
+        """
+        if distance is None:
+            distance = self.defaultDistance
+        return self._cached(round(cameraAngles[0] / self.angleQuantum), round(cameraAngles[1] / self.angleQuantum),
+            round(distance / self.distanceQuantum))
+
+
+    def getStats(self):
+        info = self._cached.cache_info()
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+        }
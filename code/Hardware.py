@@ -0,0 +1,177 @@
+"""
+Hardware access for the turret.
+
+Everything that talks to a device or reads the clock goes through this module, so the same control code can
+run on the Pi or against Simulator.Simulator on any machine. The backend is chosen with useSimulator(), or by
+setting the TURRET_HARDWARE environment variable to "sim" before anything is constructed.
+"""
+
+from BusManager import BusManager, PRIORITY_SERVO, PRIORITY_SENSOR
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+import io
+import os
+import threading
+import time
+
+class RealClock:
+    """
+    Wall clock time.
+    """
+    def now(self):
+        return default_timer()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class PiBackend:
+    """
+    The real devices on the Raspberry Pi. The Adafruit libraries are only imported when a device is opened.
+    """
+
+    I2C_CHANNEL = 1 # I2C channel 1 is connected to the GPIO pins
+    I2C_PERIPHERAL = 0x703
+
+    def __init__(self):
+        self._i2c = None
+        self._i2cLock = threading.Lock() # Devices can be opened from several threads at once, see initialise()
+
+    def i2c(self, priority, name):
+        """
+        Returns:
+            The shared busio.I2C, with its locking going through the bus manager
+        """
+        with self._i2cLock:
+            if self._i2c is None:
+                import board
+                import busio
+                self._i2c = busio.I2C(board.SCL, board.SDA)
+        return bus().wrap(self._i2c, priority, name)
+
+    def servoKit(self, channels = 16):
+        from adafruit_servokit import ServoKit
+        return ServoKit(channels=channels, i2c=self.i2c(PRIORITY_SERVO, "pca9685"))
+
+    def personSensorBus(self, address):
+        import fcntl
+        handle = io.open("/dev/i2c-" + str(self.I2C_CHANNEL), "rb", buffering=0)
+        fcntl.ioctl(handle, self.I2C_PERIPHERAL, address)
+        return handle
+
+    def rangeSensor(self):
+        from LIDAR import VL53L0X
+        return VL53L0X(self.i2c(PRIORITY_SENSOR, "vl53l0x"))
+
+
+_clock = RealClock()
+_backend = None
+_bus = None
+_lock = threading.RLock() # Guards creating the backend and bus manager
+
+
+def timer():
+    """
+    Returns:
+        The current time (seconds) from the active clock
+    """
+    return _clock.now()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def backend():
+    global _backend
+    with _lock:
+        if _backend is None:
+            if os.environ.get("TURRET_HARDWARE", "pi").lower() == "sim":
+                from Simulator import Simulator
+                useSimulator(Simulator())
+            else:
+                _backend = PiBackend()
+        return _backend
+
+
+def bus():
+    """
+    Returns:
+        The BusManager every transaction on the I2C bus goes through
+    """
+    global _bus
+    with _lock:
+        if _bus is None:
+            _bus = BusManager()
+        return _bus
+
+
+def setBackend(newBackend, clock = None):
+    """
+    Replaces the hardware backend, and optionally the clock. Must be called before any devices are opened.
+    """
+    global _backend, _clock
+    _backend = newBackend
+    if clock is not None:
+        _clock = clock
+
+
+def useSimulator(simulator):
+    """
+    Runs everything against a Simulator.Simulator and its virtual clock.
+    """
+    setBackend(simulator, simulator.clock)
+
+
+def useRealHardware():
+    setBackend(PiBackend(), RealClock())
+
+
+def servoKit(channels = 16):
+    return backend().servoKit(channels)
+
+
+def personSensorBus(address):
+    """
+    Returns:
+        A file-like handle for the Person Sensor, reads with readinto() return one result frame
+    """
+    return backend().personSensorBus(address)
+
+
+def rangeSensor():
+    """
+    Returns:
+        A VL53L0X compatible range sensor
+    """
+    return backend().rangeSensor()
+
+
+def initialise(**factories):
+    """
+    Opens devices at the same time. Most of the time spent bringing a device up is importing its driver and
+    waiting on its own start up delays, which overlap, while their I2C transactions still take turns on the bus.
+
+        devices, times = Hardware.initialise(servos=ServoHandler, ranger=Hardware.rangeSensor)
+
+    Parameters:
+        factories: Functions that each open one device, by name.
+    Returns:
+        (devices, times): What each factory returned, and how long it took (seconds), by name
+    Raises:
+        The first exception a factory raised, once they've all finished
+    """
+    def timed(factory):
+        start = default_timer()
+        device = factory()
+        return device, default_timer() - start
+
+    if not factories:
+        return {}, {}
+    with ThreadPoolExecutor(max_workers=len(factories), thread_name_prefix="initialise") as pool:
+        futures = {name: pool.submit(timed, factory) for name, factory in factories.items()}
+    devices = {}
+    times = {}
+    for name, future in futures.items():
+        devices[name], times[name] = future.result()
+    return devices, times
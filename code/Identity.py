@@ -0,0 +1,199 @@
+"""
+Friend or foe, from the Person Sensor's face recognition.
+
+The sensor can be taught up to eight faces (see its developer guide), and reports the id and id_confidence of each
+face it recognises. Ids on the allow-list are friends and are never engaged, everyone else is a target. A track whose
+window holds an allow-listed id reported below the threshold is a suspect, it can be followed but not fired on.
+
+    identities = IdentityCache(friends=[0])
+    identity = identities.observe(track.trackId, track.face)
+    if identity != IdentityCache.FRIEND:
+        ...
+"""
+
+from collections import OrderedDict, deque
+from Hardware import timer
+
+
+class IdentityEntry:
+    """
+    What one key (a track, or a sensor id) has been seen as over the last few frames.
+    """
+
+    def __init__(self, window):
+        self.observations = deque(maxlen=window) # (id, id_confidence) of each frame
+        self.totals = {} # id -> sum of its confidence over the window, kept as frames come and go
+        self.counts = {} # id -> frames in the window it was reported in
+        self.identity = None
+        self.sensorId = -1
+        self.confidence = 0
+        self.expires = 0
+
+    def add(self, sensorId, confidence):
+        if len(self.observations) == self.observations.maxlen:
+            oldId, oldConfidence = self.observations[0]
+            if oldId >= 0:
+                self.counts[oldId] -= 1
+                if self.counts[oldId] == 0:
+                    del self.counts[oldId]
+                    del self.totals[oldId]
+                else:
+                    self.totals[oldId] -= oldConfidence
+        self.observations.append((sensorId, confidence))
+        if sensorId >= 0:
+            self.totals[sensorId] = self.totals.get(sensorId, 0) + confidence
+            self.counts[sensorId] = self.counts.get(sensorId, 0) + 1
+
+    def smoothed(self, sensorId):
+        """
+        Returns:
+            Mean confidence the id was reported with over the window, 0 if it wasn't
+        """
+        return self.totals[sensorId] / self.counts[sensorId] if sensorId in self.counts else 0
+
+
+class IdentityCache:
+    """
+    Friend or foe decisions, cached for each track.
+
+    Every frame adds a face's id and id_confidence to its track's sliding window, which is all the per frame work
+    there is. The decision is only made again when it expires, or straight away when the face is reported as a
+    friend and the track isn't one yet. A single sighting of an allow-listed id at the threshold makes the track a
+    friend, only the release is smoothed: it stays a friend until no such sighting is left in the window.
+    The least recently seen entries are dropped once there are more than maxEntries.
+    """
+
+    FRIEND = "friend"
+    FOE = "foe" # Recognised, but not on the allow-list
+    UNKNOWN = "unknown" # Not recognised, engaged like a foe
+    SUSPECT = "suspect" # An allow-listed id was reported, but not confidently enough, followed but never fired on
+    HOLD_FIRE = (FRIEND, SUSPECT)
+
+    def __init__(self, friends = (), threshold = 60, minSightings = 2, window = 5, ttl = 2, maxEntries = 32):
+        """
+        Parameters:
+            friends (iterable of int): Sensor ids on the allow-list.
+            threshold (float): id_confidence needed to act on an id, in any one frame for a friend, averaged over
+                the window for anyone else.
+            minSightings (int): Frames in the window an id that isn't a friend has to be reported in to act on it.
+            window (int): Frames the confidence is smoothed over.
+            ttl (float): Time a decision is reused for before it's made again (seconds).
+            maxEntries (int): Most keys remembered, the least recently seen are dropped first.
+        """
+        self.friends = set(friends)
+        self.threshold = threshold
+        self.minSightings = minSightings
+        self.window = window
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+
+        # Statistics
+        self.decisions = 0
+        self.reused = 0
+        self.evictions = 0
+
+    def enroll(self, sensorId):
+        """
+        Adds a sensor id to the allow-list, decisions about it are made again on the next frame.
+        """
+        self.friends.add(sensorId)
+        for entry in self.entries.values():
+            entry.expires = 0
+
+    def remove(self, sensorId):
+        self.friends.discard(sensorId)
+        for entry in self.entries.values():
+            entry.expires = 0
+
+    def observe(self, key, face, timestamp = None):
+        """
+        Adds a frame's sighting of a face.
+
+        Parameters:
+            key: What the face belongs to, the trackId of its track.
+            face (Face): The face as it was seen in this frame.
+            timestamp (float): Time of the frame, defaults to now.
+        Returns:
+            FRIEND, FOE, SUSPECT or UNKNOWN
+        """
+        if timestamp is None:
+            timestamp = timer()
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = IdentityEntry(self.window)
+            self.entries[key] = entry
+            if len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.entries.move_to_end(key)
+
+        entry.add(face.id, face.id_confidence)
+        if timestamp >= entry.expires or (face.id in self.friends and entry.identity != self.FRIEND):
+            self.decide(entry, timestamp)
+        else:
+            self.reused += 1
+        return entry.identity
+
+    def decide(self, entry, timestamp):
+        self.decisions += 1
+        # One confident sighting of a friend anywhere in the window wins, even over an id seen more often
+        sighted = [sensorId for sensorId, confidence in entry.observations if sensorId in self.friends and confidence >= self.threshold]
+        if sighted:
+            entry.identity = self.FRIEND
+            entry.sensorId = max(sighted, key=entry.smoothed)
+        elif any(sensorId in self.friends for sensorId in entry.counts):
+            # Held fire on, even when another id is reported more confidently
+            entry.identity = self.SUSPECT
+            entry.sensorId = -1
+        else:
+            candidates = [sensorId for sensorId, count in entry.counts.items() if count >= self.minSightings]
+            best = max(candidates, key=entry.smoothed, default=-1)
+            if best >= 0 and entry.smoothed(best) >= self.threshold:
+                entry.identity = self.FOE
+                entry.sensorId = best
+            else:
+                entry.identity = self.UNKNOWN
+                entry.sensorId = -1
+        entry.confidence = entry.smoothed(entry.sensorId)
+        entry.expires = timestamp + self.ttl
+
+    def identity(self, key):
+        """
+        Returns:
+            The cached decision for a key, None if it hasn't been seen
+        """
+        entry = self.entries.get(key)
+        return entry.identity if entry is not None else None
+
+    def isFriend(self, key):
+        return self.identity(key) == self.FRIEND
+
+    def forget(self, key):
+        self.entries.pop(key, None)
+
+    def getStats(self):
+        return {
+            "friends": sorted(self.friends),
+            "entries": len(self.entries),
+            "decisions": self.decisions,
+            "reused": self.reused,
+            "evictions": self.evictions,
+        }
+
+
+def main():
+    # Shows a friend being recognised and released as the sensor's confidence comes and goes
+    from PersonSensor import Face
+    identities = IdentityCache(friends=[0])
+    confidences = [0, 30, 80, 90, 95, 90, 40, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+    for frame, confidence in enumerate(confidences):
+        face = Face(99, 100, 100, 140, 140, confidence, 0 if confidence > 0 else -1, True)
+        timestamp = frame * 0.2
+        print("%.1fs id_confidence %3d -> %s" % (timestamp, confidence, identities.observe(1, face, timestamp)))
+    print(identities.getStats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+from Hardware import timer, sleep
+import threading
+
+class LoopScheduler:
+    """
+    Fixed-rate scheduler for control loops.
+
+    Deadlines are absolute (start + n * period), so the time spent doing work in a tick
+    never pushes the following ticks later. When there is nothing to do the loop can
+    block on wakeEvent instead of spinning.
+    """
+
+    def __init__(self, rate = 100, maxLag = 1):
+        """
+        Scheduler setup.
+
+        Parameters:
+            rate (float): Tick rate of the loop (ticks per second).
+            maxLag (float): How many periods late a tick can be before the missed ticks are skipped instead of caught up.
+        """
+        self.setRate(rate)
+        self.maxLag = maxLag
+
+        self.wakeEvent = threading.Event()
+        self.nextDeadline = None
+
+        # Statistics
+        self.ticks = 0
+        self.overruns = 0
+        self.skippedTicks = 0
+        self.idleCount = 0
+        self.maxLateness = 0
+
+
+    def setRate(self, rate):
+        self.rate = rate
+        self.period = 1 / rate
+        self.nextDeadline = None
+
+
+    def beginTick(self):
+        """
+        Marks the start of a tick. Anything that calls wake() after this point will stop the next idle() from blocking.
+        """
+        self.wakeEvent.clear()
+        if (self.nextDeadline is None):
+            self.nextDeadline = timer()
+
+
+    def waitNext(self):
+        """
+        Sleeps until the next deadline.
+
+        Returns:
+            True : The tick finished in time
+            False : The tick overran its deadline
+        """
+        self.ticks += 1
+        self.nextDeadline += self.period
+
+        remaining = self.nextDeadline - timer()
+        if (remaining > 0):
+            sleep(remaining)
+            return True
+
+        # Overrun, the work took longer than the time left in the period
+        lateness = -remaining
+        self.overruns += 1
+        self.maxLateness = max(self.maxLateness, lateness)
+        if (lateness > self.period * self.maxLag):
+            # Too far behind to catch up, skip to the next slot on the deadline grid
+            missed = int(lateness // self.period) + 1
+            self.skippedTicks += missed
+            self.nextDeadline += missed * self.period
+            sleep(max(0, self.nextDeadline - timer()))
+        return False
+
+
+    def idle(self, timeout = None):
+        """
+        Blocks until wake() is called or the timeout expires, then restarts the deadline grid.
+
+        Parameters:
+            timeout (float): Longest time to block for (seconds), None blocks until woken.
+        Returns:
+            True : Woken by wake()
+            False : The timeout expired
+        """
+        self.idleCount += 1
+        woken = self.wakeEvent.wait(timeout)
+        self.nextDeadline = None
+        return woken
+
+
+    def wake(self):
+        self.wakeEvent.set()
+
+
+    def getStats(self):
+        return {
+            "rate": self.rate,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped_ticks": self.skippedTicks,
+            "idle_count": self.idleCount,
+            "max_lateness": self.maxLateness,
+        }
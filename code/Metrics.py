@@ -0,0 +1,312 @@
+"""
+Live counters and latency histograms, served in the Prometheus text format.
+
+    import Metrics
+    Metrics.serve(9105)                      # http://127.0.0.1:9105/metrics
+    Metrics.serveUnix("/tmp/turret.sock")    # curl --unix-socket /tmp/turret.sock http://turret/metrics
+
+Instrumented code looks its metrics up once and then only increments plain attributes, no locks are taken:
+every metric is written by one thread (the loop that owns it) and a scrape just reads the current values.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+import math
+import os
+import threading
+import time
+
+# Wall clock for measuring how long code takes, even when the control loop runs on the simulator's virtual clock
+perfTimer = time.perf_counter
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, value) for key, value in sorted(labels.items())) + "}"
+
+
+class Counter:
+    """
+    A count that only goes up.
+    """
+
+    TYPE = "counter"
+
+    def __init__(self, name, labels = None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def render(self):
+        return ["%s%s %s" % (self.name, formatLabels(self.labels), self.value)]
+
+
+class Gauge(Counter):
+    """
+    A value that can go up and down.
+    """
+
+    TYPE = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """
+    HDR-style histogram: log-linear buckets with SUB_BUCKETS per power of two, so every value is kept to within
+    1 / SUB_BUCKETS of its size over the whole range, in a fixed list of counts. Recording is an integer
+    conversion, a bit_length() and an increment.
+    """
+
+    TYPE = "histogram"
+    SUB_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BITS
+
+    def __init__(self, name, labels = None, unit = 1e-6, maxValue = 3600):
+        """
+        Parameters:
+            unit (float): Resolution of the recorded values, values are counted in whole units.
+            maxValue (float): Largest value kept exactly, larger ones go in the top bucket.
+        """
+        self.name = name
+        self.labels = labels or {}
+        self.scale = 1 / unit
+        self.unit = unit
+        self.maxIndex = self.index(int(maxValue * self.scale))
+        self.counts = [0] * (self.maxIndex + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def index(self, units):
+        shift = units.bit_length() - self.SUB_BITS - 1
+        if shift <= 0:
+            return units
+        return (shift << self.SUB_BITS) + (units >> shift)
+
+    def bounds(self, index):
+        """
+        Returns:
+            (lowest, highest) value that lands in a bucket, in units
+        """
+        if index < 2 * self.SUB_BUCKETS:
+            return index, index + 1
+        shift = (index >> self.SUB_BITS) - 1
+        mantissa = (index & (self.SUB_BUCKETS - 1)) + self.SUB_BUCKETS
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, value):
+        units = int(value * self.scale)
+        # index() inlined, this runs every tick
+        shift = units.bit_length() - self.SUB_BITS - 1
+        if shift <= 0:
+            index = units if units > 0 else 0
+        else:
+            index = (shift << self.SUB_BITS) + (units >> shift)
+            if index > self.maxIndex:
+                index = self.maxIndex
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        Returns:
+            The value below which the fraction of recorded values lie (the middle of its bucket), None when empty
+        """
+        if self.count == 0:
+            return None
+        rank = math.ceil(fraction * self.count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                low, high = self.bounds(index)
+                return (low + high) / 2 * self.unit
+        return self.max
+
+    def render(self):
+        """
+        Cumulative buckets at each power of two up to the largest value seen.
+        """
+        lines = []
+        labels = dict(self.labels)
+        counts = list(self.counts) # A snapshot, the owner may record while this renders
+        cumulative = 0
+        top = max((index for index, count in enumerate(counts) if count), default=-1)
+        groupEnd = 2 * self.SUB_BUCKETS - 1
+        for index in range(min(self.maxIndex, max(top, groupEnd) | (self.SUB_BUCKETS - 1)) + 1):
+            cumulative += counts[index]
+            if index == groupEnd:
+                labels["le"] = "%g" % (self.bounds(index)[1] * self.unit)
+                lines.append("%s_bucket%s %d" % (self.name, formatLabels(labels), cumulative))
+                groupEnd += self.SUB_BUCKETS
+        labels["le"] = "+Inf"
+        lines.append("%s_bucket%s %d" % (self.name, formatLabels(labels), self.count))
+        lines.append("%s_sum%s %s" % (self.name, formatLabels(self.labels), self.sum))
+        lines.append("%s_count%s %d" % (self.name, formatLabels(self.labels), self.count))
+        return lines
+
+    def getStats(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class Registry:
+    """
+    Every metric by name and labels, and their help text.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.metrics = {} # (name, labels) -> metric
+        self.help = {}
+        self.lock = threading.Lock() # Only guards creating metrics
+
+    def get(self, metricClass, name, help, labels = None, **settings):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = metricClass(name, labels, **settings)
+                self.metrics[key] = metric
+                self.help[name] = (help, metricClass.TYPE)
+            return metric
+
+    def counter(self, name, help, labels = None):
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels = None):
+        return self.get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels = None, **settings):
+        return self.get(Histogram, name, help, labels, **settings)
+
+    def render(self):
+        """
+        Returns:
+            Every metric in the Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+        lines = []
+        lastName = None
+        for (name, _), metric in metrics:
+            if name != lastName:
+                help, metricType = self.help[name]
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, metricType))
+                lastName = name
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, help, labels = None):
+    return registry.counter(name, help, labels)
+
+
+def gauge(name, help, labels = None):
+    return registry.gauge(name, help, labels)
+
+
+def histogram(name, help, labels = None, **settings):
+    return registry.histogram(name, help, labels, **settings)
+
+
+def enabled():
+    return registry.enabled
+
+
+def setEnabled(value):
+    registry.enabled = value
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        pass # Scrapes every few seconds would flood the console
+
+
+def startServer(server):
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, args=(), daemon=True).start()
+    return server
+
+
+def serve(port = 9105, host = "127.0.0.1"):
+    """
+    Serves /metrics over HTTP from a background thread.
+
+    Returns:
+        The server, shutdown() stops it
+    """
+    return startServer(ThreadingHTTPServer((host, port), MetricsRequestHandler))
+
+
+def serveUnix(path):
+    """
+    Serves /metrics over HTTP on a Unix socket, so nothing is opened to the network.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    return startServer(ThreadingUnixStreamServer(path, MetricsRequestHandler))
+
+
+def main():
+    # Prints what an instrumented session looks like, without hardware
+    import Hardware
+    from Simulator import Simulator, ScriptedTarget
+    simulator = Simulator([ScriptedTarget(lambda t: [90 + 20 * math.sin(t), 80])])
+    Hardware.useSimulator(simulator)
+    from ServoHandler import ServoHandler
+    from PersonSensor import PersonSensor
+    handler = ServoHandler(start=False)
+    handler.enable()
+    sensor = PersonSensor(continuous=False)
+    simulator.followCamera(handler)
+
+    def tick(t):
+        if round(t * 100) % 20 == 0:
+            angles = sensor.getLargestFace()
+            if angles != -1:
+                handler.fromCentre(angles)
+        handler.tick(t)
+
+    simulator.run(10, 0.01, tick)
+    # The handlers registered with the imported module, not this script's copy of it
+    import Metrics
+    print(Metrics.registry.render())
+
+
+if __name__ == '__main__':
+    main()
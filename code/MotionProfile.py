@@ -0,0 +1,305 @@
+import bisect
+import math
+
+class MotionProfile:
+    """
+    A planned move, worked out once and then evaluated in closed form at any time.
+
+    The move is a list of segments of constant jerk, each stored as
+    (startTime, startPosition, startSpeed, startAcceleration, jerk).
+    The last segment always holds the final position, so evaluating past the end of the move is safe.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.startTimes = [segment[0] for segment in segments]
+        self.startTime = segments[0][0]
+        self.endTime = segments[-1][0]
+        self.endPosition = segments[-1][1]
+
+
+    @classmethod
+    def hold(cls, position, currentUptime):
+        return cls([(currentUptime, position, 0, 0, 0)])
+
+
+    def sample(self, currentUptime):
+        """
+        Returns:
+            (position, speed) at the given time
+        """
+        index = max(bisect.bisect_right(self.startTimes, currentUptime) - 1, 0)
+        startTime, position, speed, acceleration, jerk = self.segments[index]
+        dt = currentUptime - startTime
+        return (position + speed * dt + acceleration * dt * dt / 2 + jerk * dt * dt * dt / 6,
+            speed + acceleration * dt + jerk * dt * dt / 2)
+
+
+    def duration(self):
+        return self.endTime - self.startTime
+
+
+    def scaled(self, origin, scale):
+        """
+        Returns:
+            A copy of the profile mapped from [0,1] onto origin + scale * position
+        """
+        return MotionProfile([(t, origin + scale * p, scale * v, scale * a, scale * j) for t, p, v, a, j in self.segments])
+
+
+def chain(startTime, position, speed, pieces):
+    """
+    Builds a profile by integrating a list of pieces one after another.
+
+    Parameters:
+        startTime (float): Time the move starts.
+        position (float): Start position.
+        speed (float): Start speed.
+        pieces (list): (duration, acceleration, jerk) for each piece, zero length pieces are skipped.
+    Returns:
+        MotionProfile
+    """
+    segments = []
+    t = startTime
+    for duration, acceleration, jerk in pieces:
+        if duration <= 0:
+            continue
+        segments.append((t, position, speed, acceleration, jerk))
+        position += speed * duration + acceleration * duration * duration / 2 + jerk * duration * duration * duration / 6
+        speed += acceleration * duration + jerk * duration * duration / 2
+        t += duration
+    segments.append((t, position, 0, 0, 0))
+    return MotionProfile(segments)
+
+
+def trapezoid(start, target, maxSpeed, acceleration, startTime, startSpeed = 0):
+    """
+    Plans the quickest move from start to target with limited speed and acceleration,
+    starting with any speed (a move can be replanned part way through another).
+
+    Parameters:
+        start (float): Current position.
+        target (float): Position to finish at, with zero speed.
+        maxSpeed (float): Speed limit (units per second).
+        acceleration (float): Acceleration and deceleration rate (units per second per second).
+        startTime (float): Time the move starts.
+        startSpeed (float): Current speed.
+    Returns:
+        MotionProfile
+    """
+    distance = target - start
+    if distance == 0 and startSpeed == 0:
+        return MotionProfile.hold(target, startTime)
+
+    # Work along the direction of the target, speeds towards it are positive
+    direction = 1 if distance > 0 or (distance == 0 and startSpeed < 0) else -1
+    distance = abs(distance)
+    speed = startSpeed * direction
+    pieces = []
+
+    if speed < 0:
+        # Moving away from the target, stop first
+        pieces.append((-speed / acceleration, acceleration * direction, 0))
+        distance += speed * speed / (2 * acceleration)
+        speed = 0
+    elif speed * speed / (2 * acceleration) > distance:
+        # Too fast to stop at the target, stop past it and come back
+        pieces.append((speed / acceleration, -acceleration * direction, 0))
+        distance = speed * speed / (2 * acceleration) - distance
+        direction = -direction
+        speed = 0
+
+    # Speed up (or slow down to maxSpeed), cruise, then slow to a stop at the target
+    peakSpeed = min(maxSpeed, math.sqrt(acceleration * distance + speed * speed / 2))
+    changeTime = abs(peakSpeed - speed) / acceleration
+    stopTime = peakSpeed / acceleration
+    cruiseDistance = distance - (peakSpeed + speed) / 2 * changeTime - peakSpeed * stopTime / 2
+    cruiseTime = cruiseDistance / peakSpeed if (peakSpeed > 0 and cruiseDistance > 0) else 0
+
+    changeDirection = 1 if peakSpeed >= speed else -1
+    pieces.append((changeTime, acceleration * changeDirection * direction, 0))
+    pieces.append((cruiseTime, 0, 0))
+    pieces.append((stopTime, -acceleration * direction, 0))
+
+    profile = chain(startTime, start, startSpeed, pieces)
+    # Land exactly on the target rather than wherever rounding leaves us
+    profile.segments[-1] = (profile.endTime, target, 0, 0, 0)
+    profile.endPosition = target
+    return profile
+
+
+def trapezoidTime(distance, maxSpeed, acceleration):
+    """
+    Returns:
+        Duration of the quickest rest-to-rest move over the distance
+    """
+    distance = abs(distance)
+    if distance * acceleration >= maxSpeed * maxSpeed:
+        return distance / maxSpeed + maxSpeed / acceleration
+    return 2 * math.sqrt(distance / acceleration)
+
+
+def sCurve(start, target, maxSpeed, acceleration, jerk, startTime):
+    """
+    Plans the quickest jerk-limited move between two resting positions.
+    Acceleration ramps up and down at the jerk rate instead of switching instantly, which is gentler on the mounts.
+
+    Parameters:
+        start (float): Current position, the servo must be at rest.
+        target (float): Position to finish at.
+        maxSpeed (float): Speed limit (units per second).
+        acceleration (float): Acceleration limit (units per second per second).
+        jerk (float): Rate of change of acceleration limit (units per second cubed).
+        startTime (float): Time the move starts.
+    Returns:
+        MotionProfile
+    """
+    distance = abs(target - start)
+    if distance == 0:
+        return MotionProfile.hold(target, startTime)
+    direction = 1 if target > start else -1
+
+    def rampTimes(peakSpeed):
+        # (jerk time, constant acceleration time) needed to reach peakSpeed from rest
+        if peakSpeed * jerk >= acceleration * acceleration:
+            jerkTime = acceleration / jerk
+            return jerkTime, peakSpeed / acceleration - jerkTime
+        return math.sqrt(peakSpeed / jerk), 0
+
+    def rampDistance(peakSpeed):
+        # Distance to speed up to peakSpeed and slow back down to rest
+        jerkTime, constantTime = rampTimes(peakSpeed)
+        return peakSpeed * (2 * jerkTime + constantTime)
+
+    peakSpeed = maxSpeed
+    if rampDistance(peakSpeed) > distance:
+        # Never reaches maxSpeed, find the peak speed that uses exactly the distance available
+        low, high = 0, maxSpeed
+        for _ in range(60):
+            peakSpeed = (low + high) / 2
+            if rampDistance(peakSpeed) > distance:
+                high = peakSpeed
+            else:
+                low = peakSpeed
+        peakSpeed = low
+
+    jerkTime, constantTime = rampTimes(peakSpeed)
+    cruiseTime = max(0, distance - rampDistance(peakSpeed)) / peakSpeed if peakSpeed > 0 else 0
+    peakAcceleration = jerk * jerkTime * direction
+    signedJerk = jerk * direction
+
+    profile = chain(startTime, start, 0, [
+        (jerkTime, 0, signedJerk),
+        (constantTime, peakAcceleration, 0),
+        (jerkTime, peakAcceleration, -signedJerk),
+        (cruiseTime, 0, 0),
+        (jerkTime, 0, -signedJerk),
+        (constantTime, -peakAcceleration, 0),
+        (jerkTime, -peakAcceleration, signedJerk),
+    ])
+    profile.segments[-1] = (profile.endTime, target, 0, 0, 0)
+    profile.endPosition = target
+    return profile
+
+
+def stretch(plan, endTime, profile):
+    """
+    Slows a move down until it arrives as close to endTime as it can without being late.
+
+    Parameters:
+        plan (function): Plans the move with its speed limit scaled by a fraction, plan(scale) -> MotionProfile.
+        endTime (float): Time the move should arrive.
+        profile (MotionProfile): The move at full speed.
+    Returns:
+        MotionProfile
+    """
+    low, high = 0, 1
+    for _ in range(30):
+        scale = (low + high) / 2
+        stretched = plan(scale)
+        if stretched.endTime > endTime:
+            low = scale
+        else:
+            high = scale
+            profile = stretched
+    return profile
+
+
+def peaks(profile):
+    """
+    Returns:
+        (highest speed, highest acceleration, highest jerk) of a profile, speed and acceleration peak at a segment boundary
+    """
+    return tuple(max(abs(segment[field]) for segment in profile.segments) for field in (2, 3, 4))
+
+
+def synchronise(starts, targets, maxSpeeds, accelerations, startTime, startSpeeds = None, jerks = None):
+    """
+    Plans moves for a group of axes so they all arrive at the same time,
+    in the shortest time the slowest axis allows.
+
+    When every axis starts at rest the axis with the longest quickest move leads, and it's planned as if it were
+    moving alone. The others follow the same normalised profile when their limits allow, so the combined move is a
+    straight line. An axis whose limits don't allow it is planned on its own, slowed down to arrive with the leader.
+    Axes that are already moving are each planned with full acceleration and their speed limit scaled
+    down until they arrive with the slowest axis.
+
+    Parameters:
+        starts (list): Current position of each axis.
+        targets (list): Target position of each axis.
+        maxSpeeds (list): Speed limit of each axis.
+        accelerations (list): Acceleration limit of each axis.
+        startTime (float): Time the moves start.
+        startSpeeds (list): Current speed of each axis, defaults to all at rest.
+        jerks (list): Jerk limit of each axis, uses S-curve profiles when given (only from rest).
+    Returns:
+        List of MotionProfile, one per axis
+    """
+    if startSpeeds is None:
+        startSpeeds = [0] * len(starts)
+    distances = [target - start for start, target in zip(starts, targets)]
+
+    if not any(startSpeeds):
+        moving = [i for i in range(len(starts)) if distances[i] != 0]
+        if not moving:
+            return [MotionProfile.hold(target, startTime) for target in targets]
+
+        def plan(i, scale = 1):
+            # The axis's quickest move over [0,1], its limits divided by its distance
+            distance = abs(distances[i])
+            if jerks is None:
+                return trapezoid(0, 1, scale * maxSpeeds[i] / distance, accelerations[i] / distance, startTime)
+            return sCurve(0, 1, scale * maxSpeeds[i] / distance, accelerations[i] / distance, jerks[i] / distance, startTime)
+
+        lead = max(moving, key=lambda i: plan(i).duration())
+        unit = plan(lead)
+        speed, acceleration, jerk = peaks(unit)
+
+        def follows(i):
+            # Whether the axis can move along the leader's profile without going over its own limits
+            distance = abs(distances[i]) * (1 - 1e-9) # Leaves the leader itself some rounding
+            return (speed * distance <= maxSpeeds[i] and acceleration * distance <= accelerations[i]
+                and (jerks is None or jerk * distance <= jerks[i]))
+
+        profiles = []
+        for i, (start, target, distance) in enumerate(zip(starts, targets, distances)):
+            if distance == 0 or follows(i):
+                profile = unit.scaled(start, distance)
+            else:
+                profile = stretch(lambda scale, i=i: plan(i, scale), unit.endTime, plan(i)).scaled(start, distance)
+            profile.segments[-1] = (profile.endTime, target, 0, 0, 0)
+            profile.endPosition = target
+            profiles.append(profile)
+        return profiles
+
+    profiles = [trapezoid(start, target, maxSpeed, acceleration, startTime, speed)
+        for start, target, maxSpeed, acceleration, speed in zip(starts, targets, maxSpeeds, accelerations, startSpeeds)]
+    endTime = max(profile.endTime for profile in profiles)
+
+    for i, profile in enumerate(profiles):
+        if profile.endTime >= endTime or distances[i] == 0:
+            continue
+        # Slow this axis down until it arrives with the slowest one
+        profiles[i] = stretch(lambda scale, i=i: trapezoid(starts[i], targets[i], maxSpeeds[i] * scale, accelerations[i], startTime, startSpeeds[i]),
+            endTime, profile)
+    return profiles
@@ -0,0 +1,158 @@
+from BusManager import PRIORITY_SERVO
+import Hardware
+import threading
+
+class BatchedChannel:
+    """
+    Stands in for servokit.servo[index]. Setting the angle only records the new duty value,
+    nothing goes on the bus until PCA9685Batch.flush().
+    """
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+        self.actuation_range = 180
+        self.minPulse = 750
+        self.maxPulse = 2250
+        self._angle = None
+
+    def set_pulse_width_range(self, minPulse, maxPulse):
+        self.minPulse = minPulse
+        self.maxPulse = maxPulse
+
+    @property
+    def angle(self):
+        return self._angle
+
+    @angle.setter
+    def angle(self, value):
+        self._angle = value
+        if value is not None:
+            self.batch.set(self.index, self.dutyCount(value))
+
+    def dutyCount(self, angle):
+        """
+        Returns:
+            The 12-bit OFF count for an angle, worked out the same way adafruit_motor.servo and
+            adafruit_pca9685 do it so the servos end up exactly where ServoKit would put them
+        """
+        frequency = self.batch.frequency
+        minDuty = int((self.minPulse * frequency) / 1000000 * 0xFFFF)
+        maxDuty = (self.maxPulse * frequency) / 1000000 * 0xFFFF
+        dutyRange = int(maxDuty - minDuty)
+        fraction = min(1, max(0, angle / self.actuation_range))
+        dutyCycle = minDuty + int(fraction * dutyRange)
+        return (dutyCycle + 1) >> 4
+
+
+class PCA9685Batch:
+    """
+    Writes every servo channel of a PCA9685 in one I2C transaction per tick.
+
+    Through ServoKit each angle assignment is its own transaction (address, register, 4 bytes).
+    Here the channels only collect duty values, then flush() sends the LED registers from the lowest
+    to the highest changed channel as one auto-increment block write. Channels whose duty value
+    hasn't changed are not counted as dirty, and nothing is sent at all when no channel changed.
+    """
+
+    LED0_ON_L = 0x06 # First LED register, each channel has ON_L, ON_H, OFF_L, OFF_H
+    REGISTERS_PER_CHANNEL = 4
+    TRANSACTION_OVERHEAD = 2 # Address byte and register byte
+
+    def __init__(self, kit, channels = 16, bus = None):
+        """
+        Parameters:
+            kit (ServoKit): The kit to take the PCA9685 from. ServoKit enables register auto-increment when it sets the frequency.
+            channels (int): Number of channels on the board.
+            bus (BusManager): Bus the writes are queued on, defaults to Hardware.bus().
+        """
+        self.bus = Hardware.bus() if bus is None else bus
+        self.device = kit._pca.i2c_device
+        self.frequency = kit._pca.frequency
+        self.channels = [BatchedChannel(self, i) for i in range(channels)]
+        self.lock = threading.Lock()
+
+        self.written = [None] * channels # Duty value last sent for each channel
+        self.pending = {}
+        self.assignments = 0 # Angle assignments since the last flush
+
+        # Statistics
+        self.flushes = 0
+        self.transactions = 0
+        self.bytesWritten = 0
+        self.channelWrites = 0
+        self.skippedWrites = 0
+        self.baselineTransactions = 0
+        self.baselineBytes = 0
+
+    def set(self, index, duty):
+        with self.lock:
+            self.assignments += 1
+            if self.written[index] == duty:
+                self.pending.pop(index, None)
+            else:
+                self.pending[index] = duty
+
+    def flush(self):
+        """
+        Sends all changed channels. If a flush from another thread is still waiting for the bus
+        this one is coalesced into it, the values are only collected once the bus is free.
+
+        Returns:
+            Number of channels written
+        """
+        with self.lock:
+            assignments = self.assignments
+            self.assignments = 0
+            self.flushes += 1
+            self.baselineTransactions += assignments
+            self.baselineBytes += assignments * (self.TRANSACTION_OVERHEAD + self.REGISTERS_PER_CHANNEL)
+            if not self.pending:
+                self.skippedWrites += assignments
+                return 0
+            self.skippedWrites += assignments - len(self.pending)
+        return self.bus.run(self.writePending, PRIORITY_SERVO, "pca9685", key=self)
+
+    def writePending(self):
+        with self.lock:
+            dirty = self.pending
+            self.pending = {}
+            if not dirty:
+                return 0
+
+            first = min(dirty)
+            last = max(dirty)
+            buffer = bytearray(1 + (last - first + 1) * self.REGISTERS_PER_CHANNEL)
+            buffer[0] = self.LED0_ON_L + first * self.REGISTERS_PER_CHANNEL
+            for index in range(first, last + 1):
+                # Unchanged channels in the middle of the block are rewritten with their current value
+                duty = dirty.get(index, self.written[index])
+                if duty is None:
+                    duty = 0 # Channel nothing has used yet, it stays off
+                offset = 1 + (index - first) * self.REGISTERS_PER_CHANNEL
+                buffer[offset + 2] = duty & 0xFF # ON count stays 0, OFF count is the duty value
+                buffer[offset + 3] = duty >> 8
+                self.written[index] = duty
+
+        # Servos can keep setting angles while this is on the bus, they go in the next flush
+        with self.device as device:
+            device.write(buffer)
+
+        self.transactions += 1
+        self.bytesWritten += len(buffer) + 1
+        self.channelWrites += len(dirty)
+        return len(dirty)
+
+    def getStats(self):
+        flushes = max(1, self.flushes)
+        return {
+            "flushes": self.flushes,
+            "transactions": self.transactions,
+            "bytes": self.bytesWritten,
+            "channel_writes": self.channelWrites,
+            "skipped_writes": self.skippedWrites,
+            "baseline_transactions": self.baselineTransactions,
+            "baseline_bytes": self.baselineBytes,
+            "transactions_saved_per_tick": (self.baselineTransactions - self.transactions) / flushes,
+            "bytes_saved_per_tick": (self.baselineBytes - self.bytesWritten) / flushes,
+        }
@@ -1,58 +1,295 @@
 # Example of accessing the Person Sensor from Useful Sensors on a Pi using
 # Python. See https://usfl.ink/ps_dev for the full developer guide.
 
-import io
-import fcntl
 import struct
-import time
+from array import array
+import Metrics
+from collections import namedtuple
 from threading import Thread
+from FrameQueue import FrameQueue
+from LoopScheduler import LoopScheduler
+from BusManager import PRIORITY_SENSOR
+import Hardware
+import math
+import numpy as np
+
+
+# One detected face, fields as laid out in the developer guide
+Face = namedtuple("Face", ["box_confidence", "box_left", "box_top", "box_right", "box_bottom", "id_confidence", "id", "is_facing"])
+
+
+def crcTable(polynomial):
+    """
+    Returns:
+        The 256 entry lookup table for an MSB-first CRC-16 with the given polynomial
+    """
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ polynomial) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+
+class PersonSensorDecoder:
+    """
+    Decodes Person Sensor result frames.
+    
+    The frame layout is compiled into struct.Struct objects once and frames are read straight into a
+    preallocated buffer, so decoding a frame doesn't allocate anything but the Face records.
+    Frames are checked against their CRC before they are decoded, and a frame identical to the one before it is flagged
+    so it isn't decoded (or aimed at) twice.
+    """
+    
+    ACCEPTED = "accepted"
+    REJECTED = "rejected"
+    DUPLICATE = "duplicate"
+    
+    # CRC-16/CCITT-FALSE over every byte before the checksum
+    CRC_POLYNOMIAL = 0x1021
+    CRC_INIT = 0xFFFF
+    CRC_TABLE = crcTable(CRC_POLYNOMIAL)
+    
+    FACE_MAX = 4
+    HEADER = struct.Struct("BBH")
+    FACE = struct.Struct("BBBBBBbB")
+    RESULT = struct.Struct("BBH" + "B" + "BBBBBBbB" * FACE_MAX + "H")
+    NUM_FACES_OFFSET = HEADER.size # Byte offset of the face count
+    FACES_OFFSET = HEADER.size + 1 # Byte offset of the first face
+    CHECKSUM = struct.Struct("<H")
+    CHECKSUM_OFFSET = FACES_OFFSET + FACE_MAX * FACE.size # The sensor packs its frame, so no alignment padding before the checksum
+    
+    # Rejections in a row, without a single accepted frame, before warning that the checksum may be wrong
+    REJECTED_WARNING = 25
+    
+    def __init__(self, verifyChecksum = False):
+        """
+        Parameters:
+            verifyChecksum (bool): Reject frames whose checksum doesn't match. Off by default, the CRC-16/CCITT-FALSE
+                checksum has only been checked against the developer guide, not against a real sensor. While it's off
+                corrupt frames are not filtered, they're decoded and published like any other.
+        """
+        self.buffer = bytearray(self.RESULT.size)
+        self.view = memoryview(self.buffer)
+        self.previousFrame = bytearray(self.RESULT.size)
+        self.verifyChecksum = verifyChecksum
+        
+        self.framesAccepted = 0
+        self.framesRejected = 0
+        self.framesDuplicate = 0
+    
+    def crc(self, data):
+        crc = self.CRC_INIT
+        table = self.CRC_TABLE
+        for byte in data:
+            crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+        return crc
+    
+    def checksumValid(self, frame = None):
+        view = self.view if frame is None else memoryview(frame)
+        (checksum,) = self.CHECKSUM.unpack_from(view, self.CHECKSUM_OFFSET)
+        return checksum == self.crc(view[:self.CHECKSUM_OFFSET])
+    
+    def check(self):
+        """
+        Validates the frame in the buffer and counts the result.
+        
+        Returns:
+            ACCEPTED : A new, valid frame
+            REJECTED : The checksum doesn't match, the frame should be dropped
+            DUPLICATE : The same frame as the last one accepted
+        """
+        if self.verifyChecksum and not self.checksumValid():
+            self.framesRejected += 1
+            if self.framesAccepted == 0 and self.framesRejected == self.REJECTED_WARNING:
+                print("Person sensor: the first %s frames all failed their checksum, if the sensor is working try verifyChecksum=False" % self.REJECTED_WARNING)
+            return self.REJECTED
+        if self.buffer == self.previousFrame:
+            self.framesDuplicate += 1
+            return self.DUPLICATE
+        self.previousFrame[:] = self.buffer
+        self.framesAccepted += 1
+        return self.ACCEPTED
+    
+    def getStats(self):
+        return {
+            "accepted": self.framesAccepted,
+            "rejected": self.framesRejected,
+            "duplicate": self.framesDuplicate,
+        }
+    
+    def decode(self, frame = None):
+        """
+        Unpacks every face in a frame with one iter_unpack call over the face bytes.
+        
+        Parameters:
+            frame (bytes-like): A result frame, defaults to the decoder's own buffer.
+        Returns:
+            Tuple of Face records, empty when no faces are detected
+        """
+        view = self.view if frame is None else memoryview(frame)
+        numFaces = min(view[self.NUM_FACES_OFFSET], self.FACE_MAX)
+        faceBytes = view[self.FACES_OFFSET:self.FACES_OFFSET + numFaces * self.FACE.size]
+        return tuple(map(Face._make, self.FACE.iter_unpack(faceBytes)))
+
+
+class SensorLens:
+    """
+    Maps sensor coordinates (0-255 on each axis) to [yaw, pitch] angle offsets from the centre of view,
+    correcting for the wide-angle lens.
+    
+    The lens is a pinhole camera with Brown radial distortion, the same parameters a standard camera calibration
+    gives (with the focal lengths and centre scaled to sensor coordinates). Every coordinate's angles are worked
+    out once into a 256x256 table, so converting a face is a few array reads however complicated the lens is.
+    Angles increase with the sensor coordinates, as the linear estimate they replace did.
+    """
+    
+    SIZE = 256
+    
+    def __init__(self, fov = 110, aspect = 720 / 1280, centre = (127.5, 127.5), k1 = 0, k2 = 0, focal = None):
+        """
+        Parameters:
+            fov (float): Horizontal field of view of the undistorted image (degrees), used when focal isn't given.
+            aspect (float): Image height / width.
+            centre (tuple): Sensor coordinates of the optical axis.
+            k1, k2 (float): Radial distortion coefficients, negative for barrel distortion.
+            focal (tuple): Calibrated [x, y] focal lengths (sensor coordinates), instead of fov and aspect.
+        """
+        if focal is None:
+            halfWidth = math.tan(math.radians(fov / 2))
+            focal = ((self.SIZE - 1) / 2 / halfWidth, (self.SIZE - 1) / 2 / (halfWidth * aspect))
+        self.focal = tuple(focal)
+        self.centre = tuple(centre)
+        self.k1 = k1
+        self.k2 = k2
+        self.table = self.buildTable()
+        # The same values in a flat array, reading single values from it is much quicker than from numpy
+        self.values = array("f", self.table.tobytes())
+    
+    def distortion(self, radiusSquared):
+        return 1 + self.k1 * radiusSquared + self.k2 * radiusSquared * radiusSquared
+    
+    def buildTable(self):
+        """
+        Returns:
+            float32 array, [y][x] holds the [yaw, pitch] offsets (degrees) of sensor coordinate (x, y)
+        """
+        coordinates = np.arange(self.SIZE, dtype=np.float64)
+        xd, yd = np.meshgrid((coordinates - self.centre[0]) / self.focal[0], (coordinates - self.centre[1]) / self.focal[1])
+        
+        # Undistort the radius by inverting the distortion curve, sampled out past the corners of the sensor
+        distorted = np.hypot(xd, yd)
+        undistortedRadii = np.linspace(0, 2 * distorted.max() + 1, 4096)
+        distortedRadii = undistortedRadii * self.distortion(undistortedRadii ** 2)
+        # Strong barrel distortion folds back at large radii, only the part that still gets wider is real
+        folds = np.flatnonzero(np.diff(distortedRadii) <= 0)
+        if len(folds):
+            undistortedRadii = undistortedRadii[:folds[0] + 1]
+            distortedRadii = distortedRadii[:folds[0] + 1]
+        undistorted = np.interp(distorted, distortedRadii, undistortedRadii)
+        scale = np.divide(undistorted, distorted, out=np.ones_like(distorted), where=distorted > 0)
+        xu, yu = xd * scale, yd * scale
+        
+        yaw = np.degrees(np.arctan(xu))
+        pitch = np.degrees(np.arctan2(yu, np.hypot(xu, 1)))
+        return np.stack([yaw, pitch], axis=-1).astype(np.float32)
+    
+    def angles(self, x, y):
+        """
+        Parameters:
+            x, y (float): Sensor coordinates, box centres fall on half coordinates.
+        Returns:
+            [yaw, pitch] offsets from the centre of view (degrees), interpolated between table entries
+        """
+        last = self.SIZE - 1
+        x = min(last, max(0, x))
+        y = min(last, max(0, y))
+        column = min(int(x), last - 1)
+        row = min(int(y), last - 1)
+        fx = x - column
+        fy = y - row
+        values = self.values
+        topLeft = (row * self.SIZE + column) * 2
+        bottomLeft = topLeft + self.SIZE * 2
+        result = []
+        for axis in (0, 1):
+            top = values[topLeft + axis] + fx * (values[topLeft + 2 + axis] - values[topLeft + axis])
+            bottom = values[bottomLeft + axis] + fx * (values[bottomLeft + 2 + axis] - values[bottomLeft + axis])
+            result.append(top + fy * (bottom - top))
+        return result
+    
+    def project(self, yaw, pitch):
+        """
+        Returns:
+            The sensor coordinates [x, y] that see the given angle offsets, the inverse of angles()
+        """
+        xu = math.tan(math.radians(yaw))
+        yu = math.tan(math.radians(pitch)) * math.hypot(xu, 1)
+        scale = self.distortion(xu * xu + yu * yu)
+        return [self.centre[0] + self.focal[0] * xu * scale, self.centre[1] + self.focal[1] * yu * scale]
 
 
 class PersonSensor:
     
-    def __init__(self):
+    def __init__(self, dictFaces = False, verifyChecksum = False, frameBuffer = 16, continuous = True, lens = None, frameSource = None, identities = None):
+        """
+        Person Sensor setup.
+        
+        Parameters:
+            dictFaces (bool): Return faces as dictionaries (the original format) instead of Face records.
+            verifyChecksum (bool): Drop frames whose checksum doesn't match, see PersonSensorDecoder. Off by default,
+                so corrupt frames are not filtered. TurretRuntime and SensorHandler take it from the calibration profile.
+            frameBuffer (int): Number of frames kept in self.frames.
+            continuous (bool): Start reading frames on a background thread.
+            lens (SensorLens): Calibration of the sensor's lens, defaults to the nominal 110 degree lens with no distortion.
+            frameSource (SensorProcess): Take frames from a sensor process instead of reading the sensor here.
+            identities (Identity.IdentityCache): Friends to leave out of getLargestFace() and getMostConfident().
+        """
 
         # The person sensor has the I2C ID of hex 62, or decimal 98.
         PERSON_SENSOR_I2C_ADDRESS = 0x62
 
         # We will be reading raw bytes over I2C, and we'll need to decode them into
-        # data structures. These strings define the format used for the decoding, and
-        # are derived from the layouts defined in the developer guide.
-        self.PERSON_SENSOR_I2C_HEADER_FORMAT = "BBH"
-        self.PERSON_SENSOR_I2C_HEADER_BYTE_COUNT = struct.calcsize(self.PERSON_SENSOR_I2C_HEADER_FORMAT)
-
-        self.PERSON_SENSOR_FACE_FORMAT = "BBBBBBbB"
-        self.PERSON_SENSOR_FACE_BYTE_COUNT = struct.calcsize(self.PERSON_SENSOR_FACE_FORMAT)
-
-        PERSON_SENSOR_FACE_MAX = 4
-        PERSON_SENSOR_RESULT_FORMAT = self.PERSON_SENSOR_I2C_HEADER_FORMAT + "B" + self.PERSON_SENSOR_FACE_FORMAT * PERSON_SENSOR_FACE_MAX + "H"
-        self.PERSON_SENSOR_RESULT_BYTE_COUNT = struct.calcsize(PERSON_SENSOR_RESULT_FORMAT)
-
-        # I2C channel 1 is connected to the GPIO pins
-        I2C_CHANNEL = 1
-        I2C_PERIPHERAL = 0x703
+        # data structures. The decoder holds the precompiled layouts from the developer guide.
+        self.decoder = PersonSensorDecoder(verifyChecksum)
+        self.PERSON_SENSOR_RESULT_BYTE_COUNT = self.decoder.RESULT.size
 
         # How long to pause between sensor polls.
         self.PERSON_SENSOR_DELAY = 0.2 * 0.98
 
-        self.i2c_handle = io.open("/dev/i2c-" + str(I2C_CHANNEL), "rb", buffering=0)
-        fcntl.ioctl(self.i2c_handle, I2C_PERIPHERAL, PERSON_SENSOR_I2C_ADDRESS)
+        self.frameSource = frameSource
+        if frameSource is None:
+            self.i2c_handle = Hardware.personSensorBus(PERSON_SENSOR_I2C_ADDRESS)
+            self.bus = Hardware.bus() # Shared with the servos, which get the bus first
         
         
         # Custom variables
+        self.dictFaces = dictFaces
         self.continousEnabled = False
-        self.fov = 110
-        resolution = [1280,720]
-        self.fovScale = [self.fov / 255, (self.fov * (resolution[1] / resolution[0])) / 255]
-        self.faces = -1
+        self.setLens(SensorLens() if lens is None else lens)
+        self.frames = FrameQueue(frameBuffer) if frameSource is None else frameSource # Accepted frames, the data of each is a tuple of Face records
+        self.takenSeq = 0
+        self.lastFaces = -1
+        self.lastStatus = None
         self.previousValue = [0,0]
+        self.recorder = None # FlightRecorder logging every raw frame
+        self.identities = identities
         
-        self.sensorCutoff = [[60,255],[60,255]]
-        self.adjustedCentre = [self.sensorCutoff[0][0] + ((self.sensorCutoff[0][1] - self.sensorCutoff[0][0]) / 2), self.sensorCutoff[1][0] + ((self.sensorCutoff[1][1] - self.sensorCutoff[1][0]) / 2)]
+        # Instrumentation, see Metrics.py
+        self.frameCounts = {status: Metrics.counter("turret_person_sensor_frames_total", "Person Sensor frames read, by the result of their check", {"status": status})
+            for status in (self.decoder.ACCEPTED, self.decoder.REJECTED, self.decoder.DUPLICATE)}
+        self.framesDropped = Metrics.gauge("turret_person_sensor_frames_dropped", "Accepted frames overwritten before anything read them")
+        self.i2cErrors = Metrics.counter("turret_i2c_errors_total", "Failed or short I2C reads", {"device": "person_sensor"})
         
-        self.start()
+        if continuous and frameSource is None:
+            self.start()
         
     
+    def setLens(self, lens):
+        self.lens = lens
+        self.adjustedCentre = list(lens.centre) # Face offsets are measured from the optical axis
+    
     def start(self):
         self.continousEnabled = True
         Thread(target=self.continousUpdate, args=(), daemon=True).start()
@@ -61,82 +298,153 @@ class PersonSensor:
         self.continousEnabled = False
     
     def continousUpdate(self):
+        # Poll at the rate the sensor produces results, rather than re-reading the same result
+        scheduler = LoopScheduler(1 / self.PERSON_SENSOR_DELAY)
         while self.continousEnabled:
-            self.faces = self.update()
-            #time.sleep(self.PERSON_SENSOR_DELAY)
-            
-    def update(self):
+            scheduler.beginTick()
+            faces = self.read()
+            if self.lastStatus == self.decoder.ACCEPTED:
+                # Rejected and repeated frames are never published, so they can't cause a re-aim
+                self.frames.put(() if faces == -1 else faces)
+                self.framesDropped.set(self.frames.dropped)
+            scheduler.waitNext()
+    
+    def read(self):
         """
-        Grabs data and creates an array of faces (dictionaries), the array is saved to self.faces and returned by the function
+        Reads, checks and decodes one result frame. The result of the check is left in self.lastStatus.
         
-        Parameters:
-            NONE
         Returns:
             When faces are detected:
-                Array of faces
-            WHen no faces are detected:
+                Tuple of Face records
+            When no faces are detected, the frame was corrupt, or it repeats the last one (no new frame yet):
                 -1
         """
-        attemptingConnection = True
-        while attemptingConnection:
+        if self.frameSource is not None:
+            raise RuntimeError("PersonSensor takes its frames from a sensor process, it can't read the sensor itself, use takeFaces()")
+        while True:
             try:
-                read_bytes = self.i2c_handle.read(self.PERSON_SENSOR_RESULT_BYTE_COUNT)
-                break
+                count = self.bus.run(lambda: self.i2c_handle.readinto(self.decoder.buffer), PRIORITY_SENSOR, "person_sensor")
+                if count == self.PERSON_SENSOR_RESULT_BYTE_COUNT:
+                    if self.recorder is not None:
+                        self.recorder.frame(self.decoder.buffer)
+                    break
+                print("Short read from person sensor (%s bytes)" % count)
+                self.i2cErrors.inc()
             except OSError as error:
                 print("No person sensor data found")
                 print(error)
-                time.sleep(self.PERSON_SENSOR_DELAY)
-        offset = 0
-        (pad1, pad2, payload_bytes) = struct.unpack_from(self.PERSON_SENSOR_I2C_HEADER_FORMAT, read_bytes, offset)
-        offset = offset + self.PERSON_SENSOR_I2C_HEADER_BYTE_COUNT
-
-        (num_faces) = struct.unpack_from("B", read_bytes, offset)
-        num_faces = int(num_faces[0])
-        offset = offset + 1
-
-        faces = []
-        for i in range(num_faces):
-            (box_confidence, box_left, box_top, box_right, box_bottom, id_confidence, id, is_facing) = struct.unpack_from(self.PERSON_SENSOR_FACE_FORMAT, read_bytes, offset)
-            offset = offset + self.PERSON_SENSOR_FACE_BYTE_COUNT
-            
-            # Centre coordinates of the face boundary box
-            x = box_left + (box_right - box_left)
-            y = box_top + (box_bottom - box_top)
-            # Coordinate offset of face centre
-            x2 = x - (((self.sensorCutoff[0][1] - self.sensorCutoff[0][0]) / 2) + self.sensorCutoff[0][0])
-            y2 = y - (((self.sensorCutoff[1][1] - self.sensorCutoff[1][0]) / 2) + self.sensorCutoff[1][0])
-            face = {
-                "box_confidence": box_confidence,
-                "box_left": box_left,
-                "box_top": box_top,
-                "box_right": box_right,
-                "box_bottom": box_bottom,
-                "box_centre": [x, y],
-                "from_centre": [x2, y2],
-                "id_confidence": id_confidence,
-                "id": id,
-                "is_facing": is_facing,
-            }
-            faces.append(face)
-        #print(faces)
+                self.i2cErrors.inc()
+            Hardware.sleep(self.PERSON_SENSOR_DELAY)
+        
+        self.lastStatus = self.decoder.check()
+        self.frameCounts[self.lastStatus].inc()
+        if self.lastStatus != self.decoder.ACCEPTED:
+            # Handing back a repeated frame's faces would make relative moves like fromCentre() re-aim on every poll
+            return -1
+        
+        faces = self.decoder.decode()
+        self.lastFaces = faces if faces else -1
+        return self.lastFaces
+    
+    def getFrameStats(self):
+        """
+        Returns:
+            Counts of accepted, rejected (bad checksum), duplicate and dropped (never read) frames.
+            With a frameSource the frames are checked in the sensor process, rejected and duplicate are None.
+        """
+        if self.frameSource is not None:
+            stats = {"accepted": self.frameSource.getStats()["frames"], "rejected": None, "duplicate": None}
+        else:
+            stats = self.decoder.getStats()
+        stats["dropped"] = self.frames.dropped
+        return stats
             
-        if (num_faces > 0):
-            return faces#getFaceCoords(faces[0])
-        return -1
+    def update(self):
+        """
+        Grabs data and creates an array of faces, the array is returned by the function
         
-        #checksum = struct.unpack_from("H", read_bytes, offset)
+        Parameters:
+            NONE
+        Returns:
+            When faces are detected:
+                Tuple of Face records (list of dictionaries if dictFaces is set)
+            WHen no faces are detected:
+                -1
+        """
+        if self.frameSource is not None:
+            # The sensor process does the reading, hand back its newest frame not already taken
+            return self.present(self.takeFaces())
+        return self.present(self.read())
     
-    def getFaces(self):
-        if self.continousEnabled:
-            faces = self.faces
-            self.faces = -1
+    def present(self, faces):
+        # Converts Face records into the original dictionary format when it's been asked for
+        if faces == -1 or not self.dictFaces:
             return faces
+        return [self.faceToDict(face) for face in faces]
+    
+    def faceToDict(self, face):
+        """
+        Returns:
+            The face in the original dictionary format
+        """
+        return {
+            "box_confidence": face.box_confidence,
+            "box_left": face.box_left,
+            "box_top": face.box_top,
+            "box_right": face.box_right,
+            "box_bottom": face.box_bottom,
+            "box_centre": self.faceCentre(face),
+            "from_centre": self.faceFromCentre(face),
+            "id_confidence": face.id_confidence,
+            "id": face.id,
+            "is_facing": face.is_facing,
+        }
+    
+    def faceCentre(self, face):
+        # Centre coordinates of the face boundary box
+        x = (face.box_left + face.box_right) / 2
+        y = (face.box_top + face.box_bottom) / 2
+        return [x, y]
+    
+    def faceFromCentre(self, face):
+        # Coordinate offset of face centre from the optical axis
+        x, y = self.faceCentre(face)
+        return [x - self.adjustedCentre[0], y - self.adjustedCentre[1]]
+    
+    def takeFaces(self):
+        """
+        Returns:
+            The Face records of the newest frame not already taken, or -1
+        """
+        if self.continousEnabled or self.frameSource is not None:
+            frame = self.frames.latest(self.takenSeq)
+            if frame is None:
+                return -1
+            self.takenSeq = frame.seq
+            return frame.data if frame.data else -1
             
         else:
-            return self.update()
+            return self.read()
+    
+    def waitForFrame(self, timeout = None):
+        """
+        Blocks until a frame newer than the last one taken arrives (needs continuous mode or a frame source).
+        
+        Parameters:
+            timeout (float): Longest time to wait (seconds), None waits forever.
+        Returns:
+            FrameQueue.SensorFrame (seq, timestamp, faces), None if the timeout expired
+        """
+        frame = self.frames.next(self.takenSeq, timeout)
+        if frame is not None:
+            self.takenSeq = frame.seq
+        return frame
+    
+    def getFaces(self):
+        return self.present(self.takeFaces())
     
     def getLargestFace(self, confidence = -1, uniqueValues = False):
-        faces = self.getFaces()
+        faces = self.takeFaces()
             
         if (faces == -1):
             if uniqueValues:
@@ -154,22 +462,72 @@ class PersonSensor:
         return value
     
     def getMostConfident(self, confidence = -1, uniqueValues = False):
-        faces = self.getFaces()
+        faces = self.takeFaces()
         
         if (faces == -1):
             if uniqueValues:
                 return -1, False
             return -1
         
-        for i in range(len(faces)):
-            print()
+        value = self.getAngleEstimation(self.findMostConfidentFace(faces, confidence))
+        
+        if uniqueValues:
+            if (value != self.previousValue):
+                self.previousValue = value
+                return value, True
+            self.previousValue = value
+            return value, False
+        return value
+    
+    def getAllFaces(self):
+        """
+        Returns:
+            The newest frame's Face records (empty when there are none), for tracking every target at once
+        """
+        faces = self.takeFaces()
+        if (faces == -1):
+            return ()
+        return faces
+    
+    def faceAngles(self, face):
+        """
+        Returns:
+            Estimated [x,y] angle offset of a face from the centre of view
+        """
+        return self.getAngleEstimation(self.faceFromCentre(face))
+    
+    def findMostConfidentFace(self, faces, confidence = -1):
+        """
+        Takes an array of faces and returns the centre offset of the face with the highest box confidence.
+        
+        Parameters:
+            Array of faces (Face records or dictionaries)
+        Returns:
+            When there are faces:
+                The centre offset of the most confident face
+            When there are no faces:
+                -1
+        """
+        best = None
+        for face in faces:
+            if isinstance(face, dict):
+                face = Face(*[face[field] for field in Face._fields])
+            if (self.isFriend(face)):
+                continue
+            if (confidence != -1 and face.box_confidence < confidence):
+                continue
+            if (best is None or face.box_confidence > best.box_confidence):
+                best = face
+        if (best is not None):
+            return self.faceFromCentre(best)
+        return -1
             
     def findLargestFace(self, faces, confidence = -1):
         """
-        Takes an array of faces and returns the face with the largest box area.
+        Takes an array of faces and returns the centre offset of the face with the largest box area.
         
         Parameters:
-            Array of faces
+            Array of faces (Face records or dictionaries)
         Returns:
             When there are faces:
                 The face with the largest box area
@@ -177,28 +535,32 @@ class PersonSensor:
                 -1
         """
         max = -1
-        index = -1
-        for i in range(len(faces)):
-            area = ( faces[i]["box_right"] - faces[i]["box_left"] ) * ( faces[i]["box_bottom"] -  faces[i]["box_top"])
+        largest = None
+        for face in faces:
+            if isinstance(face, dict):
+                face = Face(*[face[field] for field in Face._fields])
+            if (self.isFriend(face)):
+                continue
+            area = ( face.box_right - face.box_left ) * ( face.box_bottom - face.box_top )
             if (max < area):
-                if (confidence != -1):
-                    if (faces[i]["box_confidence"] >= confidence):
-                        max = area
-                        index = i
-                else:
+                if (confidence == -1 or face.box_confidence >= confidence):
                     max = area
-                    index = i
-        if (index > -1): # Sanity check
-            return faces[index]["from_centre"]
+                    largest = face
+        if (largest is not None): # Sanity check
+            return self.faceFromCentre(largest)
         return -1
     
+    def isFriend(self, face):
+        # There are no tracks here, so each face is remembered by the id the sensor gives it
+        if (self.identities is None or face.id < 0):
+            return False
+        return self.identities.observe(face.id, face) == self.identities.FRIEND
+    
     def getAngleEstimation(self, coords):
-        # Estimated x/y angle offset of face centre
+        # Estimated x/y angle offset of face centre, from the lens table
         if (coords == -1):
             return -1
-        x = int (coords[0] * self.fovScale[0])
-        y = int (coords[1] * self.fovScale[1])
-        return [x,y]
+        return self.lens.angles(coords[0] + self.adjustedCentre[0], coords[1] + self.adjustedCentre[1])
 
 def main():
     ps = PersonSensor()
@@ -0,0 +1,205 @@
+from collections import deque, namedtuple
+from threading import Thread
+from FrameQueue import FrameQueue
+from Hardware import timer
+import Hardware
+import Metrics
+
+# One range measurement with the filtered values as of that measurement (mm). The distance is None when
+# nothing was in range, the filtered values only ever include in-range readings so they hold the last ones
+RangeReading = namedtuple("RangeReading", ["distance", "median", "ema"])
+
+
+class RangeSampler:
+    """
+    Runs the VL53L0X in continuous mode on a background thread and keeps its readings,
+    so nothing else ever has to wait for a ranging cycle.
+
+    Each reading is published to a FrameQueue with its timestamp, along with a median and an exponential
+    moving average of the recent in-range readings. The latest values are a lookup, and the ring of readings
+    lets a range be interpolated to the time of a sensor frame.
+    """
+
+    # Timing budget (microseconds) and return signal rate limit (MCPS) of each preset,
+    # a longer budget gives more accurate ranges at a lower sample rate
+    PRESETS = {
+        "high_speed": (20000, 0.25),
+        "default": (33000, 0.25),
+        "high_accuracy": (200000, 0.25),
+        "long_range": (33000, 0.1),
+    }
+
+    def __init__(self, lidar, preset = "default", window = 5, smoothing = 0.3, bufferSize = 64, maxRange = 2000, start = True):
+        """
+        Parameters:
+            lidar (VL53L0X): The range sensor, from Hardware.rangeSensor().
+            preset (str): One of PRESETS.
+            window (int): Number of in-range readings the median is taken over.
+            smoothing (float): Weight of each new reading in the moving average, between 0 and 1.
+            bufferSize (int): Number of readings kept for distanceAt().
+            maxRange (float): Readings beyond this (mm) count as nothing in range, the sensor reports 8190 or more when it sees nothing.
+            start (bool): Start the sampling thread, otherwise call sampleOnce() yourself (e.g. from a simulation).
+        """
+        self.lidar = lidar
+        self.window = deque(maxlen=window)
+        self.smoothing = smoothing
+        self.maxRange = maxRange
+        self.readings = FrameQueue(bufferSize)
+        self.ema = None
+        self.enabled = False
+        self.pendingPreset = None
+        self.recorder = None # FlightRecorder logging every raw reading
+        self.i2cErrors = Metrics.counter("turret_i2c_errors_total", "Failed or short I2C reads", {"device": "vl53l0x"})
+
+        self.samples = 0
+        self.outOfRange = 0
+        self.errors = 0
+
+        self.applyPreset(preset)
+        if start:
+            self.start()
+
+
+    def applyPreset(self, preset):
+        budget, signalRateLimit = self.PRESETS[preset]
+        self.lidar.measurement_timing_budget = budget
+        self.lidar.signal_rate_limit = signalRateLimit
+        self.preset = preset
+        self.budget = budget / 1e6
+
+
+    def setPreset(self, preset):
+        """
+        Changes the timing budget, the sampling thread applies it before its next reading.
+        """
+        if preset not in self.PRESETS:
+            raise ValueError("Unknown range preset %s, expected one of %s" % (preset, list(self.PRESETS)))
+        if self.enabled:
+            self.pendingPreset = preset
+        else:
+            self.applyPreset(preset)
+
+
+    def start(self):
+        self.enabled = True
+        Thread(target=self.sampleLoop, args=(), daemon=True).start()
+
+
+    def stop(self):
+        self.enabled = False
+
+
+    def sampleLoop(self):
+        self.lidar.start_continuous()
+        try:
+            while self.enabled:
+                if self.pendingPreset is not None:
+                    # The budget can't change while the sensor is ranging
+                    self.lidar.stop_continuous()
+                    self.applyPreset(self.pendingPreset)
+                    self.pendingPreset = None
+                    self.lidar.start_continuous()
+                self.sampleOnce()
+        finally:
+            self.lidar.stop_continuous()
+
+
+    def sampleOnce(self):
+        """
+        Waits for the sensor's next reading and records it.
+
+        Returns:
+            The RangeReading, None if the sensor didn't respond
+        """
+        try:
+            distance = self.lidar.range
+        except (OSError, RuntimeError) as error:
+            print("No VL53L0X data found")
+            print(error)
+            self.errors += 1
+            self.i2cErrors.inc()
+            if self.recorder is not None:
+                self.recorder.range(None)
+            Hardware.sleep(self.budget)
+            return None
+        # The range is measured over the whole timing budget, so time it at the middle
+        return self.addReading(distance, timer() - self.budget / 2)
+
+
+    def addReading(self, distance, timestamp):
+        """
+        Filters and publishes a reading.
+
+        Returns:
+            The RangeReading
+        """
+        self.samples += 1
+        if self.recorder is not None:
+            self.recorder.range(distance, timestamp)
+        if distance >= self.maxRange:
+            self.outOfRange += 1
+            distance = None
+        else:
+            self.window.append(distance)
+            self.ema = distance if self.ema is None else self.ema + self.smoothing * (distance - self.ema)
+
+        median = None
+        if self.window:
+            ordered = sorted(self.window)
+            middle = len(ordered) // 2
+            median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+        reading = RangeReading(distance, median, self.ema)
+        self.readings.put(reading, timestamp)
+        return reading
+
+
+    def latest(self):
+        """
+        Returns:
+            The newest SensorFrame, its data is a RangeReading, None before the first reading
+        """
+        return self.readings.latest()
+
+
+    def getDistance(self, filtered = "median"):
+        """
+        Parameters:
+            filtered (str): "median", "ema" or "distance" for the raw reading.
+        Returns:
+            The latest range (mm) without waiting, None if there hasn't been one in range
+        """
+        frame = self.readings.latest()
+        if frame is None:
+            return None
+        return getattr(frame.data, filtered)
+
+
+    def distanceAt(self, timestamp, filtered = "median"):
+        """
+        Parameters:
+            timestamp (float): Time to estimate the range at, e.g. the capture time of a Person Sensor frame.
+            filtered (str): "median", "ema" or "distance" for the raw readings.
+        Returns:
+            The range (mm) linearly interpolated between the readings either side of the time, the nearest reading
+            when the time is outside the buffer or only one side is in range, None if neither is
+        """
+        before, after = self.readings.bracket(timestamp)
+        beforeValue = getattr(before.data, filtered) if before is not None else None
+        afterValue = getattr(after.data, filtered) if after is not None else None
+        if beforeValue is None:
+            return afterValue
+        if afterValue is None:
+            return beforeValue
+        fraction = (timestamp - before.timestamp) / (after.timestamp - before.timestamp)
+        return beforeValue + fraction * (afterValue - beforeValue)
+
+
+    def getStats(self):
+        return {
+            "preset": self.preset,
+            "samples": self.samples,
+            "out_of_range": self.outOfRange,
+            "errors": self.errors,
+            "nominal_rate": 1 / self.budget,
+        }
@@ -1,33 +1,98 @@
 from PersonSensor import PersonSensor
-from LIDAR import VL53L0X
+from RangeSampler import RangeSampler
+from SensorProcess import SensorProcess
+from Hardware import timer
+import Calibration
+import Hardware
+import Metrics
 
 class SensorHandler:
     """
     This class handles the sensors...
     """
     
-    def __init__(self):
+    def __init__(self, rangePreset = "default", separateProcess = False, verifyChecksum = None):
         
-        # Setup VL53L0X
-        print("Setting up VL53L0X...")        
-        self._lidar = VL53L0X()
+        # Corrupt Person Sensor frames are only dropped when the calibration profile (or the caller) asks for it
+        if verifyChecksum is None:
+            verifyChecksum = Calibration.load().verifyChecksum()
         
-        # Setup Person Sensor
-        self._personSensor = PersonSensor()
+        # Optionally read both sensors in a child process, so their I2C reads and decoding stay off the control loop
+        self._process = SensorProcess(rangePreset=rangePreset, verifyChecksum=verifyChecksum) if separateProcess else None
+        
+        # Setup VL53L0X, it ranges continuously in the background, and the Person Sensor, both at once
+        factories = {"personSensor": lambda: PersonSensor(verifyChecksum=verifyChecksum, frameSource=self._process)}
+        if self._process is None:
+            print("Setting up VL53L0X and Person Sensor...")
+            factories["lidar"] = Hardware.rangeSensor
+        devices, self.startupTimes = Hardware.initialise(**factories)
+        
+        self._ranger = None
+        if self._process is None:
+            self._lidar = devices["lidar"]
+            self._ranger = RangeSampler(self._lidar, rangePreset)
+        self._personSensor = devices["personSensor"]
+        
+        # Instrumentation, see Metrics.py
+        self._distanceAge = Metrics.histogram("turret_distance_age_seconds", "Age of the range reading getDistance() returned")
+        self._noDistance = Metrics.counter("turret_distance_missing_total", "getDistance() calls with nothing in range")
         
         print("Setup complete.")
     
-    def getDistance(self):
-        # Return distance in mm
-        return self._lidar.range
+    def getDistance(self, filtered = "median"):
+        # Return the latest distance in mm without waiting for a measurement, None until something is in range
+        if self._process is not None:
+            reading = self._process.latestRange()
+        else:
+            frame = self._ranger.latest()
+            reading = None if frame is None else (frame.timestamp, frame.data)
+        distance = None if reading is None else getattr(reading[1], filtered)
+        
+        if Metrics.registry.enabled:
+            if reading is not None:
+                self._distanceAge.record(timer() - reading[0])
+            if distance is None:
+                self._noDistance.inc()
+        return distance
+    
+    def getDistanceAt(self, timestamp, filtered = "median"):
+        # Return the distance in mm at a given time, e.g. when a face was seen
+        if self._process is not None:
+            return self._process.distanceAt(timestamp, filtered)
+        return self._ranger.distanceAt(timestamp, filtered)
+    
+    def setRangePreset(self, preset):
+        if self._process is not None:
+            self._process.setRangePreset(preset)
+        else:
+            self._ranger.setPreset(preset)
     
     def getFaceFromCentre(self, confidence = 95, uniqueValues = True):
         return self._personSensor.getLargestFace(confidence, uniqueValues)
 
+    def stop(self):
+        if self._process is not None:
+            self._process.stop()
+        else:
+            self._ranger.stop()
+            self._personSensor.stop()
+
     def continuousDistance(self):
-        with self._lidar.continuous_mode():
+        if self._process is not None:
+            # The child process does the ranging, print each new reading in its ring as it arrives
+            timestamp = None
             while True:
-                print("Range: {0}mm".format(self._lidar.range))
+                reading = self._process.latestRange()
+                if reading is not None and reading[0] != timestamp:
+                    timestamp = reading[0]
+                    print("Range: {0}mm".format(reading[1].distance))
+                Hardware.sleep(0.005)
+        
+        seq = None
+        while True:
+            frame = self._ranger.readings.next(seq)
+            seq = frame.seq
+            print("Range: {0}mm".format(frame.data.distance))
 
 def main():
     sensorHandler = SensorHandler()
@@ -0,0 +1,384 @@
+"""
+Sensor acquisition in a separate process.
+
+The child process polls the Person Sensor (and ranges with the VL53L0X) and publishes each decoded frame into a
+ring buffer in shared memory. The control process reads frames straight out of the shared memory, so the sensor
+I2C reads and decode work never hold the control loop's GIL. A supervisor thread restarts the child if it dies or
+stops publishing heartbeats, e.g. when the sensor stops responding.
+
+The child has its own BusManager, so its reads are no longer prioritised behind servo writes; the kernel's I2C
+driver still keeps the two processes' transactions from interleaving.
+
+    sensors = SensorProcess()
+    personSensor = PersonSensor(frameSource=sensors)
+"""
+
+from collections import namedtuple
+from FrameQueue import SensorFrame
+from multiprocessing import shared_memory
+from PersonSensor import PersonSensorDecoder, Face
+import Hardware
+import math
+import multiprocessing
+import struct
+import threading
+import time
+
+# Latest values of a range reading, as published by the child
+RangeValues = namedtuple("RangeValues", ["distance", "median", "ema"])
+
+
+class SharedRing:
+    """
+    Fixed-size records in a shared memory ring buffer, written by one process and read by any number of others.
+
+    Every slot is guarded by a seqlock, no locks are taken: the writer makes the slot's counter odd while it writes
+    and sets it to twice the record's sequence number when it's done, and a reader that sees the counter change
+    under it (or odd) reads again. CPython gives no memory barriers, but the interpreter's own work between the
+    counter and data writes keeps the window far wider than the hardware could reorder across.
+    """
+
+    HEADER = struct.Struct("<Qd") # Newest sequence number, writer heartbeat (time.monotonic())
+    SLOT = struct.Struct("<Qd") # Seqlock counter, record timestamp
+    MAX_RETRIES = 1000
+
+    def __init__(self, recordFormat, slots = 16, name = None):
+        """
+        Parameters:
+            recordFormat (str): struct format of one record.
+            slots (int): Number of records kept.
+            name (str): Name of an existing ring to attach to, None creates a new one.
+        """
+        self.record = struct.Struct(recordFormat)
+        self.recordFormat = recordFormat
+        self.slots = slots
+        self.slotSize = self.SLOT.size + self.record.size
+        self.slotSize += -self.slotSize % 8 # Keep the counters aligned
+        size = self.HEADER.size + slots * self.slotSize
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.buffer = self.memory.buf
+        if name is None:
+            self.buffer[:size] = bytes(size)
+        self.retries = 0 # Reads that had to be repeated because the writer got in the way
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def offset(self, seq):
+        return self.HEADER.size + (seq % self.slots) * self.slotSize
+
+    def newest(self):
+        return self.HEADER.unpack_from(self.buffer, 0)[0]
+
+    def heartbeat(self):
+        return self.HEADER.unpack_from(self.buffer, 0)[1]
+
+    def beat(self):
+        self.HEADER.pack_into(self.buffer, 0, self.newest(), time.monotonic())
+
+    def publish(self, values, timestamp):
+        """
+        Writes a record. Only one process may publish to a ring.
+
+        Returns:
+            The record's sequence number
+        """
+        seq = self.newest() + 1
+        offset = self.offset(seq)
+        self.SLOT.pack_into(self.buffer, offset, 2 * seq - 1, timestamp)
+        self.record.pack_into(self.buffer, offset + self.SLOT.size, *values)
+        self.SLOT.pack_into(self.buffer, offset, 2 * seq, timestamp)
+        self.HEADER.pack_into(self.buffer, 0, seq, time.monotonic())
+        return seq
+
+    def read(self, seq):
+        """
+        Returns:
+            (timestamp, record values) of the record, None if it has been overwritten or not written yet
+        """
+        offset = self.offset(seq)
+        for _ in range(self.MAX_RETRIES):
+            before, timestamp = self.SLOT.unpack_from(self.buffer, offset)
+            if before != 2 * seq:
+                if before == 2 * seq - 1:
+                    self.retries += 1
+                    continue # Being written right now
+                return None
+            values = self.record.unpack_from(self.buffer, offset + self.SLOT.size)
+            if self.SLOT.unpack_from(self.buffer, offset)[0] == before:
+                return timestamp, values
+            self.retries += 1
+        return None # The writer died part way through it
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+FACES_FORMAT = "<B" + PersonSensorDecoder.FACE.format.lstrip("<@=!>") * PersonSensorDecoder.FACE_MAX
+RANGE_FORMAT = "<ddd"
+
+
+def encodeFaces(faces):
+    values = [len(faces)]
+    for i in range(PersonSensorDecoder.FACE_MAX):
+        values.extend(faces[i] if i < len(faces) else (0,) * len(Face._fields))
+    return values
+
+
+def decodeFaces(values):
+    fields = len(Face._fields)
+    return tuple(Face._make(values[1 + i * fields:1 + (i + 1) * fields]) for i in range(values[0]))
+
+
+def acquire(facesName, rangesName, slots, rangePreset, stopEvent, setup = None, verifyChecksum = False):
+    """
+    Body of the child process.
+    """
+    if setup is not None:
+        setup()
+    from PersonSensor import PersonSensor
+    from LoopScheduler import LoopScheduler
+
+    faces = SharedRing(FACES_FORMAT, slots, facesName)
+    sensor = PersonSensor(continuous=False, verifyChecksum=verifyChecksum)
+
+    ranger = None
+    if rangesName is not None:
+        from RangeSampler import RangeSampler
+        ranges = SharedRing(RANGE_FORMAT, slots, rangesName)
+        ranger = RangeSampler(Hardware.rangeSensor(), rangePreset, start=False)
+        ranger.readings.addListener(lambda frame: ranges.publish(
+            [math.nan if value is None else value for value in frame.data], frame.timestamp))
+        ranger.start()
+
+    scheduler = LoopScheduler(1 / sensor.PERSON_SENSOR_DELAY)
+    while not stopEvent.is_set():
+        scheduler.beginTick()
+        result = sensor.read()
+        faces.beat()
+        if sensor.lastStatus == sensor.decoder.ACCEPTED:
+            faces.publish(encodeFaces(() if result == -1 else result), Hardware.timer())
+        scheduler.waitNext()
+
+    if ranger is not None:
+        ranger.stop()
+
+
+class SensorProcess:
+    """
+    Runs and supervises the acquisition process, and reads its frames.
+
+    latest() and next() work like FrameQueue's, so a PersonSensor can take its frames from here.
+    Frame timestamps come from the child's Hardware.timer(), which is the system-wide monotonic clock on Linux.
+    """
+
+    def __init__(self, lidar = True, rangePreset = "default", slots = 16, heartbeatTimeout = 2, restartDelay = 1, setup = None, start = True,
+            verifyChecksum = False):
+        """
+        Parameters:
+            lidar (bool): Range with the VL53L0X in the child as well.
+            rangePreset (str): RangeSampler preset for the VL53L0X.
+            slots (int): Frames kept in each shared ring.
+            heartbeatTimeout (float): Time without a heartbeat before the child is restarted (seconds).
+            restartDelay (float): Pause before restarting a failed child (seconds).
+            setup (function): Picklable function the child calls first, e.g. to choose a Hardware backend.
+            start (bool): Start the child and the supervisor now.
+            verifyChecksum (bool): Have the child drop Person Sensor frames whose checksum doesn't match.
+        """
+        self.faces = SharedRing(FACES_FORMAT, slots)
+        self.ranges = SharedRing(RANGE_FORMAT, slots) if lidar else None
+        self.slots = slots
+        self.rangePreset = rangePreset
+        self.heartbeatTimeout = heartbeatTimeout
+        self.restartDelay = restartDelay
+        self.setup = setup
+        self.verifyChecksum = verifyChecksum
+        self.context = multiprocessing.get_context("spawn") # Forking would copy the parent's threads' locks mid-use
+        self.stopEvent = self.context.Event()
+        self.process = None
+        self.supervisor = None
+        self.running = False
+        self.restarts = 0
+        self.restartRequested = False
+        self.lastTaken = 0
+        self.dropped = 0 # Frames published that nothing here read
+        if start:
+            self.start()
+
+    def launch(self):
+        self.stopEvent.clear()
+        self.process = self.context.Process(target=acquire, daemon=True, args=(
+            self.faces.name, self.ranges.name if self.ranges is not None else None,
+            self.slots, self.rangePreset, self.stopEvent, self.setup, self.verifyChecksum))
+        self.process.start()
+        self.launchedAt = time.monotonic()
+
+    def start(self):
+        self.running = True
+        self.launch()
+        self.supervisor = threading.Thread(target=self.supervise, args=(), daemon=True)
+        self.supervisor.start()
+
+    def stop(self):
+        self.running = False
+        self.stopEvent.set()
+        if self.supervisor is not None:
+            self.supervisor.join()
+        if self.process is not None:
+            self.process.join(self.heartbeatTimeout)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        for ring in (self.faces, self.ranges):
+            if ring is not None:
+                ring.close()
+                ring.unlink()
+
+    def alive(self):
+        """
+        Returns:
+            True if the child is running and has sent a heartbeat recently
+        """
+        if self.process is None or not self.process.is_alive():
+            return False
+        lastBeat = max(self.faces.heartbeat(), self.launchedAt)
+        return time.monotonic() - lastBeat < self.heartbeatTimeout
+
+    def supervise(self):
+        while self.running:
+            time.sleep(min(0.2, self.heartbeatTimeout / 4))
+            if not self.running or self.alive():
+                continue
+            if self.restartRequested:
+                self.restartRequested = False
+                self.process.join()
+                self.launch()
+                continue
+            if self.process.is_alive():
+                print("Sensor process stopped responding, restarting it")
+                self.process.terminate()
+            else:
+                print("Sensor process exited (%s), restarting it" % self.process.exitcode)
+            self.process.join()
+            time.sleep(self.restartDelay)
+            if self.running:
+                self.restarts += 1
+                self.launch()
+
+    def frame(self, seq):
+        record = self.faces.read(seq)
+        if record is None:
+            return None
+        return SensorFrame(seq, record[0], decodeFaces(record[1]))
+
+    def take(self, frame):
+        # Every frame published since the last one taken that wasn't read now never will be
+        if frame.seq > self.lastTaken:
+            self.dropped += frame.seq - self.lastTaken - 1
+            self.lastTaken = frame.seq
+
+    def latest(self, afterSeq = None):
+        """
+        Returns:
+            The newest SensorFrame of faces, None if there isn't one (newer than afterSeq)
+        """
+        while True:
+            seq = self.faces.newest()
+            if seq == 0 or (afterSeq is not None and seq <= afterSeq):
+                return None
+            frame = self.frame(seq)
+            if frame is not None:
+                self.take(frame)
+                return frame
+
+    def next(self, afterSeq = None, timeout = None):
+        """
+        Waits for the frame after afterSeq, polling the ring.
+
+        Returns:
+            The oldest frame newer than afterSeq still held, None if the timeout expired
+        """
+        if afterSeq is None:
+            afterSeq = self.lastTaken
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            newest = self.faces.newest()
+            if newest > afterSeq:
+                frame = self.frame(max(afterSeq + 1, newest - self.slots + 1))
+                if frame is not None:
+                    self.take(frame)
+                    return frame
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(0.002)
+
+    def latestRange(self):
+        """
+        Returns:
+            (timestamp, RangeValues) of the newest range reading, None if there isn't one. Values are None when out of range.
+        """
+        if self.ranges is None:
+            return None
+        while True:
+            seq = self.ranges.newest()
+            if seq == 0:
+                return None
+            record = self.ranges.read(seq)
+            if record is not None:
+                return record[0], RangeValues(*[None if math.isnan(value) else value for value in record[1]])
+
+    def getDistance(self, filtered = "median"):
+        reading = self.latestRange()
+        return None if reading is None else getattr(reading[1], filtered)
+
+    def distanceAt(self, timestamp, filtered = "median"):
+        """
+        As RangeSampler.distanceAt(), over the readings still in the ring.
+        """
+        if self.ranges is None:
+            return None
+        newest = self.ranges.newest()
+        before = after = None
+        for seq in range(newest, max(0, newest - self.slots), -1):
+            record = self.ranges.read(seq)
+            if record is None:
+                break
+            value = record[1][RangeValues._fields.index(filtered)]
+            if record[0] <= timestamp:
+                before = (record[0], value)
+                break
+            after = (record[0], value)
+
+        beforeValue = None if before is None or math.isnan(before[1]) else before[1]
+        afterValue = None if after is None or math.isnan(after[1]) else after[1]
+        if beforeValue is None:
+            return afterValue
+        if afterValue is None:
+            return beforeValue
+        fraction = (timestamp - before[0]) / (after[0] - before[0])
+        return beforeValue + fraction * (afterValue - beforeValue)
+
+    def setRangePreset(self, preset):
+        """
+        Changes the VL53L0X preset by restarting the child with it.
+        """
+        self.rangePreset = preset
+        if self.process is not None and self.process.is_alive():
+            self.restartRequested = True # Not a failure
+            self.process.terminate()
+
+    def getStats(self):
+        return {
+            "alive": self.alive(),
+            "restarts": self.restarts,
+            "frames": self.faces.newest(),
+            "ranges": self.ranges.newest() if self.ranges is not None else 0,
+            "read_retries": self.faces.retries + (self.ranges.retries if self.ranges is not None else 0),
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,169 @@
+from Hardware import timer
+import numpy as np
+
+class ServoBank:
+    """
+    Holds the motion state of several CustomServo.Servo objects in contiguous NumPy arrays,
+    so every channel can be stepped with a single vectorised update.
+
+    Servos added to a bank keep working as normal, their motion attributes just read and write the bank's arrays.
+    Each servo's planned MotionProfile is copied into fixed-width segment arrays so every profile can be evaluated at once.
+    """
+
+    MAX_SEGMENTS = 8
+
+    # Below this many channels the NumPy call overhead costs more than it saves and update() steps them one at a
+    # time instead, BenchServoBank.py puts the crossover between 32 and 48 channels
+    SCALAR_CHANNELS = 40
+
+    DTYPES = {
+        "dom": np.float64,
+        "minAngle": np.float64,
+        "maxAngle": np.float64,
+        "maxSpeed": np.float64,
+        "invert": np.bool_,
+        "acceleration": np.float64,
+        "currentSpeed": np.float64,
+        "currentAngle": np.float64,
+        "targetAngle": np.float64,
+        "atPos": np.bool_,
+        "arrivalTime": np.float64,
+    }
+
+    # Columns of the segment arrays, matching the MotionProfile segment tuples
+    SEGMENT_FIELDS = ("segmentStart", "segmentPosition", "segmentSpeed", "segmentAcceleration", "segmentJerk")
+
+    def __init__(self, servos = ()):
+        """
+        Bank setup.
+
+        Parameters:
+            servos (list of CustomServo.Servo): Servos to add to the bank.
+        """
+        self.servos = []
+        self.resting = True # Whether every servo was at rest after the last update(), kept without an array reduction
+        for field, dtype in self.DTYPES.items():
+            setattr(self, field, np.zeros(0, dtype=dtype))
+        for field in self.SEGMENT_FIELDS:
+            setattr(self, field, np.zeros((0, self.MAX_SEGMENTS)))
+
+        for servo in servos:
+            self.add(servo)
+
+
+    def add(self, servo):
+        """
+        Moves a servo's motion state into the bank.
+
+        Returns:
+            The servo's index in the bank arrays
+        """
+        if servo.bank is not None:
+            raise ValueError("%s is already in a ServoBank" % servo.name)
+
+        for field, dtype in self.DTYPES.items():
+            array = np.append(getattr(self, field), np.array([getattr(servo, field)], dtype=dtype))
+            setattr(self, field, array)
+            del servo.__dict__[field]
+        for field in self.SEGMENT_FIELDS:
+            setattr(self, field, np.vstack([getattr(self, field), np.zeros((1, self.MAX_SEGMENTS))]))
+
+        servo.bankIndex = len(self.servos)
+        servo.bank = self
+        self.servos.append(servo)
+        self.loadProfile(servo.bankIndex, servo.profile)
+        return servo.bankIndex
+
+
+    def loadProfile(self, index, profile):
+        """
+        Copies a servo's MotionProfile into its row of the segment arrays.
+        """
+        if len(profile.segments) > self.MAX_SEGMENTS:
+            raise ValueError("Profile has %s segments, ServoBank holds at most %s" % (len(profile.segments), self.MAX_SEGMENTS))
+
+        count = len(profile.segments)
+        for column, field in enumerate(self.SEGMENT_FIELDS):
+            row = getattr(self, field)[index]
+            row[:count] = [segment[column] for segment in profile.segments]
+            row[count:] = np.inf if column == 0 else 0
+
+
+    def __len__(self):
+        return len(self.servos)
+
+
+    def update(self, currentUptime = None):
+        """
+        Moves every servo in the bank to where its planned move says it should be.
+        Produces the same motion as calling Servo.update() on each servo at the same time.
+
+        Parameters:
+            currentUptime (float): Time of the step, defaults to the current timer() value.
+        Returns:
+            Boolean array, True for each servo that is at its target angle
+        """
+        if (currentUptime is None):
+            currentUptime = timer()
+
+        if len(self.servos) < self.SCALAR_CHANNELS:
+            return self.updateScalar(currentUptime)
+
+        moving = np.flatnonzero(~self.atPos)
+        if len(moving) == 0:
+            self.resting = True
+            return self.atPos
+
+        # Find the segment of each moving servo's profile that is active now and evaluate it
+        index = np.count_nonzero(self.segmentStart[moving] <= currentUptime, axis=1) - 1
+        np.maximum(index, 0, out=index)
+        dt = currentUptime - self.segmentStart[moving, index]
+        speed = self.segmentSpeed[moving, index]
+        acceleration = self.segmentAcceleration[moving, index]
+        jerk = self.segmentJerk[moving, index]
+        angle = self.segmentPosition[moving, index] + speed * dt + acceleration * dt * dt / 2 + jerk * dt * dt * dt / 6
+        speed = speed + acceleration * dt + jerk * dt * dt / 2
+        angle = np.clip(angle, self.minAngle[moving], self.maxAngle[moving])
+
+        arrived = self.arrivalTime[moving] <= currentUptime
+        speed[arrived] = 0
+        self.currentAngle[moving] = angle
+        self.currentSpeed[moving] = speed
+        self.atPos[moving] = arrived
+        self.resting = len(moving) == np.count_nonzero(arrived)
+
+        for i, value in zip(moving.tolist(), angle.tolist()):
+            self.servos[i].servo.angle = value # Move servo to currentAngle
+
+        return self.atPos
+
+
+    def updateScalar(self, currentUptime):
+        """
+        update() for a small bank, one servo at a time through its MotionProfile, the same way Servo.update() does.
+        """
+        atPos = self.atPos.tolist()
+        if all(atPos):
+            self.resting = True
+            return self.atPos
+
+        minAngle = self.minAngle.tolist()
+        maxAngle = self.maxAngle.tolist()
+        arrivalTime = self.arrivalTime.tolist()
+        resting = True
+        for i, servo in enumerate(self.servos):
+            if atPos[i]:
+                continue
+            angle, speed = servo.profile.sample(currentUptime)
+            angle = min(max(angle, minAngle[i]), maxAngle[i])
+            if currentUptime >= arrivalTime[i]:
+                speed = 0
+                self.atPos[i] = True
+            else:
+                resting = False
+            self.currentAngle[i] = angle
+            self.currentSpeed[i] = speed
+            servo.servo.angle = angle # Move servo to currentAngle
+        self.resting = resting
+
+        return self.atPos
@@ -1,51 +1,111 @@
 from CustomServo import Servo
-from adafruit_servokit import ServoKit
+from ServoBank import ServoBank
+from PCA9685Batch import PCA9685Batch
+from Ballistics import BallisticsTable
+from GunTransform import GunTransform
+from FireControl import FireControl
+from MotionProfile import synchronise
+from LoopScheduler import LoopScheduler
+from Metrics import perfTimer
+import Calibration
+import Metrics
 import threading
-from timeit import default_timer as timer
+from Hardware import timer
+import Hardware
 import time
 
 class ServoHandler:
     
-    def __init__(self, debug = False):
-        self.kit = ServoKit(channels=16)
+    def __init__(self, debug = False, updateRate = 100, sCurve = False, start = True, batchWrites = True, ballistics = None, calibration = None):
+        """
+        Servo setup.
+        
+        Parameters:
+            debug (bool): Print the camera target every tick.
+            updateRate (float): Control loop rate (ticks per second).
+            sCurve (bool): Use jerk-limited S-curve profiles for group moves.
+            start (bool): Start the update thread, otherwise call tick() yourself (e.g. from a simulation).
+            batchWrites (bool): Send all the servo positions once per tick in a single I2C block write, instead of one write per servo update.
+            ballistics (BallisticsTable): Drop compensation for moveTurret(), defaults to the cached table for the standard dart.
+            calibration (Calibration.CalibrationProfile): Servo and fire control settings, defaults to Calibration.load().
+        """
+        self.kit = Hardware.servoKit(channels=16)
+        
+        # With batching the servos write into self.pwm, which is flushed at the end of every tick
+        self.pwm = PCA9685Batch(self.kit) if batchWrites else None
+        channels = self.pwm.channels if batchWrites else self.kit.servo
         
         self.debug = debug
+        self.sCurve = sCurve # Use jerk-limited S-curve profiles for group moves
+        
+        # Limits, pulse ranges and adjustments all come from the calibration profile
+        self.calibration = Calibration.load() if calibration is None else calibration
+        def calibratedServo(name):
+            return Servo(channels[self.calibration.channel(name)], name = name, **self.calibration.servoSettings(name))
         
-        self.gunYaw = Servo(self.kit.servo[0], dom=270, minPulse=400, maxPulse=2500, minAngle=0, maxAngle=270, restAngle=135, maxSpeed=250, acceleration=2000, adjustment=-10)
-        self.gunYPitch = Servo(self.kit.servo[1], dom=270, minPulse=400, maxPulse=2500, minAngle=60, maxAngle=120, restAngle=90, maxSpeed=250, acceleration=2000)
+        self.gunYaw = calibratedServo("gunYaw")
+        self.gunYPitch = calibratedServo("gunPitch")
         
-        self._prime = Servo(self.kit.servo[2], dom=180, minPulse=500, maxPulse=2500, minAngle=10, maxAngle=170, restAngle=90, maxSpeed=250, acceleration=2000)
-        self._trigger = Servo(self.kit.servo[3], dom=180, minPulse=500, maxPulse=2500, minAngle=10, maxAngle=170, restAngle=130, maxSpeed=250, acceleration=2000)
+        self._prime = calibratedServo("prime")
+        self._trigger = calibratedServo("trigger")
 
-        self.trackYaw = Servo(self.kit.servo[4], dom=180, minPulse=500, maxPulse=2500, minAngle=10, maxAngle=170, restAngle=90, maxSpeed=250, acceleration=2000, invert=True, name = "trackYaw")
-        self.trackPitch = Servo(self.kit.servo[5], dom=180, minPulse=500, maxPulse=2500, minAngle=10, maxAngle=170, restAngle=90, maxSpeed=250, acceleration=2000, adjustment=20, name = "trackPitch")
+        self.trackYaw = calibratedServo("trackYaw")
+        self.trackPitch = calibratedServo("trackPitch")
+        
+        self.servos = [self.gunYaw, self.gunYPitch, self._prime, self._trigger, self.trackYaw, self.trackPitch]
+        self.aimQuantum = max(self.gunYaw.angleQuantum(), self.gunYPitch.angleQuantum()) # Smallest gun move the PWM outputs
+        self.bank = ServoBank(self.servos) # All servos are stepped together, six are few enough that it's done one by one
+        self.flush()
         
         timerStartValue = timer()
 
-        self._primed = False
-        self.__triggerPull = False
-        self.__triggerDepressionDelay = 0.5
-        self.__triggerPullAngle = 55
-        self.__primeActiveAngle = 50
-        self.__revTimer = timerStartValue
-        self.__triggerReleaseTime = timerStartValue
-        self.__spinupTime = 2
-        self.__maxSpin = False
+        # Flywheels and trigger, its transitions are run by the control loop as they fall due
+        self.fireControl = FireControl(self._prime, self._trigger, **self.calibration.fireControl)
+        
+        # fromCentre() tracking law, see fromCentre()
+        self.trackingGain = self.calibration.tracking.get("gain", 1)
+        self.trackingRateGain = self.calibration.tracking.get("rateGain", 0)
+        self.lastOffset = None # (time, offset) of the last fromCentre() call
 
         self.enabled = False
         self.exit = False
+        self.tracker = None # TargetTracker the camera follows every tick
+        self.recorder = None # FlightRecorder logging every tick
+        
+        self.ballistics = BallisticsTable.cached() if ballistics is None else ballistics
+        self.pitchUp = 1 # Direction the gun pitch servo turns to raise the barrel
         
         self.forwardOffset = 10
         self.rightOffset = 0
         self.heightOffset = 20
         
+        # Camera gimbal position from the gun's pivot, the offsets above are in cm
+        self.gunTransform = GunTransform(
+            cameraOffset=[self.rightOffset * 10, self.forwardOffset * 10, self.heightOffset * 10],
+            cameraZero=[self.trackYaw.restAngle, self.trackPitch.restAngle],
+            gunZero=[self.gunYaw.restAngle, self.gunYPitch.restAngle])
+        
         self.timeAtLastUpdate = timerStartValue
-        self.updateTime = 0.01
+        
+        # Instrumentation, see Metrics.py
+        self.tickTime = Metrics.histogram("turret_tick_seconds", "CPU time of one control loop tick")
+        self.tickOverruns = Metrics.counter("turret_tick_overruns_total", "Control loop ticks that finished after their deadline")
+        self.settleTime = Metrics.histogram("turret_settle_seconds", "Time from the servos starting to move to all of them settling")
+        self.moveStart = None
+        
+        # Control loop timing, the loop sleeps until its next deadline and blocks entirely while there's nothing to move
+        self.scheduler = LoopScheduler(updateRate)
+        for servo in self.servos:
+            servo.wakeEvent = self.scheduler.wakeEvent
+        self.fireControl.wakeEvent = self.scheduler.wakeEvent
+        
         self.updateThread = threading.Thread(target=self.update, args=(), daemon=True)
-        self.start()
+        if start:
+            self.start()
     
     def enable(self):
         self.enabled = True
+        self.scheduler.wake()
         
     def disable(self):
         self.enabled = False
@@ -56,77 +116,245 @@ class ServoHandler:
         
     def stop(self):
         self.exit = True
+        self.scheduler.wake()
+    
+    def setUpdateRate(self, rate):
+        self.scheduler.setRate(rate)
+        self.scheduler.wake()
+    
+    def moveGroup(self, servos, angles, sCurve = None, tolerance = 0):
+        """
+        Moves a group of servos so they all arrive at the same time, in the time the slowest one needs.
+        When they start at rest the combined move is a straight line instead of an L shape.
+        
+        Parameters:
+            servos (list of Servo): Servos to move.
+            angles (list): Target angle of each servo.
+            sCurve (bool): Use jerk-limited profiles (only when all servos are at rest), defaults to self.sCurve.
+            tolerance (float): Leave the current moves running when every target is within this of where its servo
+                is already heading (degrees).
+        Returns:
+            True if any of the servos is already at its target
+        """
+        if sCurve is None:
+            sCurve = self.sCurve
+        currentTime = timer()
+        
+        targets = [servo.resolveTarget(angle) for servo, angle in zip(servos, angles)]
+        if all(abs(servo.targetAngle - target) <= tolerance for servo, target in zip(servos, targets)):
+            # Already heading there, nothing to replan
+            return any([servo.update(currentTime) for servo in servos])
+        
+        starts = []
+        goals = []
+        for servo, target in zip(servos, targets):
+            servo.update(currentTime)
+            starts.append(servo.currentAngle)
+            if servo.currentSpeed == 0 and abs(target - servo.currentAngle) < servo.deadband:
+                goals.append(servo.currentAngle)
+            else:
+                goals.append(target)
+        
+        speeds = [servo.currentSpeed for servo in servos]
+        jerks = [servo.jerk for servo in servos] if sCurve else None
+        profiles = synchronise(starts, goals, [servo.maxSpeed for servo in servos],
+            [servo.acceleration for servo in servos], currentTime, speeds, jerks)
+        
+        for servo, target, profile in zip(servos, targets, profiles):
+            servo.targetAngle = target
+            servo.setProfile(profile)
+        return any([servo.update(currentTime) for servo in servos])
     
-    def moveTurret(self, angles):
-        a = self.gunYaw.setAngle(angles[0])
-        b = self.gunYPitch.setAngle(angles[1])
-        return a or b
+    def moveTurret(self, angles, sCurve = None, distance = None, tolerance = 0):
+        """
+        Parameters:
+            angles (list): [yaw, pitch] of the gun.
+            distance (float): Range to the target (mm), when given the barrel is raised so the dart drops onto it.
+            tolerance (float): Smallest change of target that replans the move (degrees), see moveGroup().
+        """
+        if distance is not None:
+            angles = [angles[0], angles[1] + self.pitchUp * self.ballistics.correction(distance)]
+        return self.moveGroup([self.gunYaw, self.gunYPitch], angles, sCurve, tolerance)
+        
+    def aimGun(self, distance = None, cameraAngles = None, sCurve = None):
+        """
+        Points the gun at what the camera is looking at, allowing for the offset between them and for drop.
+        Called every tick while tracking, so the move is only replanned once the aim point has moved by more than
+        the PWM can show (self.aimQuantum), smaller changes leave the current move running.
+        
+        Parameters:
+            distance (float): LIDAR range to the target (mm), None assumes gunTransform's default range and skips drop compensation.
+            cameraAngles (list): Camera [yaw, pitch] to aim along, defaults to where the camera is now (e.g. pass a TargetTracker lead point).
+        """
+        if cameraAngles is None:
+            cameraAngles = self.cameraAngles()
+        gunYaw, gunPitch, gunRange = self.gunTransform.gunAngles(cameraAngles, distance)
+        return self.moveTurret([gunYaw, gunPitch], sCurve, gunRange if distance is not None else None, self.aimQuantum)
         
     def adjustCamera(self, angles):
         self.trackYaw.adjust(angles[0])
         self.trackPitch.adjust(angles[1])
         
-    def setCamera(self, angles):
-        self.trackYaw.setAngle(angles[0])
-        self.trackPitch.setAngle(angles[1])
+    def setCamera(self, angles, sCurve = None):
+        self.moveGroup([self.trackYaw, self.trackPitch], angles, sCurve)
     
-    def fromCentre(self, angles):
-        self.trackYaw.setAngle(self.trackYaw.getCurrentAngle() - self.trackYaw.adjustment + angles[0])
-        self.trackPitch.setAngle(self.trackPitch.getCurrentAngle() - self.trackPitch.adjustment + angles[1])
+    def fromCentre(self, angles, currentUptime = None):
+        """
+        Turns the camera towards a face's offset from the centre of view.
+        
+        The move is trackingGain times the offset, plus trackingRateGain times how much the offset changed since the
+        last call (when that was recent enough to be the previous frame).
+        """
+        if (currentUptime is None):
+            currentUptime = timer()
+        rate = [0, 0]
+        if (self.lastOffset is not None and currentUptime - self.lastOffset[0] <= 0.5):
+            rate = [angles[0] - self.lastOffset[1][0], angles[1] - self.lastOffset[1][1]]
+        self.lastOffset = (currentUptime, angles)
         
+        self.moveGroup([self.trackYaw, self.trackPitch], [
+            self.trackYaw.getCurrentAngle() - self.trackYaw.adjustment + self.trackingGain * angles[0] + self.trackingRateGain * rate[0],
+            self.trackPitch.getCurrentAngle() - self.trackPitch.adjustment + self.trackingGain * angles[1] + self.trackingRateGain * rate[1]])
+    
+    def cameraAngles(self, currentUptime = None):
+        """
+        Returns:
+            [yaw, pitch] of the camera gimbal at the given time (defaults to now), in the same angles setCamera takes
+        """
+        if currentUptime is None:
+            currentUptime = timer()
+        return [self.trackYaw.angleAt(currentUptime), self.trackPitch.angleAt(currentUptime)]
+    
+    def track(self, tracker):
+        """
+        Makes the camera follow a TargetTracker's prediction of the target every tick, instead of
+        jumping to each measurement as it arrives.
+        """
+        self.tracker = tracker
+        self.scheduler.wake()
+    
+    def stopTracking(self):
+        self.tracker = None
+    
+    def isTracking(self, currentUptime = None):
+        return self.tracker is not None and self.tracker.active() and not self.tracker.isLost(currentUptime)
     
     def update(self):
         while (not self.exit):
+            self.scheduler.beginTick()
             currentTime = timer()
 
-            if (self.enabled):
-
-                if self._primed:
-                    elapsedTime = currentTime - self.__revTimer
-                    if elapsedTime > self.__spinupTime:
-                        self.__maxSpin = True
-                    if self.__triggerPull:
-                        timeSinceTriggerPull = currentTime - self.__triggerPullTime
-                        if timeSinceTriggerPull > self.__triggerDepressionDelay:
-                            self._trigger.rest()
-                            self.__triggerPull = False
-                            self.__triggerReleaseTime = timer()
-                        else:
-                            self._trigger.setAngle(self.__triggerPullAngle)
-
-
-                self.gunYaw.update()
-                self.gunYPitch.update()
-                self.trackYaw.update()
-                self.trackPitch.update()
-                self._prime.update()
-                self._trigger.update()
-
-            if (self.debug):
-                print("ServoHandler: track-target-angle -> [%s,%s]" % (self.trackYaw.targetAngle,self.trackPitch.targetAngle))
+            self.tick(currentTime)
             
+            if (not self.enabled):
+                self.scheduler.idle()
+            elif (self.atRest() and not self.isTracking(currentTime)):
+                self.scheduler.idle(self.fireControl.nextEvent(currentTime))
+            elif (not self.scheduler.waitNext()):
+                self.tickOverruns.inc()
+    
+    def tick(self, currentTime = None):
+        """
+        One pass of the control loop, update() calls this on its own thread.
+        
+        Parameters:
+            currentTime (float): Time of the tick, defaults to the current timer() value.
+        """
+        tickStart = perfTimer()
+        if currentTime is None:
+            currentTime = timer()
+        
+        if (self.enabled):
+
+            self.fireControl.advance(currentTime)
+
+            if self.isTracking(currentTime):
+                aim = self.tracker.predict(currentTime)
+                self.trackYaw.setAngle(aim[0], currentTime)
+                self.trackPitch.setAngle(aim[1], currentTime)
+
+            self.bank.update(currentTime)
+            
+            if (self.recorder is not None):
+                self.recorder.tick(self.bank, currentTime)
+            
+            if (Metrics.registry.enabled):
+                # Time to settle, from the first tick something moved to the first tick everything is at rest
+                if (self.moveStart is None):
+                    if (not self.bank.resting):
+                        self.moveStart = currentTime
+                elif (self.bank.resting):
+                    self.settleTime.record(currentTime - self.moveStart)
+                    self.moveStart = None
+
+        self.flush()
+        
+        if (Metrics.registry.enabled):
+            self.tickTime.record(perfTimer() - tickStart)
+
+        if (self.debug):
+            print("ServoHandler: track-target-angle -> [%s,%s]" % (self.trackYaw.targetAngle,self.trackPitch.targetAngle))
+    
+    def flush(self):
+        """
+        Sends any servo positions set since the last flush, when writes are batched.
+        """
+        if (self.pwm is not None):
+            self.pwm.flush()
+    
+    def saveCalibration(self, path = None):
+        """
+        Writes the servos' current settings to the calibration profile.
+        
+        Returns:
+            The path written
+        """
+        for name, servo in zip(Calibration.SERVO_NAMES, self.servos):
+            self.calibration.setServo(name, **servo.getCalibration())
+        return self.calibration.save(path)
+    
+    def getWriteStats(self):
+        return self.pwm.getStats() if self.pwm is not None else None
+    
+    def atRest(self):
+        return bool(self.bank.atPos.all())
     
     def inMotion(self):
-        return not (self.trackYaw.atPos and self.trackPitch.atPos)
+        return self.trackYaw.timeToArrival() > 0 or self.trackPitch.timeToArrival() > 0
+    
+    def timeUntilAimed(self):
+        """
+        Returns:
+            Seconds until the gun servos finish their current moves, known as soon as the move is set
+        """
+        return max(self.gunYaw.timeToArrival(), self.gunYPitch.timeToArrival())
     
-    def prime(self, noTimerUpdate = False):
-        if not noTimerUpdate and self._primed:
-            self.__revTimer = timer()
-        self._prime.setAngle(self.__primeActiveAngle)
-        self._primed = True
+    def cameraArrivalTime(self):
+        return max(self.trackYaw.arrivalTime, self.trackPitch.arrivalTime)
+    
+    def prime(self):
+        self.fireControl.prime()
+    
+    def isPrimed(self):
+        return self.fireControl.primed()
         
     def unprime(self):
-        self._primed = False
-        self.__maxSpin = False
-        self.__triggerPull = False
-        self._prime.rest()
-
-    def fire(self):
-        self.prime(noTimerUpdate = True)
-        if not self.__triggerPull:
-            self.__triggerPullTime = timer()
-        if self.__maxSpin and (timer() - self.__triggerReleaseTime) > self.__triggerDepressionDelay:
-            self.__triggerPull = True
+        self.fireControl.unprime()
+
+    def fire(self, shots = 1, cadence = None):
+        """
+        Fires a burst, spinning up first if the blaster isn't primed.
+        
+        Parameters:
+            shots (int): Number of darts.
+            cadence (float): Time between shots (seconds), defaults to the quickest the trigger allows.
+        Returns:
+            False if a burst was already under way
+        """
+        return self.fireControl.fire(shots, cadence)
+    
+    def getFireStats(self):
+        return self.fireControl.getStats()
 
 
 if __name__ == '__main__':
@@ -37,6 +37,24 @@ def inputLoop(responses = ["c","e"], printMsg = ">>>", lowerCase = True):
             validResponse = True
             return userInput
         
+def invertServo(servo):
+    servo.invert = not servo.invert
+    servo.rest()
+
+def setHomeOffsets(servoHandler, step = 1):
+    # Nudges the camera's horn adjustments until it points straight ahead
+    moves = {"u": (servoHandler.trackPitch, step), "d": (servoHandler.trackPitch, -step),
+             "r": (servoHandler.trackYaw, step), "l": (servoHandler.trackYaw, -step)}
+    responses = list(moves) + ["c"]
+    while True:
+        userInput = inputLoop(responses, "u/d/l/r to nudge the camera %s degree, c when it faces straight ahead\n>>>" % step)
+        if responses[userInput] == "c":
+            return
+        servo, change = moves[responses[userInput]]
+        servo.adjustment += change
+        servo.rest()
+        print("Camera adjustment: [%s,%s]" % (servoHandler.trackYaw.adjustment, servoHandler.trackPitch.adjustment))
+
 def main():
     print("""
    _____                        _____          _ _   _                _____      _               
@@ -67,21 +85,36 @@ def main():
     #tilt camera up
     print("\nThe tracking gimbal will now pivot upwards slightly...")
     time.sleep(3)
-    servoHandler.adjustCamera(0,15)
+    servoHandler.adjustCamera([0,15])
     print("Did the gimbal move in the right direction? (upwards)")
     print("Type 'c' to confirm, or 'down' if the gimbal moved downwards instead, then press ENTER")
     userInput = inputLoop(["c","down"])
     if userInput == 1:
-        print("PITCH NEEDS INVERTED")
-    
+        print("Inverting pitch")
+        invertServo(servoHandler.trackPitch)
+    servoHandler.trackPitch.rest()
     
     #turn camera right
-    #turn camera left
+    print("\nThe tracking gimbal will now turn right slightly...")
+    time.sleep(3)
+    servoHandler.adjustCamera([15,0])
+    print("Did the gimbal move in the right direction? (right)")
+    print("Type 'c' to confirm, or 'left' if the gimbal turned left instead, then press ENTER")
+    userInput = inputLoop(["c","left"])
+    if userInput == 1:
+        print("Inverting yaw")
+        invertServo(servoHandler.trackYaw)
+    servoHandler.trackYaw.rest()
     
     #Set home offsets
+    print("\nCentre the camera so it faces straight ahead")
+    setHomeOffsets(servoHandler)
     
-    #Save settings to text file
-    
+    #Save settings to the calibration profile
+    print("\nType 'c' to save this calibration or type 'e' to exit without saving, then press ENTER")
+    if inputLoop() == 1:
+        return
+    print("Saved to %s" % servoHandler.saveCalibration())
     
     #(post on lemmy for a pracitical guide to git)
 
@@ -97,7 +130,7 @@ def main2():
             print('Please enter either "c" to continue:')
         servoHandler = ServoHandler()
         servoHandler.enable()
-        servoHandler.adjustCamera(0,15)
+        servoHandler.adjustCamera([0,15])
         while (not input(">>>") == "e"):
             print(".")
             
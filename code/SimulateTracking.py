@@ -0,0 +1,100 @@
+"""
+Simulated-target harness for TargetTracker.
+
+A target moves along a scripted path, the Person Sensor is modelled as 5 Hz frames with latency and
+quantised, noisy angles, and the camera gimbal is a pair of CustomServo.Servo motion models stepped at 100 Hz.
+Reports the camera's aim error when it jumps to each measurement (the old fromCentre behaviour) and when it
+follows the tracker's prediction, plus the error of the lead point for a dart in flight.
+Runs in simulated time without any hardware attached.
+"""
+
+from CustomServo import Servo
+from TargetTracker import TargetTracker
+from BenchServoBank import StandInServo
+import math
+import random
+
+def weavingTarget(t):
+    # Someone walking back and forth across the room
+    return [90 + 30 * math.sin(2 * math.pi * 0.2 * t), 95 + 8 * math.sin(2 * math.pi * 0.13 * t + 1)]
+
+
+def crossingTarget(t):
+    # Someone walking straight across the field of view and back at 12 degrees per second
+    phase = t % 20
+    return [40 + 12 * min(phase, 20 - phase), 90]
+
+
+def makeCamera():
+    yaw = Servo(StandInServo(), dom=180, minAngle=10, maxAngle=170, restAngle=90, maxSpeed=250, acceleration=2000, name="trackYaw")
+    pitch = Servo(StandInServo(), dom=180, minAngle=10, maxAngle=170, restAngle=90, maxSpeed=250, acceleration=2000, name="trackPitch")
+    return yaw, pitch
+
+
+def simulate(path, useTracker, duration = 30, tickRate = 100, frameRate = 5, latency = 0.1, noise = 0.3, distance = 4000, seed = 0, tracker = None):
+    """
+    Returns:
+        (rms aim error, rms lead error) in degrees, the lead error is None without the tracker
+    """
+    rng = random.Random(seed)
+    yaw, pitch = makeCamera()
+    if tracker is None:
+        tracker = TargetTracker(latency=latency)
+    sensorStep = 110 / 255 # Degrees per sensor coordinate
+
+    tick = 1 / tickRate
+    nextCapture = 0
+    pending = [] # (arrival time, measured angles)
+    aimErrors = []
+    leadErrors = []
+
+    for i in range(int(duration * tickRate)):
+        t = i * tick
+
+        if t >= nextCapture:
+            truth = path(t)
+            measured = [round((angle + rng.gauss(0, noise)) / sensorStep) * sensorStep for angle in truth]
+            pending.append((t + latency, measured))
+            nextCapture += 1 / frameRate
+
+        while pending and pending[0][0] <= t:
+            arrival, measured = pending.pop(0)
+            if useTracker:
+                tracker.addMeasurement(measured, arrival)
+            else:
+                yaw.setAngle(measured[0], t)
+                pitch.setAngle(measured[1], t)
+
+        if useTracker and tracker.active():
+            aim = tracker.predict(t)
+            yaw.setAngle(aim[0], t)
+            pitch.setAngle(aim[1], t)
+
+        yaw.update(t)
+        pitch.update(t)
+
+        if t > 2: # Let everything settle first
+            truth = path(t)
+            aimErrors.append((yaw.angleAt(t) - truth[0]) ** 2 + (pitch.angleAt(t) - truth[1]) ** 2)
+            if useTracker:
+                lead = tracker.aimPoint(distance, t)
+                future = path(t + tracker.flightTime(distance))
+                leadErrors.append((lead[0] - future[0]) ** 2 + (lead[1] - future[1]) ** 2)
+
+    rms = math.sqrt(sum(aimErrors) / len(aimErrors))
+    leadRms = math.sqrt(sum(leadErrors) / len(leadErrors)) if leadErrors else None
+    return rms, leadRms
+
+
+def main():
+    print("%-10s %-22s %14s %15s" % ("target", "aiming", "aim rms (deg)", "lead rms (deg)"))
+    for name, path in (("weaving", weavingTarget), ("crossing", crossingTarget)):
+        jump, _ = simulate(path, False)
+        print("%-10s %-22s %14.2f %15s" % (name, "jump to measurement", jump, "-"))
+        for model in ("cv", "ca"):
+            tracked, lead = simulate(path, True, tracker=TargetTracker(model=model))
+            print("%-10s %-22s %14.2f %15.2f" % (name, "tracker (%s)" % model, tracked, lead))
+
+
+if __name__ == '__main__':
+    main()
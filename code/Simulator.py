@@ -0,0 +1,327 @@
+"""
+In-process simulator of the turret's hardware.
+
+Provides stand-ins for the PCA9685 servo HAT (through the ServoKit interface, or as register writes), the Person Sensor's I2C handle
+and the VL53L0X, driven by scripted targets and a virtual clock. With the virtual clock the control code is
+stepped from a single thread, so hours of operation can run in seconds:
+
+    sim = Simulator([ScriptedTarget(path)])
+    Hardware.useSimulator(sim)
+    handler = ServoHandler(start=False)
+    sensor = PersonSensor(continuous=False)
+    sim.followCamera(handler)
+    sim.run(60, 0.01, lambda t: handler.tick(t))
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from PersonSensor import PersonSensorDecoder, SensorLens
+import math
+import random
+
+class VirtualClock:
+    """
+    Simulated time, it only moves when something sleeps or advance() is called.
+    """
+    def __init__(self, start = 0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.time += seconds
+
+    def advance(self, seconds):
+        self.time += seconds
+
+
+class ScriptedTarget:
+    """
+    A person moving along a scripted path.
+    """
+    def __init__(self, path, distance = 3000, sensorId = -1, idConfidence = 0, confidence = 99, faceWidth = 150):
+        """
+        Parameters:
+            path (function): Takes a time, returns the target's absolute [yaw, pitch] (degrees, as setCamera takes).
+            distance (float or function): Range to the target (mm), or a function of time giving it.
+            sensorId (int): Recognition id the sensor reports, -1 for unrecognised.
+            idConfidence (int): Confidence reported with the id.
+            confidence (int): Box confidence reported.
+            faceWidth (float): Width of the face (mm), sets the box size.
+        """
+        self.path = path
+        self.distance = distance
+        self.sensorId = sensorId
+        self.idConfidence = idConfidence
+        self.confidence = confidence
+        self.faceWidth = faceWidth
+
+    def position(self, t):
+        return self.path(t)
+
+    def distanceAt(self, t):
+        return self.distance(t) if callable(self.distance) else self.distance
+
+
+class SimServo:
+    """
+    One PCA9685 channel, as servokit.servo[index]. Every angle written is logged as a timestamped pulse width.
+    """
+    def __init__(self, simulator, channel):
+        self.simulator = simulator
+        self.channel = channel
+        self.actuation_range = 180
+        self.minPulse = 750
+        self.maxPulse = 2250
+        self._angle = None
+
+    def set_pulse_width_range(self, minPulse, maxPulse):
+        self.minPulse = minPulse
+        self.maxPulse = maxPulse
+
+    @property
+    def angle(self):
+        return self._angle
+
+    @angle.setter
+    def angle(self, value):
+        self._angle = value
+        if value is not None:
+            pulse = self.minPulse + (self.maxPulse - self.minPulse) * value / self.actuation_range
+            self.simulator.recordPulse(self.channel, pulse)
+
+
+class SimPCA9685:
+    """
+    The PCA9685 behind the servo kit, as ServoKit._pca. Block writes to the LED registers are decoded
+    back into pulse widths and logged like SimServo writes, with the bus traffic counted.
+    """
+    LED0_ON_L = 0x06
+
+    def __init__(self, simulator, frequency = 50):
+        self.simulator = simulator
+        self.frequency = frequency
+        self.i2c_device = self
+        self.transactions = 0
+        self.bytesWritten = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, buffer, start = 0, end = None):
+        buffer = bytes(buffer[start:end])
+        self.transactions += 1
+        self.bytesWritten += len(buffer) + 1 # Address byte
+        firstChannel = (buffer[0] - self.LED0_ON_L) // 4
+        for i in range((len(buffer) - 1) // 4):
+            on = buffer[1 + i * 4] | (buffer[2 + i * 4] << 8)
+            off = buffer[3 + i * 4] | (buffer[4 + i * 4] << 8)
+            self.simulator.recordPulse(firstChannel + i, (off - on) * 1000000 / (self.frequency * 4096))
+
+
+class SimServoKit:
+    """
+    Stand-in for adafruit_servokit.ServoKit.
+    """
+    def __init__(self, simulator, channels = 16):
+        self.servo = [SimServo(simulator, i) for i in range(channels)]
+        self._pca = SimPCA9685(simulator)
+
+
+class SimPersonSensorBus:
+    """
+    Stand-in for the Person Sensor's I2C handle. Each read returns a byte-exact result frame, checksum included,
+    showing the scripted targets as seen from the camera's current angles.
+    """
+    def __init__(self, simulator, period = 0.2, latency = 0.1, noise = 0.3, corruptRate = 0, lens = None, seed = 0):
+        """
+        Parameters:
+            period (float): Time between results (seconds).
+            latency (float): Time from capture to the result being readable (seconds).
+            noise (float): Standard deviation of the measured face position (degrees).
+            corruptRate (float): Fraction of reads with a flipped byte, to exercise the checksum.
+            lens (PersonSensor.SensorLens): Projects the targets onto the sensor, defaults to the nominal lens.
+        """
+        self.simulator = simulator
+        self.period = period
+        self.latency = latency
+        self.noise = noise
+        self.corruptRate = corruptRate
+        self.lens = SensorLens() if lens is None else lens
+        self.rng = random.Random(seed)
+        self.decoder = PersonSensorDecoder()
+        self.frameIndex = None
+        self.frame = bytes(self.decoder.RESULT.size)
+        self.reads = 0
+
+    def captureTime(self, frameIndex):
+        return frameIndex * self.period
+
+    def buildFrame(self, captureTime):
+        camera = self.simulator.cameraAngles(captureTime)
+        faces = []
+        for target in self.simulator.targets:
+            angles = target.position(captureTime)
+            distance = target.distanceAt(captureTime)
+            offset = [angles[i] - camera[i] + self.rng.gauss(0, self.noise) for i in range(2)]
+            if abs(offset[0]) > 80 or abs(offset[1]) > 80:
+                continue
+            centre = self.lens.project(*offset)
+            if not (0 <= centre[0] <= 255 and 0 <= centre[1] <= 255):
+                continue
+            halfWidth = math.degrees(math.atan(target.faceWidth / (2 * distance)))
+            halfHeight = halfWidth * 1.3
+            box = [self.lens.project(offset[0] - halfWidth, offset[1])[0], self.lens.project(offset[0], offset[1] - halfHeight)[1],
+                self.lens.project(offset[0] + halfWidth, offset[1])[0], self.lens.project(offset[0], offset[1] + halfHeight)[1]]
+            box = [int(min(255, max(0, round(value)))) for value in box]
+            faces.append([target.confidence] + box + [target.idConfidence, target.sensorId, 1])
+        faces = faces[:self.decoder.FACE_MAX]
+
+        values = [0, 0, self.decoder.RESULT.size - self.decoder.HEADER.size, len(faces)]
+        for i in range(self.decoder.FACE_MAX):
+            values.extend(faces[i] if i < len(faces) else [0] * 8)
+        values.append(0)
+        frame = bytearray(self.decoder.RESULT.pack(*values))
+        self.decoder.CHECKSUM.pack_into(frame, self.decoder.CHECKSUM_OFFSET, self.decoder.crc(frame[:self.decoder.CHECKSUM_OFFSET]))
+        return bytes(frame)
+
+    def readinto(self, buffer):
+        self.reads += 1
+        frameIndex = math.floor((self.simulator.clock.now() - self.latency) / self.period)
+        if frameIndex != self.frameIndex:
+            # The sensor only produces a new result once per period, reads in between repeat it
+            self.frameIndex = frameIndex
+            self.frame = self.buildFrame(self.captureTime(frameIndex))
+        frame = self.frame
+        if self.corruptRate and self.rng.random() < self.corruptRate:
+            frame = bytearray(frame)
+            frame[self.rng.randrange(len(frame))] ^= 0xFF
+        buffer[:len(frame)] = frame
+        return len(frame)
+
+    def read(self, count):
+        buffer = bytearray(count)
+        self.readinto(buffer)
+        return bytes(buffer)
+
+
+class SimRangeSensor:
+    """
+    Stand-in for the VL53L0X, reports the range of the nearest target inside its cone of view.
+    Reads block (on the active clock) for the timing budget like the real sensor.
+    """
+    def __init__(self, simulator, cone = 25, outOfRange = 8190, noise = 10, seed = 1):
+        self.simulator = simulator
+        self.cone = cone
+        self.outOfRange = outOfRange
+        self.noise = noise
+        self.rng = random.Random(seed)
+        self.measurement_timing_budget = 33000 # Microseconds
+        self.signal_rate_limit = 0.25
+        self.continuous = False
+
+    def measure(self, t):
+        camera = self.simulator.cameraAngles(t)
+        distance = self.outOfRange
+        for target in self.simulator.targets:
+            angles = target.position(t)
+            if math.hypot(angles[0] - camera[0], angles[1] - camera[1]) <= self.cone / 2:
+                distance = min(distance, target.distanceAt(t))
+        if distance >= self.outOfRange:
+            return self.outOfRange
+        return int(max(0, distance + self.rng.gauss(0, self.noise)))
+
+    @property
+    def range(self):
+        clock = self.simulator.clock
+        budget = self.measurement_timing_budget / 1e6
+        if self.continuous:
+            # Wait for the next measurement in the continuous sequence
+            ready = math.ceil(clock.now() / budget) * budget
+            clock.sleep(ready - clock.now())
+        else:
+            clock.sleep(budget)
+        return self.measure(clock.now())
+
+    @property
+    def data_ready(self):
+        return True
+
+    def start_continuous(self):
+        self.continuous = True
+
+    def stop_continuous(self):
+        self.continuous = False
+
+    @contextmanager
+    def continuous_mode(self):
+        self.start_continuous()
+        try:
+            yield self
+        finally:
+            self.stop_continuous()
+
+
+class Simulator:
+    """
+    Hardware backend for Hardware.useSimulator().
+    """
+
+    def __init__(self, targets = (), clock = None, pulseLogSize = 100000, **sensorSettings):
+        """
+        Parameters:
+            targets (list of ScriptedTarget): People in the scene.
+            clock: Defaults to a VirtualClock, pass Hardware.RealClock() to run in real time with threads.
+            pulseLogSize (int): Most pulse writes kept in pulseLog.
+            sensorSettings: Passed to SimPersonSensorBus.
+        """
+        self.clock = VirtualClock() if clock is None else clock
+        self.targets = list(targets)
+        self.pulseLog = deque(maxlen=pulseLogSize) # (time, channel, pulse width in microseconds)
+        self.pulseCount = 0
+        self.camera = lambda t: [90, 90]
+        self.sensorSettings = sensorSettings
+        self.kit = None
+        self.personSensor = None
+        self.lidar = None
+
+    def recordPulse(self, channel, pulse):
+        self.pulseLog.append((self.clock.now(), channel, pulse))
+        self.pulseCount += 1
+
+    def cameraAngles(self, t):
+        return self.camera(t)
+
+    def followCamera(self, servoHandler):
+        """
+        Points the simulated sensors wherever the handler's camera gimbal is.
+        """
+        self.camera = servoHandler.cameraAngles
+
+    # Backend interface used by Hardware
+
+    def servoKit(self, channels = 16):
+        self.kit = SimServoKit(self, channels)
+        return self.kit
+
+    def personSensorBus(self, address):
+        self.personSensor = SimPersonSensorBus(self, **self.sensorSettings)
+        return self.personSensor
+
+    def rangeSensor(self):
+        self.lidar = SimRangeSensor(self)
+        return self.lidar
+
+    def run(self, duration, step, tick):
+        """
+        Steps the virtual clock, calling tick(time) every step.
+        """
+        end = self.clock.now() + duration
+        while self.clock.now() < end:
+            tick(self.clock.now())
+            self.clock.advance(step)
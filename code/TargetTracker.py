@@ -0,0 +1,375 @@
+from Hardware import timer
+import math
+import numpy as np
+
+class AxisFilter:
+    """
+    Kalman filter for one angle axis, with a constant velocity or constant acceleration model.
+    """
+
+    def __init__(self, model = "cv", processNoise = 500, measurementNoise = 1):
+        """
+        Parameters:
+            model (str): "cv" for constant velocity, "ca" for constant acceleration.
+            processNoise (float): Spectral density of the unmodelled motion (acceleration for "cv", jerk for "ca").
+            measurementNoise (float): Standard deviation of a measurement (degrees).
+        """
+        if model not in ("cv", "ca"):
+            raise ValueError("Unknown motion model %s" % model)
+        self.model = model
+        self.order = 2 if model == "cv" else 3
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.x = None
+        self.P = None
+
+
+    def transition(self, dt):
+        F = np.eye(self.order)
+        F[0, 1] = dt
+        if self.order == 3:
+            F[0, 2] = dt * dt / 2
+            F[1, 2] = dt
+        return F
+
+
+    def noise(self, dt):
+        q = self.processNoise
+        if self.order == 2:
+            return q * np.array([
+                [dt ** 3 / 3, dt ** 2 / 2],
+                [dt ** 2 / 2, dt]])
+        return q * np.array([
+            [dt ** 5 / 20, dt ** 4 / 8, dt ** 3 / 6],
+            [dt ** 4 / 8, dt ** 3 / 3, dt ** 2 / 2],
+            [dt ** 3 / 6, dt ** 2 / 2, dt]])
+
+
+    def reset(self, position):
+        self.x = np.zeros(self.order)
+        self.x[0] = position
+        # Position is known to the measurement noise, speed and acceleration aren't known at all
+        self.P = np.diag([self.measurementNoise ** 2] + [1e4] * (self.order - 1))
+
+
+    def predict(self, dt):
+        F = self.transition(dt)
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + self.noise(dt)
+
+
+    def correct(self, position):
+        R = self.measurementNoise ** 2
+        innovation = position - self.x[0]
+        S = self.P[0, 0] + R
+        K = self.P[:, 0] / S
+        self.x = self.x + K * innovation
+        self.P = self.P - np.outer(K, self.P[0, :])
+        return innovation
+
+
+    def extrapolate(self, dt):
+        """
+        Returns:
+            (position, speed) dt seconds after the filter's time, without changing the filter
+        """
+        position = self.x[0] + self.x[1] * dt
+        speed = self.x[1]
+        if self.order == 3:
+            position += self.x[2] * dt * dt / 2
+            speed += self.x[2] * dt
+        return position, speed
+
+
+class TargetTracker:
+    """
+    Tracks one target in absolute gimbal angles (yaw, pitch) between Person Sensor frames.
+
+    Measurements are back-dated by the sensor latency before they are filtered, and the filter state is
+    extrapolated to any time, so the servo loop can aim at where the target is now rather than where it was
+    when the last frame was captured. A lead for the dart's flight time can be added on top.
+    """
+
+    def __init__(self, model = "cv", processNoise = 500, measurementNoise = 1, latency = 0.1, muzzleVelocity = 20, maxAge = 1, ballistics = None):
+        """
+        Tracker setup.
+
+        Parameters:
+            model (str): "cv" for constant velocity, "ca" for constant acceleration.
+            processNoise (float): How much the target is expected to manoeuvre, higher follows faster but is noisier.
+            measurementNoise (float): Standard deviation of a measured angle (degrees).
+            latency (float): Time from the sensor capturing a frame to the frame being read (seconds).
+            muzzleVelocity (float): Dart speed used for the lead (metres per second).
+            maxAge (float): Time without a measurement before the track is lost (seconds).
+            ballistics (BallisticsTable): Gives the dart's time of flight with drag, otherwise it flies at muzzleVelocity.
+        """
+        self.axes = [AxisFilter(model, processNoise, measurementNoise), AxisFilter(model, processNoise, measurementNoise)]
+        self.latency = latency
+        self.muzzleVelocity = muzzleVelocity
+        self.ballistics = ballistics
+        self.maxAge = maxAge
+        self.filterTime = None # Time the filter state refers to
+        self.lastMeasurementTime = None
+        self.measurements = 0
+
+
+    def reset(self):
+        self.filterTime = None
+        self.lastMeasurementTime = None
+        self.measurements = 0
+
+
+    def addMeasurement(self, angles, timestamp = None):
+        """
+        Adds a measured target position.
+
+        Parameters:
+            angles (list): Absolute [yaw, pitch] of the target (degrees).
+            timestamp (float): Time the frame was read, defaults to now. The capture time is timestamp - latency.
+        Returns:
+            False if the measurement was older than the filter state and was ignored
+        """
+        if timestamp is None:
+            timestamp = timer()
+        captureTime = timestamp - self.latency
+
+        if self.filterTime is None or self.isLost(timestamp):
+            for axis, angle in zip(self.axes, angles):
+                axis.reset(angle)
+        elif captureTime < self.filterTime:
+            return False
+        else:
+            dt = captureTime - self.filterTime
+            for axis, angle in zip(self.axes, angles):
+                axis.predict(dt)
+                axis.correct(angle)
+
+        self.filterTime = captureTime
+        self.lastMeasurementTime = timestamp
+        self.measurements += 1
+        return True
+
+
+    def active(self):
+        return self.filterTime is not None
+
+
+    def isLost(self, currentUptime = None):
+        if self.lastMeasurementTime is None:
+            return True
+        if currentUptime is None:
+            currentUptime = timer()
+        return currentUptime - self.lastMeasurementTime > self.maxAge
+
+
+    def predict(self, currentUptime = None):
+        """
+        Returns:
+            Predicted [yaw, pitch] of the target at the given time, None before the first measurement
+        """
+        if self.filterTime is None:
+            return None
+        if currentUptime is None:
+            currentUptime = timer()
+        dt = currentUptime - self.filterTime
+        return [float(axis.extrapolate(dt)[0]) for axis in self.axes]
+
+
+    def velocity(self):
+        """
+        Returns:
+            Estimated [yaw, pitch] angular speed of the target (degrees per second)
+        """
+        if self.filterTime is None:
+            return None
+        return [float(axis.x[1]) for axis in self.axes]
+
+
+    def flightTime(self, distance):
+        """
+        Parameters:
+            distance (float): Range to the target (mm), as given by SensorHandler.getDistance().
+        Returns:
+            Time for a dart to reach the target (seconds)
+        """
+        if self.ballistics is not None:
+            return self.ballistics.flightTime(distance)
+        return distance / 1000 / self.muzzleVelocity
+
+
+    def leadAngles(self, distance, currentUptime = None):
+        """
+        Returns:
+            [yaw, pitch] offsets to add to predict() so a dart fired now meets the target
+        """
+        if self.filterTime is None:
+            return None
+        if currentUptime is None:
+            currentUptime = timer()
+        now = self.predict(currentUptime)
+        later = self.predict(currentUptime + self.flightTime(distance))
+        return [b - a for a, b in zip(now, later)]
+
+
+    def aimPoint(self, distance, currentUptime = None):
+        """
+        Returns:
+            Predicted [yaw, pitch] of the target when a dart fired now would arrive
+        """
+        if self.filterTime is None:
+            return None
+        if currentUptime is None:
+            currentUptime = timer()
+        return self.predict(currentUptime + self.flightTime(distance))
+
+
+def boxOverlap(a, b):
+    """
+    Returns:
+        Intersection over union of two Face boxes
+    """
+    width = min(a.box_right, b.box_right) - max(a.box_left, b.box_left)
+    height = min(a.box_bottom, b.box_bottom) - max(a.box_top, b.box_top)
+    if width <= 0 or height <= 0:
+        return 0
+    intersection = width * height
+    union = (a.box_right - a.box_left) * (a.box_bottom - a.box_top) + (b.box_right - b.box_left) * (b.box_bottom - b.box_top) - intersection
+    return intersection / union if union > 0 else 0
+
+
+class Track:
+    """
+    One target followed across frames by MultiTargetTracker.
+    """
+
+    def __init__(self, trackId, face, tracker):
+        self.trackId = trackId
+        self.face = face
+        self.tracker = tracker
+        self.sensorId = -1
+        self.idConfidence = 0
+        self.identity = None # Friend or foe, from an Identity.IdentityCache when one is kept
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "Track(%s, sensorId=%s, hits=%s)" % (self.trackId, self.sensorId, self.hits)
+
+
+class MultiTargetTracker:
+    """
+    Keeps stable tracks for every face in view.
+
+    Faces are matched to tracks by the sensor's recognition id when it is confident, then by box overlap, then by
+    how close they are to where a track predicts its target to be (boxes stop overlapping when the camera moves).
+    Each track has its own TargetTracker, so every target can be predicted between frames.
+    """
+
+    def __init__(self, idConfidence = 60, minOverlap = 0.2, maxTracks = 8, maxAngle = 5, **trackerSettings):
+        """
+        Parameters:
+            idConfidence (int): Sensor id_confidence needed to match a face to a track by its id.
+            minOverlap (float): Box intersection over union needed to match a face to a track by position.
+            maxTracks (int): Most tracks kept at once, the stalest are dropped first.
+            maxAngle (float): Furthest a face can be from a track's predicted position to match it by position (degrees).
+            trackerSettings: Passed to each track's TargetTracker.
+        """
+        self.idConfidence = idConfidence
+        self.minOverlap = minOverlap
+        self.maxTracks = maxTracks
+        self.maxAngle = maxAngle
+        self.trackerSettings = trackerSettings
+        self.tracks = []
+        self.nextTrackId = 1
+
+
+    def update(self, faces, toAngles, timestamp = None):
+        """
+        Matches a frame's faces to tracks and adds each as a measurement.
+
+        Parameters:
+            faces (list of Face): The faces in the frame.
+            toAngles (function): Converts a Face to its absolute [yaw, pitch].
+            timestamp (float): Time the frame was read, defaults to now.
+        Returns:
+            The live tracks
+        """
+        if timestamp is None:
+            timestamp = timer()
+
+        unmatched = list(faces)
+        matches = []
+        free = list(self.tracks)
+
+        # Recognised faces keep their track even if they've moved a long way
+        for face in list(unmatched):
+            if face.id < 0 or face.id_confidence < self.idConfidence:
+                continue
+            for track in free:
+                if track.sensorId == face.id:
+                    matches.append((track, face))
+                    unmatched.remove(face)
+                    free.remove(track)
+                    break
+
+        # Everything else is matched on box overlap, best overlap first
+        pairs = sorted(((boxOverlap(track.face, face), i, j) for i, track in enumerate(free) for j, face in enumerate(unmatched)), reverse=True)
+        usedTracks = set()
+        usedFaces = set()
+        for overlap, i, j in pairs:
+            if overlap < self.minOverlap:
+                break
+            if i in usedTracks or j in usedFaces:
+                continue
+            usedTracks.add(i)
+            usedFaces.add(j)
+            matches.append((free[i], unmatched[j]))
+
+        # Then on distance from each track's predicted position, nearest first
+        angles = {j: toAngles(face) for j, face in enumerate(unmatched) if j not in usedFaces}
+        predictions = {i: track.tracker.predict(timestamp - track.tracker.latency) for i, track in enumerate(free) if i not in usedTracks}
+        pairs = sorted((math.hypot(angles[j][0] - predictions[i][0], angles[j][1] - predictions[i][1]), i, j)
+            for i in predictions if predictions[i] is not None for j in angles)
+        for distance, i, j in pairs:
+            if distance > self.maxAngle:
+                break
+            if i in usedTracks or j in usedFaces:
+                continue
+            usedTracks.add(i)
+            usedFaces.add(j)
+            matches.append((free[i], unmatched[j]))
+
+        for j, face in enumerate(unmatched):
+            if j not in usedFaces:
+                track = Track(self.nextTrackId, face, TargetTracker(**self.trackerSettings))
+                self.nextTrackId += 1
+                self.tracks.append(track)
+                matches.append((track, face))
+
+        matched = set()
+        for track, face in matches:
+            track.face = face
+            track.hits += 1
+            track.misses = 0
+            if face.id >= 0 and face.id_confidence >= self.idConfidence:
+                track.sensorId = face.id
+                track.idConfidence = face.id_confidence
+            track.tracker.addMeasurement(toAngles(face), timestamp)
+            matched.add(track.trackId)
+
+        for track in self.tracks:
+            if track.trackId not in matched:
+                track.misses += 1
+
+        self.tracks = [track for track in self.tracks if not track.tracker.isLost(timestamp)]
+        if len(self.tracks) > self.maxTracks:
+            self.tracks.sort(key=lambda track: track.tracker.lastMeasurementTime, reverse=True)
+            self.tracks = self.tracks[:self.maxTracks]
+        return self.tracks
+
+
+    def getTrack(self, trackId):
+        for track in self.tracks:
+            if track.trackId == trackId:
+                return track
+        return None
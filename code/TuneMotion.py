@@ -0,0 +1,252 @@
+"""
+Tunes the camera servos' speed and acceleration and the fromCentre() gains in simulation.
+
+Every episode runs the turret's own code against the simulator: a target moves along a scripted path, the
+simulated Person Sensor's frames are checked and decoded by PersonSensor and turned into angles by its lens table,
+the camera is turned, and the servos move as CustomServo.Servo models in the handler's ServoBank. The camera is
+turned both ways the turret does it: by fromCentre(), and the way TurretRuntime does, following a TargetTracker's
+prediction through ServoHandler.track(). The gains only matter to the first, the servo limits to both.
+An episode scores the camera's mean aim error over time, a set of parameters scores the mean over every scripted
+motion, noise seed and both ways of tracking. Episodes are independent, so they're spread over a ProcessPoolExecutor.
+
+The search samples the space at random, then refines around the best few. The winner is written to the
+calibration profile ServoHandler loads, see Calibration.py, as long as it doesn't make the tracker path any worse
+than the current settings. Otherwise the best candidate that doesn't is written.
+
+    python TuneMotion.py --candidates 150 --seeds 4
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from SimulateTracking import weavingTarget, crossingTarget
+import argparse
+import math
+import os
+import random
+import time
+
+# Parameter -> (lowest, highest) searched, the servo limits are roughly what an MG996R manages
+SEARCH_SPACE = {
+    "maxSpeed": (100, 450),
+    "acceleration": (500, 5000),
+    "gain": (0.3, 1.5),
+    "rateGain": (0, 1.5),
+}
+CAMERA_SERVOS = ("trackYaw", "trackPitch")
+
+
+def steppingTarget(t):
+    # Someone standing still, then stepping aside every few seconds
+    return [90 + 15 * (int(t / 4) % 3 - 1), 85]
+
+
+MOTIONS = {
+    "weaving": weavingTarget,
+    "crossing": crossingTarget,
+    "stepping": steppingTarget,
+}
+
+# How the camera is turned, fromCentre() or following a TargetTracker as TurretRuntime does
+LAWS = ("fromCentre", "tracker")
+
+
+# Loaded once in each worker process
+_ballistics = None
+
+
+def runEpisode(job):
+    """
+    Runs one simulated tracking episode.
+
+    Parameters:
+        job (tuple): (settings, motion, law, seed, duration, tolerance), settings holds a value for each SEARCH_SPACE name.
+    Returns:
+        (mean aim error (degrees), fraction of the time within tolerance of the target)
+    """
+    global _ballistics
+    settings, motion, law, seed, duration, tolerance = job
+
+    import Calibration
+    import Hardware
+    from Ballistics import BallisticsTable
+    from PersonSensor import PersonSensor
+    from ServoHandler import ServoHandler
+    from Simulator import Simulator, ScriptedTarget
+    from TargetTracker import TargetTracker
+
+    if _ballistics is None:
+        _ballistics = BallisticsTable.cached()
+    path = MOTIONS[motion]
+    simulator = Simulator([ScriptedTarget(path)], seed=seed)
+    Hardware.useSimulator(simulator)
+
+    handler = ServoHandler(start=False, ballistics=_ballistics, calibration=applySettings(Calibration.CalibrationProfile(), settings))
+    handler.enable()
+    sensor = PersonSensor(continuous=False)
+    simulator.followCamera(handler)
+    tracker = None
+    if law == "tracker":
+        tracker = TargetTracker(ballistics=_ballistics)
+        handler.track(tracker)
+
+    errors = []
+    def tick(t):
+        angles = sensor.getLargestFace()
+        if (angles != -1 and sensor.lastStatus == sensor.decoder.ACCEPTED):
+            if tracker is None:
+                handler.fromCentre(angles, t)
+            else:
+                # The face is relative to where the camera was when the frame was captured
+                camera = handler.cameraAngles(t - tracker.latency)
+                tracker.addMeasurement([camera[0] + angles[0], camera[1] + angles[1]], t)
+        handler.tick(t)
+        if t >= 2: # Time to find the target first
+            truth = path(t)
+            camera = handler.cameraAngles(t)
+            errors.append(math.hypot(camera[0] - truth[0], camera[1] - truth[1]))
+
+    simulator.run(duration, 0.01, tick)
+    return sum(errors) / len(errors), sum(1 for error in errors if error <= tolerance) / len(errors)
+
+
+def applySettings(profile, settings):
+    """
+    Returns:
+        The profile with the camera servos' motion limits and the tracking gains set from a candidate's settings
+    """
+    for name in CAMERA_SERVOS:
+        profile.setServo(name, maxSpeed=settings["maxSpeed"], acceleration=settings["acceleration"])
+    profile.setTracking(gain=settings["gain"], rateGain=settings["rateGain"])
+    return profile
+
+
+def currentSettings(profile):
+    servo = profile.servos[CAMERA_SERVOS[0]]
+    return {
+        "maxSpeed": servo["maxSpeed"],
+        "acceleration": servo["acceleration"],
+        "gain": profile.tracking.get("gain", 1),
+        "rateGain": profile.tracking.get("rateGain", 0),
+    }
+
+
+def sample(rng):
+    return {name: rng.uniform(low, high) for name, (low, high) in SEARCH_SPACE.items()}
+
+
+def perturb(settings, rng, scale):
+    # A step around a good candidate, scale is a fraction of each parameter's range
+    perturbed = {}
+    for name, (low, high) in SEARCH_SPACE.items():
+        perturbed[name] = min(high, max(low, settings[name] + rng.gauss(0, scale * (high - low))))
+    return perturbed
+
+
+class Tuner:
+    """
+    Scores candidate settings on every motion and seed, in parallel.
+    """
+
+    def __init__(self, pool, seeds = 4, duration = 15, tolerance = 2):
+        """
+        Parameters:
+            pool (concurrent.futures.Executor): Runs the episodes.
+            seeds (int): Sensor noise seeds each motion is run with.
+            duration (float): Simulated length of each episode (seconds).
+            tolerance (float): Aim error that still counts as on target (degrees).
+        """
+        self.pool = pool
+        self.seeds = seeds
+        self.duration = duration
+        self.tolerance = tolerance
+        self.results = [] # (mean error, on target fraction, settings, {law: mean error}), best first
+        self.episodes = 0
+
+    def evaluate(self, candidates):
+        """
+        Returns:
+            (mean error, on target fraction, settings, {law: mean error}) of each candidate, best first
+        """
+        jobs = [(settings, motion, law, seed, self.duration, self.tolerance)
+            for settings in candidates for motion in MOTIONS for law in LAWS for seed in range(self.seeds)]
+        perCandidate = len(MOTIONS) * len(LAWS) * self.seeds
+        scores = list(self.pool.map(runEpisode, jobs, chunksize=max(1, len(jobs) // (4 * (os.cpu_count() or 1)))))
+        self.episodes += len(jobs)
+
+        results = []
+        for i, settings in enumerate(candidates):
+            episodes = scores[i * perCandidate:(i + 1) * perCandidate]
+            byLaw = {law: [] for law in LAWS}
+            for job, (error, _) in zip(jobs[i * perCandidate:(i + 1) * perCandidate], episodes):
+                byLaw[job[2]].append(error)
+            byLaw = {law: sum(errors) / len(errors) for law, errors in byLaw.items()}
+            results.append((sum(error for error, _ in episodes) / perCandidate, sum(onTarget for _, onTarget in episodes) / perCandidate, settings, byLaw))
+        results.sort(key=lambda result: result[0])
+        self.results = sorted(self.results + results, key=lambda result: result[0])
+        return results
+
+    def search(self, baseline, candidates = 150, rounds = 3, keep = 5, perRound = 30, seed = 0):
+        """
+        Random search over SEARCH_SPACE, then rounds of smaller and smaller steps around the best so far.
+
+        Returns:
+            (mean error, on target fraction, settings, {law: mean error}) of the best candidate
+        """
+        rng = random.Random(seed)
+        self.evaluate([baseline] + [sample(rng) for _ in range(candidates)])
+        scale = 0.1
+        for _ in range(rounds):
+            best = [settings for _, _, settings, _ in self.results[:keep]]
+            self.evaluate([perturb(best[i % keep], rng, scale) for i in range(perRound)])
+            scale /= 2
+        return self.results[0]
+
+
+def formatSettings(settings):
+    return ", ".join("%s %.4g" % (name, value) for name, value in settings.items())
+
+
+def formatScore(result):
+    return "%.2f deg mean error (%s), %.0f%% on target" % (result[0],
+        ", ".join("%s %.2f" % (law, error) for law, error in result[3].items()), 100 * result[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the camera servos and tracking gains in simulation")
+    parser.add_argument("--candidates", type=int, default=150, help="Random candidates before refining")
+    parser.add_argument("--rounds", type=int, default=3, help="Refinement rounds")
+    parser.add_argument("--per-round", type=int, default=30, help="Candidates in each refinement round")
+    parser.add_argument("--seeds", type=int, default=4, help="Sensor noise seeds each motion is run with")
+    parser.add_argument("--duration", type=float, default=15, help="Simulated seconds per episode")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to one per CPU")
+    parser.add_argument("--output", default=None, help="Calibration profile to write, defaults to Calibration.profilePath()")
+    parser.add_argument("--dry-run", action="store_true", help="Don't write the profile")
+    args = parser.parse_args()
+
+    import Calibration
+    profile = Calibration.load(args.output)
+    baseline = currentSettings(profile)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        tuner = Tuner(pool, seeds=args.seeds, duration=args.duration)
+        best = tuner.search(baseline, args.candidates, args.rounds, perRound=args.per_round)
+        baselineScore = next(result for result in tuner.results if result[2] is baseline)
+    elapsed = time.perf_counter() - start
+
+    # TurretRuntime tracks through the TargetTracker, settings that make that worse aren't taken however well they
+    # do with fromCentre(). The current settings always qualify.
+    chosen = next(result for result in tuner.results if result[3]["tracker"] <= baselineScore[3]["tracker"])
+
+    print("%d episodes in %.1fs" % (tuner.episodes, elapsed))
+    print("current: %s (%s)" % (formatScore(baselineScore), formatSettings(baseline)))
+    print("best:    %s (%s)" % (formatScore(best), formatSettings(best[2])))
+    if chosen is not best:
+        print("chosen:  %s (%s), the best makes the tracker path worse" % (formatScore(chosen), formatSettings(chosen[2])))
+
+    if not args.dry_run:
+        settings = {name: round(value, 3) for name, value in chosen[2].items()}
+        print("Saved to %s" % applySettings(profile, settings).save())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,532 @@
+"""
+The turret's main application.
+
+Sensor polling, target selection, servo stepping and fire control run as cooperating asyncio tasks on one
+event loop, each at an explicit rate. The blocking I2C reads run on a worker thread per sensor, so a slow read
+only delays its own task. Tasks hand work to each other through awaitable events (a new frame has arrived,
+the servos have arrived) rather than polling, and stopping cancels every task and leaves the blaster safe.
+
+    python TurretRuntime.py              Run on the turret, tracking only
+    python TurretRuntime.py --armed      Also fire at targets
+    python TurretRuntime.py --sim        Run against the simulator in real time
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from Hardware import timer
+from Identity import IdentityCache
+from Metrics import perfTimer
+from TargetTracker import MultiTargetTracker
+import argparse
+import asyncio
+import Calibration
+import Hardware
+import math
+import signal
+import threading
+
+
+class RateLimiter:
+    """
+    Paces a task to a fixed rate with absolute deadlines, LoopScheduler's awaitable counterpart.
+    """
+
+    def __init__(self, rate, maxLag = 1):
+        """
+        Parameters:
+            rate (float): Iterations per second.
+            maxLag (float): How many periods late an iteration can be before the missed ones are skipped instead of caught up.
+        """
+        self.rate = rate
+        self.period = 1 / rate
+        self.maxLag = maxLag
+        self.nextDeadline = None
+
+        self.ticks = 0
+        self.overruns = 0
+        self.skippedTicks = 0
+        self.maxLateness = 0
+
+    def reset(self):
+        """
+        Restarts the deadline grid, e.g. after the task has been idle.
+        """
+        self.nextDeadline = None
+
+    async def wait(self):
+        """
+        Sleeps until the next deadline.
+
+        Returns:
+            True if the iteration finished in time, False if it overran
+        """
+        now = timer()
+        if self.nextDeadline is None:
+            self.nextDeadline = now
+        self.ticks += 1
+        self.nextDeadline += self.period
+
+        remaining = self.nextDeadline - now
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+            return True
+
+        lateness = -remaining
+        self.overruns += 1
+        self.maxLateness = max(self.maxLateness, lateness)
+        if lateness > self.period * self.maxLag:
+            missed = int(lateness // self.period) + 1
+            self.skippedTicks += missed
+            self.nextDeadline += missed * self.period
+        # Always yield, so an overrunning task can't starve the others
+        await asyncio.sleep(max(0, self.nextDeadline - timer()))
+        return False
+
+    def getStats(self):
+        return {
+            "rate": self.rate,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped_ticks": self.skippedTicks,
+            "max_lateness": self.maxLateness,
+        }
+
+
+class Signal:
+    """
+    An awaitable "it happened again" event, that can be raised from any thread.
+
+    Each raise wakes everything waiting at that moment. The latest value raised is kept, so a waiter that
+    remembers the last sequence number it saw never misses that a newer one has arrived.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.loopThread = threading.get_ident()
+        self.event = asyncio.Event()
+        self.value = None
+        self.seq = 0
+
+    def raiseFromLoop(self, value = None):
+        self.value = value
+        self.seq += 1
+        self.event.set()
+        self.event = asyncio.Event()
+
+    def raiseSignal(self, value = None):
+        if threading.get_ident() == self.loopThread:
+            self.raiseFromLoop(value)
+        else:
+            self.loop.call_soon_threadsafe(self.raiseFromLoop, value)
+
+    def set(self):
+        # Lets a Signal stand in for the threading.Event a Servo sets when it's given a new target
+        self.raiseSignal()
+
+    async def wait(self, afterSeq = None, timeout = None):
+        """
+        Parameters:
+            afterSeq (int): Returns straight away if the signal has been raised since this sequence number.
+            timeout (float): Longest time to wait (seconds), None waits forever.
+        Returns:
+            (sequence number, value) of the latest raise, None if the timeout expired
+        """
+        if afterSeq is None or self.seq <= afterSeq:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.seq, self.value
+
+
+class TurretRuntime:
+    """
+    Wires the sensors, the target tracker and the servos together on one event loop.
+
+    Tasks:
+        sensor - reads the Person Sensor every frame period and raises frameSignal for each new frame
+        range - takes VL53L0X readings as the sensor produces them, at the rate its timing budget sets
+        select - waits for each frame, updates the tracks and picks the target the camera follows
+        servo - steps the servos at updateRate, aiming the gun at the target's lead point, and sleeps while nothing moves
+        fire - primes while there is a target and fires when the gun is on it, only when armed
+    """
+
+    def __init__(self, servoHandler = None, personSensor = None, ranger = None, frameSource = None,
+            updateRate = 100, fireRate = 10, armed = False, confidence = 90, minHits = 3,
+            fireRange = (300, 5000), aimTolerance = 2, idleTimeout = 5, latency = 0.1, friends = (), verifyChecksum = None):
+        """
+        Parameters:
+            servoHandler (ServoHandler): Defaults to a new one, its own update thread is never started.
+            personSensor (PersonSensor): Defaults to a new one that is only read by the sensor task.
+            ranger (RangeSampler): Defaults to one on Hardware.rangeSensor(), sampled by the range task.
+            frameSource (SensorProcess): Take frames and ranges from a sensor process instead of reading the sensors here.
+            updateRate (float): Servo steps per second.
+            fireRate (float): Fire control decisions per second.
+            armed (bool): Fire at targets, otherwise the fire task never starts.
+            confidence (int): Box confidence a face needs to be tracked.
+            minHits (int): Frames a track needs before it can be fired on.
+            fireRange (tuple): Nearest and furthest range to fire at (mm).
+            aimTolerance (float): Furthest the camera can be from the target to fire (degrees).
+            idleTimeout (float): Time without a target before the flywheels spin down (seconds).
+            latency (float): Time from the Person Sensor capturing a frame to it being read (seconds).
+            friends (iterable of int): Person Sensor recognition ids that are never engaged.
+            verifyChecksum (bool): Drop Person Sensor frames whose checksum doesn't match, defaults to the calibration
+                profile's setting. A frameSource checks its frames itself, see SensorProcess.
+        """
+        calibration = servoHandler.calibration if servoHandler is not None else Calibration.load()
+        if verifyChecksum is None:
+            verifyChecksum = calibration.verifyChecksum()
+
+        # Whatever isn't given is brought up at the same time, imports included
+        factories = {}
+        if servoHandler is None:
+            def openServos():
+                from ServoHandler import ServoHandler
+                return ServoHandler(updateRate=updateRate, start=False, calibration=calibration)
+            factories["servoHandler"] = openServos
+        if personSensor is None:
+            def openPersonSensor():
+                from PersonSensor import PersonSensor
+                return PersonSensor(continuous=False, verifyChecksum=verifyChecksum, frameSource=frameSource)
+            factories["personSensor"] = openPersonSensor
+        if ranger is None and frameSource is None:
+            def openRanger():
+                from RangeSampler import RangeSampler
+                return RangeSampler(Hardware.rangeSensor(), start=False)
+            factories["ranger"] = openRanger
+        start = perfTimer()
+        devices, self.startupTimes = Hardware.initialise(**factories)
+        self.startupTimes["total"] = perfTimer() - start
+        servoHandler = devices.get("servoHandler", servoHandler)
+        personSensor = devices.get("personSensor", personSensor)
+        ranger = devices.get("ranger", ranger)
+
+        self.servoHandler = servoHandler
+        self.personSensor = personSensor
+        self.ranger = ranger
+        self.frameSource = frameSource
+        self.armed = armed
+        self.confidence = confidence
+        self.minHits = minHits
+        self.fireRange = fireRange
+        self.aimTolerance = aimTolerance
+        self.idleTimeout = idleTimeout
+        self.maxMisses = 2 # Frames in a row the target can be missing while another face is in view before switching
+        self.latency = latency
+
+        self.tracks = MultiTargetTracker(latency=latency, ballistics=servoHandler.ballistics)
+        self.identities = IdentityCache(friends)
+        self.target = None # Track the camera is following
+        self.lastTargetTime = None
+
+        self.limiters = {
+            "sensor": RateLimiter(1 / personSensor.PERSON_SENSOR_DELAY),
+            "servo": RateLimiter(updateRate),
+        }
+        if armed:
+            self.limiters["fire"] = RateLimiter(fireRate)
+
+        self.loop = None
+        self.tasks = []
+        self.stopping = None
+        self.executors = []
+        self.framesSeen = 0
+        self.targetChanges = 0
+
+
+    # Awaitable events
+
+    async def nextFrame(self, afterSeq = None, timeout = None):
+        """
+        Returns:
+            The next SensorFrame after afterSeq, None if the timeout expired
+        """
+        raised = await self.frameSignal.wait(afterSeq, timeout)
+        return None if raised is None else raised[1]
+
+    async def arrived(self, servos = None, timeout = None):
+        """
+        Waits until the servos have reached their targets. The arrival time is known as soon as a move is
+        planned, so this sleeps until then and only checks again if the move was replanned.
+
+        Parameters:
+            servos (list of Servo): Defaults to the camera gimbal.
+        Returns:
+            True once arrived, False if the timeout expired
+        """
+        if servos is None:
+            servos = [self.servoHandler.trackYaw, self.servoHandler.trackPitch]
+        deadline = None if timeout is None else timer() + timeout
+        while True:
+            remaining = max(servo.timeToArrival() for servo in servos)
+            if remaining <= 0 and all(servo.atPos for servo in servos):
+                return True
+            if deadline is not None and timer() >= deadline:
+                return False
+            if remaining > 0:
+                wait = remaining if deadline is None else min(remaining, deadline - timer())
+                await asyncio.sleep(max(0, wait))
+            else:
+                # Due now, the next servo step will mark it arrived
+                await self.tickSignal.wait(self.tickSignal.seq, None if deadline is None else max(0, deadline - timer()))
+
+
+    # Tasks
+
+    async def sensorTask(self):
+        limiter = self.limiters["sensor"]
+        executor = self.executor("person_sensor")
+        seq = 0
+        while True:
+            if self.frameSource is not None:
+                frame = self.frameSource.latest(seq)
+            else:
+                faces = await self.loop.run_in_executor(executor, self.personSensor.read)
+                frame = None
+                if self.personSensor.lastStatus == self.personSensor.decoder.ACCEPTED:
+                    # Rejected and repeated frames are never published
+                    frame = self.personSensor.frames.put(() if faces == -1 else faces)
+            if frame is not None:
+                seq = frame.seq
+                self.frameSignal.raiseSignal(frame)
+            await limiter.wait()
+
+    async def rangeTask(self):
+        # Paced by the sensor itself, each read waits for its next continuous-mode reading
+        executor = self.executor("vl53l0x")
+        lidar = self.ranger.lidar
+        await self.loop.run_in_executor(executor, lidar.start_continuous)
+        try:
+            while True:
+                # Returns as soon as the sensor's next reading is ready
+                await self.loop.run_in_executor(executor, self.ranger.sampleOnce)
+        finally:
+            lidar.stop_continuous()
+
+    async def selectTask(self):
+        seq = None
+        while True:
+            frame = await self.nextFrame(seq)
+            seq = frame.seq
+            self.framesSeen += 1
+
+            # The faces are relative to where the camera was when the frame was captured
+            camera = self.servoHandler.cameraAngles(frame.timestamp - self.latency)
+            faces = [face for face in frame.data if face.box_confidence >= self.confidence]
+            def toAngles(face):
+                offset = self.personSensor.faceAngles(face)
+                return [camera[0] + offset[0], camera[1] + offset[1]]
+            tracks = self.tracks.update(faces, toAngles, frame.timestamp)
+            for track in tracks:
+                if track.misses == 0:
+                    track.identity = self.identities.observe(track.trackId, track.face, frame.timestamp)
+            self.selectTarget(tracks)
+
+    def selectTarget(self, tracks):
+        # Friends are never followed, even when nobody else is in view
+        live = [track for track in tracks if track.misses == 0 and track.identity != IdentityCache.FRIEND]
+        if (self.target is not None and self.target in tracks and self.target.identity != IdentityCache.FRIEND
+                and (self.target.misses < self.maxMisses or not live)):
+            target = self.target
+        elif live:
+            # Nearest face first, it has the largest box
+            target = max(live, key=lambda track: (track.face.box_right - track.face.box_left) * (track.face.box_bottom - track.face.box_top))
+        else:
+            target = None
+
+        if target is not self.target:
+            self.target = target
+            self.targetChanges += 1
+            if target is None:
+                self.servoHandler.stopTracking()
+            else:
+                self.servoHandler.track(target.tracker)
+                self.wakeSignal.raiseSignal()
+        if target is not None:
+            self.lastTargetTime = timer()
+
+    async def servoTask(self):
+        limiter = self.limiters["servo"]
+        handler = self.servoHandler
+        while True:
+            currentTime = timer()
+            if self.target is not None and handler.isTracking(currentTime):
+                distance = self.distance()
+                if distance is not None:
+                    handler.aimGun(distance, self.target.tracker.aimPoint(distance, currentTime))
+            handler.tick(currentTime)
+            self.tickSignal.raiseSignal(currentTime)
+
+            if handler.atRest() and not handler.isTracking(currentTime):
+                # Nothing to step, sleep until a servo is given a new target or the fire logic is due
+                await self.wakeSignal.wait(self.wakeSignal.seq, handler.fireControl.nextEvent())
+                limiter.reset()
+            else:
+                await limiter.wait()
+
+    async def fireTask(self):
+        limiter = self.limiters["fire"]
+        handler = self.servoHandler
+        while True:
+            currentTime = timer()
+            target = self.target
+            if target is not None and target.hits >= self.minHits and target.identity not in IdentityCache.HOLD_FIRE:
+                handler.prime()
+                distance = self.distance()
+                if (distance is not None and self.fireRange[0] <= distance <= self.fireRange[1]
+                        and self.onTarget(target, currentTime) and handler.timeUntilAimed() == 0):
+                    handler.fire()
+            elif handler.isPrimed() and (self.lastTargetTime is None or currentTime - self.lastTargetTime > self.idleTimeout):
+                handler.unprime()
+            await limiter.wait()
+
+    def onTarget(self, target, currentTime):
+        aim = target.tracker.predict(currentTime)
+        camera = self.servoHandler.cameraAngles(currentTime)
+        return math.hypot(aim[0] - camera[0], aim[1] - camera[1]) <= self.aimTolerance
+
+    def distance(self):
+        if self.frameSource is not None:
+            return self.frameSource.getDistance()
+        return self.ranger.getDistance() if self.ranger is not None else None
+
+
+    # Running
+
+    def executor(self, name):
+        # One thread per device, so each device's reads stay in order and a slow one can't hold up the other
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.executors.append(executor)
+        return executor
+
+    def stop(self):
+        """
+        Asks run() to finish, safe to call from any thread or a signal handler.
+        """
+        if self.loop is not None and self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def run(self, duration = None):
+        """
+        Runs every task until stop() is called, the duration has passed or a task fails.
+
+        Parameters:
+            duration (float): Seconds to run for, None runs until stopped.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.frameSignal = Signal(self.loop)
+        self.tickSignal = Signal(self.loop)
+        self.wakeSignal = Signal(self.loop)
+        for servo in self.servoHandler.servos:
+            servo.wakeEvent = self.wakeSignal
+        self.servoHandler.fireControl.wakeEvent = self.wakeSignal
+
+        coroutines = {"sensor": self.sensorTask(), "select": self.selectTask(), "servo": self.servoTask()}
+        if self.ranger is not None:
+            coroutines["range"] = self.rangeTask()
+        if self.armed:
+            coroutines["fire"] = self.fireTask()
+
+        self.servoHandler.enable()
+        self.tasks = [asyncio.create_task(coroutine, name=name) for name, coroutine in coroutines.items()]
+        stopper = asyncio.create_task(self.stopping.wait())
+        try:
+            done, _ = await asyncio.wait(self.tasks + [stopper], timeout=duration, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stopper and not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            stopper.cancel()
+            await self.shutdown()
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        # Leave the blaster safe and send the final positions
+        handler = self.servoHandler
+        handler.unprime()
+        handler.stopTracking()
+        handler.tick()
+        handler.disable()
+        for servo in handler.servos:
+            servo.wakeEvent = handler.scheduler.wakeEvent
+        handler.fireControl.wakeEvent = handler.scheduler.wakeEvent
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+        self.executors = []
+
+    def getStats(self):
+        return {
+            "frames": self.framesSeen,
+            "tracks": len(self.tracks.tracks),
+            "target_changes": self.targetChanges,
+            "startup": self.startupTimes,
+            "identities": self.identities.getStats(),
+            "fire": self.servoHandler.getFireStats(),
+            "tasks": {name: limiter.getStats() for name, limiter in self.limiters.items()},
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the turret")
+    parser.add_argument("--armed", action="store_true", help="Fire at targets")
+    parser.add_argument("--sim", action="store_true", help="Run against the simulator in real time")
+    parser.add_argument("--duration", type=float, default=None, help="Seconds to run for, default until interrupted")
+    parser.add_argument("--rate", type=float, default=100, help="Servo steps per second")
+    parser.add_argument("--separate-process", action="store_true", help="Read the sensors in a child process")
+    parser.add_argument("--record", default=None, help="Flight recorder log to write, see FlightRecorder.py")
+    parser.add_argument("--friend", type=int, action="append", default=[], help="Person Sensor id never to engage, can be repeated")
+    parser.add_argument("--verify-checksum", action=argparse.BooleanOptionalAction, default=None,
+        help="Drop Person Sensor frames with a bad checksum, defaults to the calibration profile's setting (off)")
+    args = parser.parse_args()
+    if args.sim and args.separate_process:
+        parser.error("the simulator can't follow the camera from a child process")
+
+    simulator = None
+    if args.sim:
+        from Simulator import Simulator, ScriptedTarget
+        simulator = Simulator([ScriptedTarget(lambda t: [90 + 30 * math.sin(0.4 * t), 80], distance=2000)], clock=Hardware.RealClock())
+        Hardware.useSimulator(simulator)
+
+    verifyChecksum = args.verify_checksum
+    if verifyChecksum is None:
+        verifyChecksum = Calibration.load().verifyChecksum()
+
+    frameSource = None
+    if args.separate_process:
+        from SensorProcess import SensorProcess
+        frameSource = SensorProcess(verifyChecksum=verifyChecksum)
+
+    runtime = TurretRuntime(updateRate=args.rate, armed=args.armed, frameSource=frameSource, friends=args.friend,
+        verifyChecksum=verifyChecksum)
+    print("Hardware up in %.3fs %s" % (runtime.startupTimes["total"], {name: round(seconds, 3) for name, seconds in runtime.startupTimes.items() if name != "total"}))
+    if simulator is not None:
+        simulator.followCamera(runtime.servoHandler)
+
+    recorder = None
+    if args.record:
+        from FlightRecorder import FlightRecorder
+        recorder = FlightRecorder(args.record)
+        recorder.attach(runtime.servoHandler, runtime.personSensor, runtime.ranger)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        for signalNumber in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signalNumber, runtime.stop)
+        await runtime.run(args.duration)
+
+    try:
+        asyncio.run(run())
+    finally:
+        if frameSource is not None:
+            frameSource.stop()
+        if recorder is not None:
+            recorder.close()
+    print(runtime.getStats())
+
+
+if __name__ == '__main__':
+    main()